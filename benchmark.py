@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks the overhead of fluidinfo.py against a local, in-process stand-in
+for Fluidinfo (see fakefluidinfo.py) so that no network connection is needed
+and results can be compared from one release to the next.
+
+Usage:
+
+    $ python benchmark.py --calls 2000 --output results.json
+
+For each scenario the number of calls per second, the 50th and 99th
+percentile latencies (in milliseconds) and the number of objects allocated
+per call are emitted as JSON. Python 2 has no allocation tracer so the
+latter is the growth in the garbage collector's generation 0 count (the
+container objects created and not freed) with collection turned off while
+the scenario runs.
+
+Copyright (c) 2009-2010 Seo Sanghyeon, Nicholas Tollervey and others
+
+See README, AUTHORS and LICENSE for more information
+"""
+
+import gc
+import sys
+import time
+import platform
+import argparse
+import requests
+import fluidinfo
+import fakefluidinfo
+if sys.version_info < (2, 6):
+    import simplejson as json
+else:
+    import json
+
+
+NAMESPACE = 'test/benchmark'
+TAGS = ['tag%d' % i for i in range(50)]
+OPAQUE_VALUE = '<html><body>%s</body></html>' % ('x' * 4096)
+STRING_SET = [u'member %d' % i for i in range(5000)]
+ENCODED_STRING_SET = fluidinfo.encode_value(STRING_SET)
+
+
+def setup(client, objects):
+    """
+    Creates the namespace, tags and objects used by the scenarios.
+    """
+    client.post('/namespaces/test', {'name': 'benchmark',
+                                     'description': 'benchmarks'})
+    for tag in TAGS:
+        client.post('/tags/' + NAMESPACE, {'name': tag, 'description': tag,
+                                           'indexed': False})
+    for i in range(objects):
+        for tag in TAGS:
+            client.put(['about', 'object %d' % i, 'test', 'benchmark', tag],
+                       i)
+
+
+def primitive_put(client, i):
+    client.put(['about', 'object %d' % (i % 100), 'test', 'benchmark',
+                'tag0'], i)
+
+
+def opaque_put(client, i):
+    client.put(['about', 'object %d' % (i % 100), 'test', 'benchmark',
+                'tag1'], OPAQUE_VALUE, 'text/html')
+
+
+def string_set_put(client, i):
+    client.put(['about', 'object %d' % (i % 100), 'test', 'benchmark',
+                'tag3'], STRING_SET)
+
+
+def encoded_string_set_put(client, i):
+    client.put(['about', 'object %d' % (i % 100), 'test', 'benchmark',
+                'tag3'], ENCODED_STRING_SET)
+
+
+def values_query(client, i):
+    client.get('/values', tags=[NAMESPACE + '/' + tag for tag in TAGS],
+               query='has %s/tag2' % NAMESPACE)
+
+
+def list_path_get(client, i):
+    client.get(['about', 'object %d/with a slash' % (i % 100), 'test',
+                'benchmark', 'tag0'])
+
+
+def build_url(client, i):
+    client.build_url(['about', 'object %d/with a slash' % (i % 100), 'test',
+                      'benchmark', 'tag0'])
+
+
+def path_build_url(client, i):
+    client.build_url(fluidinfo.path('about', 'object %d/with a slash' %
+                                    (i % 100), 'test', 'benchmark', 'tag0'))
+
+
+# The scenarios to run and the proportion of the requested number of calls
+# each one makes (the /values queries are far more expensive than the rest).
+SCENARIOS = [
+    ('primitive_put', primitive_put, 1),
+    ('opaque_put', opaque_put, 1),
+    ('string_set_put', string_set_put, 0.1),
+    ('encoded_string_set_put', encoded_string_set_put, 0.1),
+    ('values_query', values_query, 0.1),
+    ('list_path_get', list_path_get, 1),
+    ('build_url', build_url, 10),
+    ('path_build_url', path_build_url, 10),
+]
+
+
+def run(fn, client, calls):
+    """
+    Calls fn(client, i) the given number of times and returns a dictionary
+    of statistics about the calls.
+    """
+    latencies = []
+    gc.collect()
+    gc.disable()
+    try:
+        allocated = gc.get_count()[0]
+        started = time.time()
+        for i in xrange(calls):
+            before = time.time()
+            fn(client, i)
+            latencies.append(time.time() - before)
+        elapsed = time.time() - started
+        allocated = gc.get_count()[0] - allocated
+    finally:
+        gc.enable()
+    latencies.sort()
+    return {
+        'calls': calls,
+        'calls_per_second': calls / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'allocations_per_call': float(allocated) / calls,
+    }
+
+
+def percentile(ordered, percent):
+    index = int(round((len(ordered) - 1) * percent / 100.0))
+    return ordered[index]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calls', type=int, default=1000,
+                        help='the number of calls made by each scenario')
+    parser.add_argument('--objects', type=int, default=100,
+                        help='the number of objects to create')
+    parser.add_argument('--scenario', action='append',
+                        help='only run the named scenario(s)')
+    parser.add_argument('--output', help='write the JSON results here')
+    args = parser.parse_args(argv)
+    results = {
+        'python': platform.python_version(),
+        'requests': requests.__version__,
+        'timestamp': time.time(),
+        'scenarios': {},
+    }
+    with fakefluidinfo.FakeFluidinfoServer() as url:
+        client = fluidinfo.FluidinfoClient(url, 'test', 'test')
+        setup(client, args.objects)
+        for name, fn, proportion in SCENARIOS:
+            if args.scenario and name not in args.scenario:
+                continue
+            calls = max(1, int(args.calls * proportion))
+            # warm up the connection pool before measuring
+            fn(client, 0)
+            results['scenarios'][name] = run(fn, client, calls)
+        client.pool.close()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        out = open(args.output, 'w')
+        try:
+            out.write(output + '\n')
+        finally:
+            out.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory stand-in for Fluidinfo for use in tests and benchmarks
+
+It implements enough of the /objects, /about, /values, /namespaces, /tags,
+/permissions and /users parts of the RESTful API to exercise fluidinfo.py
+without a network connection to a real instance. Nothing is persisted and
+every request is treated as coming from an authorised user.
+
+Copyright (c) 2009-2010 Seo Sanghyeon, Nicholas Tollervey and others
+
+See README, AUTHORS and LICENSE for more information
+"""
+
+import re
+import sys
+import zlib
+import uuid
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import fluidinfo
+if sys.version_info < (2, 6):
+    import simplejson as json
+else:
+    import json
+
+
+JSON = 'application/json'
+PRIMITIVE = 'application/vnd.fluiddb.value+json'
+
+
+class FakeFluidinfo(object):
+    """
+    Holds the objects, namespaces, tags and users of the fake instance and
+    answers requests made to it with handle().
+
+    users = The usernames of the users to create (each gets a top level
+        namespace of the same name)
+    compress_threshold = The size in bytes above which response bodies are
+        gzipped (or deflated) for clients that accept it (None means never)
+    """
+
+    def __init__(self, users=('test',), compress_threshold=1024):
+        self.compress_threshold = compress_threshold
+        self.objects = {}
+        self.about = {}
+        self.namespaces = {}
+        self.tags = {}
+        self.users = {}
+        self.permissions = {}
+        self.lock = threading.RLock()
+        self.namespaces['fluiddb'] = {'id': str(uuid.uuid4()),
+                                      'description': 'Fluidinfo itself'}
+        for tag in ('fluiddb/about', 'fluiddb/users/username'):
+            self.tags[tag] = {'id': str(uuid.uuid4()), 'description': tag,
+                              'indexed': True}
+        for username in users:
+            self.add_user(username)
+
+    def add_user(self, username):
+        """
+        Creates a user along with their top level namespace.
+        """
+        with self.lock:
+            object_id = self._object(None)
+            self.objects[object_id]['tags']['fluiddb/users/username'] = (
+                username, PRIMITIVE)
+            self.users[username] = {'name': username, 'id': object_id}
+            self.namespaces[username] = {'id': str(uuid.uuid4()),
+                                         'description': username}
+
+    def handle(self, method, path, query, headers, body):
+        """
+        Answers a request and returns a (status, headers, body) tuple.
+
+        method = The HTTP verb
+        path = The percent-encoded path of the URL
+        query = A list of (name, value) query-string arguments
+        headers = A dictionary of request headers with lower case names
+        body = The request body as a string (gzipped or deflated if the
+            content-encoding header says so)
+        """
+        elements = [urllib.unquote(e).decode('utf-8')
+                    for e in path.split('/')[1:]]
+        args = {}
+        for name, value in query:
+            args.setdefault(name, []).append(value)
+        try:
+            body = _decompress(headers.get('content-encoding'), body)
+            if not elements or not elements[0]:
+                raise Error(404, 'NoSuchResource')
+            handler = getattr(self, '_' + elements[0], None)
+            if handler is None:
+                raise Error(404, 'NoSuchResource')
+            with self.lock:
+                status, content_type, content = handler(
+                    method.upper(), elements[1:], args, headers, body)
+        except Error, e:
+            return e.status, {'Content-Type': 'text/html',
+                              'X-FluidDB-Error-Class': e.error_class}, ''
+        # like Fluidinfo, always send a content-type
+        response_headers = {'Content-Type': content_type or 'text/html'}
+        if content_type in (JSON, PRIMITIVE):
+            content = json.dumps(content)
+        if method.upper() == 'HEAD':
+            content = ''
+        content = content or ''
+        if (self.compress_threshold is not None and
+            len(content) > self.compress_threshold):
+            encoding = _accepted_encoding(headers.get('accept-encoding', ''))
+            if encoding is not None:
+                response_headers['Content-Encoding'] = encoding
+                content = _compress(encoding, content)
+        return status, response_headers, content
+
+    # Resources
+
+    def _objects(self, method, elements, args, headers, body):
+        if not elements:
+            if method == 'POST':
+                about = _json(body).get('about')
+                if about is not None and about in self.about:
+                    object_id = self.about[about]
+                else:
+                    object_id = self._object(about)
+                return 201, JSON, {'id': object_id,
+                                   'URI': '/objects/' + object_id}
+            if method == 'GET':
+                ids = self._query(_arg(args, 'query'))
+                return 200, JSON, {'ids': ids}
+            raise Error(405, 'MethodNotAllowed')
+        object_id = elements[0]
+        if object_id not in self.objects:
+            if method == 'PUT' and len(elements) > 1:
+                self.objects[object_id] = {'about': None, 'tags': {}}
+            else:
+                raise Error(404, 'NoSuchObject')
+        return self._object_resource(method, object_id, elements[1:],
+                                     headers, body)
+
+    def _about(self, method, elements, args, headers, body):
+        if not elements:
+            raise Error(404, 'NoSuchResource')
+        about = elements[0]
+        object_id = self.about.get(about)
+        if object_id is None:
+            if method == 'POST' and len(elements) == 1:
+                object_id = self._object(about)
+                return 201, JSON, {'id': object_id,
+                                   'URI': '/objects/' + object_id}
+            if method == 'PUT' and len(elements) > 1:
+                object_id = self._object(about)
+            else:
+                raise Error(404, 'NoSuchObject')
+        elif method == 'POST' and len(elements) == 1:
+            return 200, JSON, {'id': object_id,
+                               'URI': '/objects/' + object_id}
+        return self._object_resource(method, object_id, elements[1:],
+                                     headers, body)
+
+    def _object_resource(self, method, object_id, tag_elements, headers,
+                         body):
+        tags = self.objects[object_id]['tags']
+        if not tag_elements:
+            if method not in ('GET', 'HEAD'):
+                raise Error(405, 'MethodNotAllowed')
+            return 200, JSON, {'id': object_id,
+                               'about': self.objects[object_id]['about'],
+                               'tagPaths': sorted(tags)}
+        tag = '/'.join(tag_elements)
+        if method in ('GET', 'HEAD'):
+            if tag not in tags:
+                raise Error(404, 'NoSuchTag')
+            value, content_type = tags[tag]
+            return 200, content_type, value
+        if method == 'PUT':
+            if tag not in self.tags:
+                raise Error(404, 'NoSuchTag')
+            content_type = headers.get('content-type', '')
+            if content_type == PRIMITIVE:
+                value = _json(body)
+            else:
+                value = body
+            tags[tag] = (value, content_type)
+            return 204, None, None
+        if method == 'DELETE':
+            tags.pop(tag, None)
+            return 204, None, None
+        raise Error(405, 'MethodNotAllowed')
+
+    def _values(self, method, elements, args, headers, body):
+        if method in ('GET', 'HEAD'):
+            wanted = args.get('tag', [])
+            results = {}
+            for object_id in self._query(_arg(args, 'query')):
+                tags = self.objects[object_id]['tags']
+                values = {}
+                for tag in wanted:
+                    if tag == 'fluiddb/id':
+                        values[tag] = {'value': object_id}
+                    elif tag in tags:
+                        value, content_type = tags[tag]
+                        if content_type == PRIMITIVE:
+                            values[tag] = {'value': value}
+                        else:
+                            values[tag] = {'value-type': content_type,
+                                           'size': len(value)}
+                results[object_id] = values
+            return 200, JSON, {'results': {'id': results}}
+        if method == 'PUT':
+            for query, values in _json(body)['queries']:
+                for tag in values:
+                    if tag not in self.tags:
+                        raise Error(404, 'NoSuchTag')
+                ids = self._query(query)
+                if not ids:
+                    # setting values on an about value creates the object
+                    about = _exact_about(query)
+                    if about is not None:
+                        ids = [self._object(about)]
+                for object_id in ids:
+                    tags = self.objects[object_id]['tags']
+                    for tag, value in values.items():
+                        tags[tag] = (value['value'], PRIMITIVE)
+            return 204, None, None
+        if method == 'DELETE':
+            for object_id in self._query(_arg(args, 'query')):
+                for tag in args.get('tag', []):
+                    self.objects[object_id]['tags'].pop(tag, None)
+            return 204, None, None
+        raise Error(405, 'MethodNotAllowed')
+
+    def _namespaces(self, method, elements, args, headers, body):
+        path = '/'.join(elements)
+        if method == 'POST':
+            if path not in self.namespaces:
+                raise Error(404, 'NoSuchNamespace')
+            data = _json(body)
+            child = path + '/' + data['name']
+            if child in self.namespaces or child in self.tags:
+                raise Error(412, 'NamespaceAlreadyExists')
+            namespace_id = str(uuid.uuid4())
+            self.namespaces[child] = {'id': namespace_id,
+                                      'description': data.get('description',
+                                                              '')}
+            return 201, JSON, {'id': namespace_id,
+                               'URI': '/namespaces/' + child}
+        namespace = self.namespaces.get(path)
+        if namespace is None:
+            raise Error(404, 'NoSuchNamespace')
+        if method in ('GET', 'HEAD'):
+            result = {'id': namespace['id']}
+            if _flag(args, 'returnDescription'):
+                result['description'] = namespace['description']
+            if _flag(args, 'returnNamespaces'):
+                result['namespaceNames'] = _children(self.namespaces, path)
+            if _flag(args, 'returnTags'):
+                result['tagNames'] = _children(self.tags, path)
+            return 200, JSON, result
+        if method == 'PUT':
+            namespace['description'] = _json(body).get('description', '')
+            return 204, None, None
+        if method == 'DELETE':
+            if (_children(self.namespaces, path) or
+                _children(self.tags, path)):
+                raise Error(412, 'NamespaceNotEmpty')
+            del self.namespaces[path]
+            return 204, None, None
+        raise Error(405, 'MethodNotAllowed')
+
+    def _tags(self, method, elements, args, headers, body):
+        path = '/'.join(elements)
+        if method == 'POST':
+            if path not in self.namespaces:
+                raise Error(404, 'NoSuchNamespace')
+            data = _json(body)
+            child = path + '/' + data['name']
+            if child in self.tags or child in self.namespaces:
+                raise Error(412, 'TagAlreadyExists')
+            tag_id = str(uuid.uuid4())
+            self.tags[child] = {'id': tag_id,
+                                'description': data.get('description', ''),
+                                'indexed': data.get('indexed', False)}
+            return 201, JSON, {'id': tag_id, 'URI': '/tags/' + child}
+        tag = self.tags.get(path)
+        if tag is None:
+            raise Error(404, 'NoSuchTag')
+        if method in ('GET', 'HEAD'):
+            result = {'id': tag['id'], 'indexed': tag['indexed']}
+            if _flag(args, 'returnDescription'):
+                result['description'] = tag['description']
+            return 200, JSON, result
+        if method == 'PUT':
+            tag['description'] = _json(body).get('description', '')
+            return 204, None, None
+        if method == 'DELETE':
+            del self.tags[path]
+            for obj in self.objects.values():
+                obj['tags'].pop(path, None)
+            return 204, None, None
+        raise Error(405, 'MethodNotAllowed')
+
+    def _permissions(self, method, elements, args, headers, body):
+        if not elements:
+            raise Error(404, 'NoSuchResource')
+        kind, path = elements[0], '/'.join(elements[1:])
+        things = {'namespaces': self.namespaces, 'tags': self.tags,
+                  'tag-values': self.tags}.get(kind)
+        if things is None or path not in things:
+            raise Error(404, 'NoSuchResource')
+        key = (kind, path, _arg(args, 'action'))
+        if method in ('GET', 'HEAD'):
+            default = {'policy': 'open', 'exceptions': [path.split('/')[0]]}
+            return 200, JSON, self.permissions.get(key, default)
+        if method == 'PUT':
+            self.permissions[key] = _json(body)
+            return 204, None, None
+        raise Error(405, 'MethodNotAllowed')
+
+    def _users(self, method, elements, args, headers, body):
+        if len(elements) != 1 or elements[0] not in self.users:
+            raise Error(404, 'NoSuchUser')
+        if method not in ('GET', 'HEAD'):
+            raise Error(405, 'MethodNotAllowed')
+        return 200, JSON, self.users[elements[0]]
+
+    # Helpers
+
+    def _object(self, about):
+        object_id = str(uuid.uuid4())
+        tags = {}
+        if about is not None:
+            tags['fluiddb/about'] = (about, PRIMITIVE)
+            self.about[about] = object_id
+        self.objects[object_id] = {'about': about, 'tags': tags}
+        return object_id
+
+    def _query(self, query):
+        if query is None:
+            raise Error(400, 'MissingArgument')
+        try:
+            match = _parse_query(query)
+        except ValueError:
+            raise Error(400, 'QueryParseError')
+        return [object_id for object_id, obj in self.objects.items()
+                if match(object_id, obj['tags'])]
+
+
+class Error(Exception):
+    """
+    An error response from the fake instance.
+    """
+
+    def __init__(self, status, error_class):
+        Exception.__init__(self, status, error_class)
+        self.status = status
+        self.error_class = error_class
+
+
+class FakeFluidinfoServer(object):
+    """
+    Serves a FakeFluidinfo over HTTP on a background thread. Use it as a
+    context manager or call start() and stop()::
+
+        with FakeFluidinfoServer() as url:
+            client = fluidinfo.FluidinfoClient(url)
+
+    fake = The FakeFluidinfo to serve (a new one is created if not given)
+    """
+
+    def __init__(self, fake=None, host='127.0.0.1', port=0):
+        if fake is None:
+            fake = FakeFluidinfo()
+        self.fake = fake
+        self.address = (host, port)
+        self.server = None
+        self.url = None
+
+    def start(self):
+        """
+        Starts serving and returns the base URL of the fake instance.
+        """
+        self.server = _ThreadingHTTPServer(self.address, _Handler)
+        self.server.fake = self.fake
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://%s:%d' % self.server.server_address
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeTransport(object):
+    """
+    A transport for FluidinfoClient that hands requests straight to a
+    FakeFluidinfo without going anywhere near a socket::
+
+        client = fluidinfo.FluidinfoClient('http://fake',
+                                           transport=FakeTransport())
+
+    fake = The FakeFluidinfo to use (a new one is created if not given)
+    """
+
+    # nothing can go wrong in transit
+    errors = ()
+    retryable_errors = ()
+
+    def __init__(self, fake=None):
+        if fake is None:
+            fake = FakeFluidinfo()
+        self.fake = fake
+
+    def request(self, method, url, body=None, headers=None, stream=False):
+        parts = urlparse.urlsplit(url)
+        headers = dict((name.lower(), value)
+                       for name, value in (headers or {}).items())
+        status, response_headers, content = self.fake.handle(
+            method, parts.path, urlparse.parse_qsl(parts.query, True),
+            headers, fluidinfo.read_body(body) or '')
+        return fluidinfo.TransportResponse(status, response_headers, content)
+
+    def close(self):
+        pass
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one go rather than waiting on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle_request(self):
+        parts = urlparse.urlsplit(self.path)
+        headers = dict((name.lower(), value)
+                       for name, value in self.headers.items())
+        status, response_headers, content = self.server.fake.handle(
+            self.command, parts.path, urlparse.parse_qsl(parts.query, True),
+            headers, self.read_body())
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+    def read_body(self):
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return ''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length)
+
+    def log_message(self, *args):
+        pass
+
+
+# Queries
+
+_QUERY_TOKEN = re.compile(r'\s*(?:("(?:[^"\\]|\\.)*")|(-?\d+(?:\.\d+)?)|'
+                          r'(<=|>=|!=|[=<>(),])|([^\s=<>!(),"]+))')
+
+
+def _tokenize(query):
+    tokens = []
+    position = 0
+    query = query.strip()
+    while position < len(query):
+        match = _QUERY_TOKEN.match(query, position)
+        if match is None:
+            raise ValueError(query)
+        string, number, operator, word = match.groups()
+        if string is not None:
+            tokens.append(('value', json.loads(string)))
+        elif number is not None:
+            tokens.append(('value', json.loads(number)))
+        elif operator is not None:
+            tokens.append(('op', operator))
+        elif word in ('and', 'or', 'has', 'in', 'except'):
+            tokens.append(('op', word))
+        elif word in ('true', 'false', 'null'):
+            tokens.append(('value', json.loads(word)))
+        else:
+            tokens.append(('path', word))
+        position = match.end()
+    return tokens
+
+
+def _parse_query(query):
+    """
+    Turns a (subset of the) Fluidinfo query language into a function that
+    takes an object id and its tags and returns whether the object matches.
+    """
+    tokens = _tokenize(query)
+    match, position = _parse_or(tokens, 0)
+    if position != len(tokens):
+        raise ValueError(query)
+    return match
+
+
+def _parse_or(tokens, position):
+    left, position = _parse_and(tokens, position)
+    while position < len(tokens) and tokens[position] == ('op', 'or'):
+        right, position = _parse_and(tokens, position + 1)
+        left = (lambda a, b: lambda i, t: a(i, t) or b(i, t))(left, right)
+    return left, position
+
+
+def _parse_and(tokens, position):
+    left, position = _parse_term(tokens, position)
+    while position < len(tokens) and tokens[position] in (('op', 'and'),
+                                                          ('op', 'except')):
+        negate = tokens[position][1] == 'except'
+        right, position = _parse_term(tokens, position + 1)
+        left = (lambda a, b, n: lambda i, t: a(i, t) and
+                (not b(i, t) if n else b(i, t)))(left, right, negate)
+    return left, position
+
+
+def _parse_term(tokens, position):
+    token = _token(tokens, position)
+    if token == ('op', '('):
+        match, position = _parse_or(tokens, position + 1)
+        if _token(tokens, position) != ('op', ')'):
+            raise ValueError('Expected )')
+        return match, position + 1
+    if token == ('op', 'has'):
+        kind, path = _token(tokens, position + 1)
+        if kind != 'path':
+            raise ValueError('Expected a tag path')
+        return (lambda i, t: path in t), position + 2
+    kind, path = token
+    if kind != 'path':
+        raise ValueError('Expected a tag path')
+    kind, operator = _token(tokens, position + 1)
+    if operator == 'in':
+        if _token(tokens, position + 2) != ('op', '('):
+            raise ValueError('Expected (')
+        values = []
+        position += 3
+        while True:
+            kind, value = _token(tokens, position)
+            if kind != 'value':
+                raise ValueError('Expected a value')
+            values.append(value)
+            kind, separator = _token(tokens, position + 1)
+            position += 2
+            if separator == ')':
+                break
+            if separator != ',':
+                raise ValueError('Expected , or )')
+        return (lambda i, t: _tag_value(path, i, t) in values), position
+    kind, value = _token(tokens, position + 2)
+    if kind != 'value' or operator not in _COMPARISONS:
+        raise ValueError('Expected a comparison')
+    compare = _COMPARISONS[operator]
+
+    def match(object_id, tags):
+        current = _tag_value(path, object_id, tags)
+        return current is not _MISSING and compare(current, value)
+    return match, position + 3
+
+
+_MISSING = object()
+
+_COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _token(tokens, position):
+    if position >= len(tokens):
+        raise ValueError('Unexpected end of query')
+    return tokens[position]
+
+
+def _tag_value(path, object_id, tags):
+    if path == 'fluiddb/id':
+        return object_id
+    if path in tags:
+        return tags[path][0]
+    return _MISSING
+
+
+def _exact_about(query):
+    """
+    Returns the about value if the query is of the form fluiddb/about = "x".
+    """
+    try:
+        tokens = _tokenize(query)
+    except ValueError:
+        return None
+    if (len(tokens) == 3 and tokens[0] == ('path', 'fluiddb/about') and
+        tokens[1] == ('op', '=') and tokens[2][0] == 'value'):
+        return tokens[2][1]
+    return None
+
+
+def _accepted_encoding(accept_encoding):
+    """
+    Returns the compression to use ('gzip' or 'deflate') given the value of
+    an Accept-Encoding header, or None if neither is acceptable.
+    """
+    accepted = set()
+    for part in accept_encoding.split(','):
+        params = [param.strip() for param in part.split(';')]
+        if 'q=0' in params or 'q=0.0' in params:
+            continue
+        accepted.add(params[0].lower())
+    for encoding in ('gzip', 'deflate'):
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def _compress(encoding, content):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6)
+    return compressor.compress(content) + compressor.flush()
+
+
+def _decompress(encoding, body):
+    if not encoding or encoding == 'identity':
+        return body
+    try:
+        if encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if encoding == 'deflate':
+            return zlib.decompress(body)
+    except zlib.error:
+        raise Error(400, 'BadRequest')
+    raise Error(415, 'UnsupportedMediaType')
+
+
+def _json(body):
+    if not body:
+        return {}
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise Error(400, 'BadRequest')
+
+
+def _arg(args, name):
+    values = args.get(name)
+    if values:
+        return values[0]
+    return None
+
+
+def _flag(args, name):
+    return (_arg(args, name) or '').lower() == 'true'
+
+
+def _children(things, path):
+    prefix = path + '/'
+    return sorted(name[len(prefix):] for name in things
+                  if name.startswith(prefix) and '/' not in
+                  name[len(prefix):])
@@ -7,14 +7,55 @@ Copyright (c) 2009-2010 Seo Sanghyeon, Nicholas Tollervey and others
 See README, AUTHORS and LICENSE for more information
 """
 
+import os
+import re
 import sys
-import requests
+import time
+import base64
+import binascii
+import bisect
+import random
+import email.utils
+import threading
+import Queue
 import urllib
 import types
+import zlib
+import weakref
+import collections
+from collections import OrderedDict
 if sys.version_info < (2, 6):
     import simplejson as json
 else:
     import json
+# requests is only needed by the default transport (ConnectionPool) so other
+# transports, such as the one in gae_fluidinfo, work without it.
+try:
+    import requests
+    import requests.adapters
+except ImportError:
+    requests = None
+# sqlite3 is only needed by Mirror and by an AboutResolver given a database
+# file (and isn't available on App Engine).
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+# mmap is only needed to send mmap bodies without copying them (and isn't
+# available on App Engine).
+try:
+    import mmap
+except ImportError:
+    mmap = None
+# If it's installed, a recent simplejson encodes faster than the json module
+# (it's only used for encoding since it decodes ASCII strings to str rather
+# than unicode). Assign any function that behaves like json.dumps to
+# json_dumps to use something else.
+try:
+    import simplejson
+    json_dumps = simplejson.dumps
+except ImportError:
+    json_dumps = json.dumps
 
 
 # There are currently two instances of Fluidinfo. MAIN is the default standard
@@ -32,24 +73,3400 @@ SERIALIZABLE_TYPES = set((types.NoneType, bool, int, float, str, unicode, list,
 
 global_headers = {
     'Accept': '*/*',
+    'Accept-Encoding': 'gzip, deflate',
 }
 
 
+# Default settings for the keep-alive connection pool. POOL_SIZE is the
+# maximum number of connections kept open to each host and IDLE_TIMEOUT is the
+# number of seconds a host's connections may sit unused before they're thrown
+# away (the server will probably have dropped them by then anyway).
+POOL_SIZE = 10
+IDLE_TIMEOUT = 60
+
+
+# The number of bytes read from the network at a time when streaming responses.
+CHUNK_SIZE = 64 * 1024
+
+
+# The number of calls made with async=True that may be waiting for a worker
+# thread before making another one blocks (so a loop firing off calls can't
+# queue up more than this in memory).
+MAX_PENDING = 1000
+
+
+class FluidinfoError(Exception):
+    """
+    Raised when Fluidinfo responds with an error to a request whose result
+    can't be returned as a (headers, result) tuple.
+
+    headers = The response headers (including the 'status')
+    result = The content of the response
+    """
+
+    def __init__(self, headers, result):
+        Exception.__init__(self, headers['status'], result)
+        self.headers = headers
+        self.result = result
+
+
+# The content-types of responses whose body is json.
+JSON_CONTENT_TYPES = ('application/json', 'application/vnd.fluiddb.value+json')
+
+# Marks a LazyResult that hasn't been decoded yet.
+_UNDECODED = object()
+
+
+class LazyResult(object):
+    """
+    The result of a call made with decode=False. It holds the raw bytes of
+    the response body and only decodes them (from json, or to unicode for
+    other content-types) the first time the value is needed, so callers that
+    just check the status never pay for it. Indexing, iterating over,
+    comparing and testing the length of a LazyResult all act on its value.
+
+    raw = The body of the response as read from the network
+    content_type = The content-type of the response
+    encoding = The character set of a non-json response (utf-8 if None)
+    """
+
+    __slots__ = ('raw', 'content_type', 'encoding', '_value')
+
+    def __init__(self, raw, content_type=None, encoding=None):
+        self.raw = raw
+        self.content_type = content_type
+        self.encoding = encoding
+        self._value = _UNDECODED
+
+    @classmethod
+    def decoded(cls, value):
+        """
+        Returns a LazyResult for a value that has already been decoded.
+        """
+        result = cls(None)
+        result._value = value
+        return result
+
+    @property
+    def value(self):
+        value = self._value
+        if value is _UNDECODED:
+            if self.content_type in JSON_CONTENT_TYPES and self.raw:
+                value = json.loads(self.raw)
+            else:
+                value = unicode(self.raw, self.encoding or 'utf-8',
+                                'replace')
+            self._value = value
+        return value
+
+    def __getitem__(self, key):
+        return self.value[key]
+
+    def __iter__(self):
+        return iter(self.value)
+
+    def __len__(self):
+        return len(self.value)
+
+    def __contains__(self, item):
+        return item in self.value
+
+    def __nonzero__(self):
+        return bool(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyResult):
+            other = other.value
+        return self.value == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'LazyResult(%r)' % (self.value,)
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe collection of keep-alive sessions, one per Fluidinfo
+    instance, so that consecutive calls re-use open TCP/TLS connections
+    rather than performing a fresh handshake every time. This is the default
+    transport, sending requests with the requests library.
+
+    pool_size = The maximum number of connections kept open per host
+    idle_timeout = Seconds a host's session may go unused before it is closed
+        and replaced with a fresh one (None means never)
+    """
+
+    if requests is not None:
+        errors = (requests.exceptions.RequestException,)
+        retryable_errors = (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout)
+
+    def __init__(self, pool_size=POOL_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None, stream=False):
+        """
+        Sends a request over one of the connections to the URL's host and
+        returns the requests response object.
+        """
+        session = self.session(_base_url(url))
+        return session.request(method, url, data=body, headers=headers,
+                               stream=stream)
+
+    def session(self, base_url):
+        """
+        Returns the session to use for requests to the given instance,
+        creating it (or replacing a stale one) if required.
+        """
+        now = time.time()
+        stale = None
+        with self._lock:
+            entry = self._sessions.get(base_url)
+            if entry is not None:
+                session, last_used = entry
+                if (self.idle_timeout is not None and
+                    now - last_used > self.idle_timeout):
+                    stale = session
+                    entry = None
+            if entry is None:
+                session = self._create_session()
+            self._sessions[base_url] = (session, now)
+        if stale is not None:
+            stale.close()
+        return session
+
+    def close(self):
+        """
+        Closes all the open connections held by the pool.
+        """
+        with self._lock:
+            sessions = [session for session, _ in self._sessions.values()]
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+
+# The transport shared by all the module level functions. Assign a new
+# ConnectionPool to change the pool size or idle timeout (or any other
+# transport to send the requests some other way).
+connection_pool = ConnectionPool()
+
+
+def _base_url(url):
+    """
+    Returns the scheme and host part of the URL.
+    """
+    end = url.find('/', url.find('://') + 3)
+    if end == -1:
+        return url
+    return url[:end]
+
+
+class _Headers(dict):
+    """
+    A dictionary of HTTP headers whose names are case-insensitive (they're
+    stored in lower case).
+    """
+
+    def __init__(self, headers=()):
+        dict.__init__(self)
+        self.update(headers)
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __setitem__(self, name, value):
+        dict.__setitem__(self, name.lower(), value)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+    def update(self, headers):
+        if hasattr(headers, 'items'):
+            headers = headers.items()
+        for name, value in headers:
+            self[name] = value
+
+    def copy(self):
+        return _Headers(self)
+
+
+class TransportResponse(object):
+    """
+    A response returned by a transport that doesn't use requests. It has the
+    parts of a requests response that FluidinfoClient relies upon.
+
+    A gzip or deflate encoded body (as indicated by the content-encoding
+    header) is decompressed as it's read, and bytes_read counts the bytes of
+    the body read so far before decompression.
+
+    status_code = The HTTP status of the response
+    headers = A dictionary of the response headers
+    content = The body of the response
+    encoding = The character set of the body (taken from the content-type if
+        not given)
+    """
+
+    def __init__(self, status_code, headers, content, encoding=None):
+        self.status_code = status_code
+        self.headers = _Headers(headers)
+        self.bytes_read = 0
+        self._body = content
+        self._content = None
+        if encoding is None:
+            content_type = self.headers.get('content-type', '')
+            if 'charset=' in content_type:
+                encoding = content_type.split('charset=')[-1].strip()
+        self.encoding = encoding
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = ''.join(self.iter_content(CHUNK_SIZE))
+        return self._content
+
+    @property
+    def text(self):
+        return unicode(self.content, self.encoding or 'utf-8', 'replace')
+
+    def iter_content(self, chunk_size=1):
+        if self._content is not None:
+            for i in xrange(0, len(self._content), chunk_size):
+                yield self._content[i:i + chunk_size]
+            return
+        decompressor = None
+        content_encoding = self.headers.get('content-encoding')
+        if content_encoding in DECOMPRESSORS:
+            decompressor = _Decompressor(content_encoding)
+        body = self._body
+        for i in xrange(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.bytes_read += len(chunk)
+            if decompressor is not None:
+                chunk = decompressor.decompress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            if chunk:
+                yield chunk
+
+    def close(self):
+        pass
+
+
+def read_body(body):
+    """
+    Returns the body of a request, as prepared by FluidinfoClient, as a
+    string. Streamed bodies (file-like objects, buffers and iterators) are
+    read into memory so transports that can't stream requests may use this.
+    """
+    if body is None or isinstance(body, basestring):
+        return body
+    if hasattr(body, 'read'):
+        data = body.read()
+        if isinstance(data, memoryview):
+            return data.tobytes()
+        return str(data)
+    return ''.join(body)
+
+
+# The content-encodings of responses that are decompressed.
+DECOMPRESSORS = ('gzip', 'deflate')
+
+
+class _Decompressor(object):
+    """
+    Decompresses a gzip or deflate encoded body a chunk at a time.
+    """
+
+    def __init__(self, content_encoding):
+        self._raw_deflate = None
+        if content_encoding == 'gzip':
+            self._raw_deflate = False
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            # deflate should have a zlib header but some servers send bare
+            # deflate data, which we can only tell from the first chunk
+            self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data):
+        if self._raw_deflate is None and data:
+            self._raw_deflate = False
+            try:
+                return self._decompressor.decompress(data)
+            except zlib.error:
+                self._raw_deflate = True
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+def _bytes_read(response):
+    """
+    Returns the number of bytes of the response's body read from the network
+    so far (before decompression) or None if the transport doesn't say.
+    """
+    if isinstance(response, TransportResponse):
+        return response.bytes_read
+    try:
+        return response.raw.tell()
+    except AttributeError:
+        return None
+
+
+class Compression(object):
+    """
+    Compresses the JSON bodies of requests and counts the bytes saved by
+    compression in both directions. Responses are compressed whenever
+    Fluidinfo is willing (clients send an Accept-Encoding header asking for
+    gzip or deflate) but request bodies are only compressed if a threshold
+    is given, since not every server will accept them.
+
+    threshold = The size in bytes above which dictionaries and primitive
+        values sent as JSON are gzipped (None means never)
+    level = The zlib compression level (1 is fastest, 9 compresses most)
+    """
+
+    def __init__(self, threshold=None, level=6):
+        self.threshold = threshold
+        self.level = level
+        self.requests_compressed = 0
+        self.responses_compressed = 0
+        self.sent_saved = 0
+        self.received_saved = 0
+        self._lock = threading.Lock()
+
+    @property
+    def saved(self):
+        """
+        The total number of bytes saved by compression.
+        """
+        return self.sent_saved + self.received_saved
+
+    def compress(self, body):
+        """
+        Returns the body gzipped if it's big enough to be worth it and
+        compressing it makes it smaller, otherwise None.
+        """
+        if self.threshold is None or len(body) < self.threshold:
+            return None
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        compressed = compressor.compress(body) + compressor.flush()
+        if len(compressed) >= len(body):
+            return None
+        with self._lock:
+            self.requests_compressed += 1
+            self.sent_saved += len(body) - len(compressed)
+        return compressed
+
+    def record(self, response, size):
+        """
+        Counts the bytes saved by a compressed response whose decompressed
+        body (all of which has been read) is of the given size.
+        """
+        if response.headers.get('content-encoding') not in DECOMPRESSORS:
+            return
+        read = _bytes_read(response)
+        if read is None:
+            return
+        with self._lock:
+            self.responses_compressed += 1
+            self.received_saved += size - read
+
+
+# The Compression used by the module level functions. Assign one with a
+# threshold to have them compress request bodies too.
+compression = Compression()
+
+
+class CachedResponse(object):
+    """
+    A response held in a ResponseCache along with what's needed to work out
+    whether it's still fresh and to revalidate it with Fluidinfo.
+    """
+
+    __slots__ = ('key', 'headers', 'result', 'ttl', 'expires')
+
+    def __init__(self, key, headers, result, ttl):
+        self.key = key
+        self.headers = headers
+        self.result = result
+        self.ttl = ttl
+        self.expires = time.time() + ttl
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        """
+        Returns the headers needed to make a conditional request for the
+        resource (empty if Fluidinfo didn't supply an ETag or Last-Modified
+        header).
+        """
+        validators = {}
+        if self.headers.get('etag'):
+            validators['If-None-Match'] = self.headers['etag']
+        if self.headers.get('last-modified'):
+            validators['If-Modified-Since'] = self.headers['last-modified']
+        return validators
+
+    def response(self):
+        """
+        Returns the (headers, result) tuple. The headers are copied so they
+        can be changed safely but the result is shared by everyone reading
+        the cached response so must be left alone.
+        """
+        return self.headers.copy(), self.result
+
+
+class ResponseCache(object):
+    """
+    A thread-safe in-memory cache of the responses to GET and HEAD requests,
+    keyed by method, URL (including the query string) and Authorization
+    header, so a cache shared by clients (or used across login() calls)
+    never gives one user's responses to another. When it holds max_entries
+    responses the least recently used one is thrown away. Responses are
+    considered fresh for ttl seconds, after which they're revalidated with a
+    conditional request if Fluidinfo supplied an ETag or Last-Modified
+    header (or fetched again if not).
+
+    Any other request to a URL removes the responses cached for it. Since
+    the same tag value can be reached through both /about/... and
+    /objects/... paths, a request to a tag value path removes the cached
+    values of that tag on every object. Changes made some other way (for
+    example by another client) are only seen once the responses go stale.
+
+    max_entries = The maximum number of responses to hold
+    ttl = Seconds a response stays fresh, either a number or a function that
+        is called with the URL and response headers and returns a number
+    """
+
+    def __init__(self, max_entries=1000, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_path = {}
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, method, url, auth=None):
+        """
+        Returns the CachedResponse for the request (made with the given
+        Authorization header) or None.
+        """
+        key = (method, url, auth)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert to mark it as the most recently used
+                self._entries[key] = entry
+            return entry
+
+    def store(self, method, url, headers, result, auth=None):
+        """
+        Caches the response to the request (made with the given
+        Authorization header).
+        """
+        ttl = self.ttl
+        if callable(ttl):
+            ttl = ttl(url, headers)
+        key = (method, url, auth)
+        entry = CachedResponse(key, headers.copy(), result, ttl)
+        tag = _tag_of(url)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            self._keys_by_path.setdefault(_url_path(url), set()).add(key)
+            if tag is not None:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._forget(old_key)
+
+    def revalidate(self, entry):
+        """
+        Marks the cached response as fresh again.
+        """
+        entry.expires = time.time() + entry.ttl
+
+    def invalidate(self, url):
+        """
+        Removes all the responses cached for the URL, whatever their query
+        string or credentials, along with the cached values of the same tag
+        on other objects if it's a tag value. A change made through /values
+        could affect any object so invalidating it empties the cache.
+        """
+        path = _url_path(url)
+        tag = _tag_of(url)
+        with self._lock:
+            if path.endswith('/values'):
+                self._entries.clear()
+                self._keys_by_path.clear()
+                self._keys_by_tag.clear()
+                return
+            keys = set(self._keys_by_path.get(path, ()))
+            if tag is not None:
+                keys.update(self._keys_by_tag.get(tag, ()))
+            for key in keys:
+                self._entries.pop(key, None)
+                self._forget(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_path.clear()
+            self._keys_by_tag.clear()
+
+    def _forget(self, key):
+        url = key[1]
+        for index, name in ((self._keys_by_path, _url_path(url)),
+                            (self._keys_by_tag, _tag_of(url))):
+            keys = index.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[name]
+
+
+def _url_path(url):
+    """
+    Returns the URL without its query string.
+    """
+    return url.split('?', 1)[0]
+
+
+def _tag_of(url):
+    """
+    Returns a (host, tag) tuple if the URL is that of a tag value (through
+    either /about or /objects), otherwise None.
+    """
+    path = _url_path(url)
+    host = ''
+    if '://' in path:
+        host, _, path = path.split('://', 1)[1].partition('/')
+        path = '/' + path
+    elements = path.split('/')[1:]
+    if len(elements) < 4 or elements[0] not in ('about', 'objects'):
+        return None
+    return host, '/'.join(elements[2:])
+
+
+# Assign a ResponseCache to turn on caching for the module level functions.
+cache = None
+
+
+class SingleFlight(object):
+    """
+    Makes concurrent identical GET and HEAD requests share a single call to
+    Fluidinfo: while a request is in flight, any other thread making the
+    same request (same method, URL, credentials and cache validators) waits
+    for it and is given its response rather than sending its own.
+
+    calls and coalesced count, for each (method, URL), the requests sent to
+    Fluidinfo and those that were answered by a request already in flight.
+    """
+
+    def __init__(self):
+        self.calls = collections.defaultdict(int)
+        self.coalesced = collections.defaultdict(int)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """
+        Returns a (fn(*args), shared) tuple, where shared is True if the
+        result came from a call with the same key that was already under way.
+        key starts with the method and URL.
+        """
+        stats = key[:2]
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = Future()
+                self._in_flight[key] = future
+                self.calls[stats] += 1
+                leader = True
+            else:
+                self.coalesced[stats] += 1
+                leader = False
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except:
+            exc_info = sys.exc_info()
+            self._land(key)
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._land(key)
+        future.set_result(result)
+        return result, False
+
+    def _land(self, key):
+        with self._lock:
+            del self._in_flight[key]
+
+
+# Assign a SingleFlight to coalesce concurrent identical GET and HEAD
+# requests made by the module level functions.
+single_flight = None
+
+
+# The HTTP verbs that may safely be sent more than once.
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'PUT', 'DELETE'))
+
+# The response statuses worth retrying by default (all server errors).
+RETRY_STATUSES = frozenset(range(500, 600))
+
+
+class RetryPolicy(object):
+    """
+    Describes when and how failed requests are retried. Requests are retried
+    if they failed to connect (or timed out) or the response status is in
+    statuses. The time between attempts uses "decorrelated jitter" so that
+    clients retrying at the same time quickly spread out, and a 503 response's
+    Retry-After header is honoured (unless it asks for a longer wait than cap,
+    in which case the response is returned).
+
+    max_retries = The maximum number of times a request is retried
+    methods = The HTTP verbs that are retried (POST isn't idempotent so isn't
+        retried by default)
+    statuses = The response statuses that are retried
+    connection_errors = Whether to retry requests that failed to connect
+    base = The minimum number of seconds to wait before retrying
+    cap = The maximum number of seconds to wait before retrying
+    """
+
+    def __init__(self, max_retries=3, methods=IDEMPOTENT_METHODS,
+                 statuses=RETRY_STATUSES, connection_errors=True, base=0.1,
+                 cap=10.0):
+        self.max_retries = max_retries
+        self.methods = frozenset(method.upper() for method in methods)
+        self.statuses = frozenset(statuses)
+        self.connection_errors = connection_errors
+        self.base = base
+        self.cap = cap
+
+    def should_retry(self, method, attempt, status=None):
+        """
+        Returns True if a request that has been sent attempt times should be
+        sent again given the status of its response (None if it failed to
+        connect).
+        """
+        if attempt > self.max_retries or method.upper() not in self.methods:
+            return False
+        if status is None:
+            return self.connection_errors
+        return status in self.statuses
+
+    def backoff(self, previous=None, retry_after=None):
+        """
+        Returns the number of seconds to wait before the next attempt given
+        the previous wait (None for the first retry) and the number of
+        seconds asked for by a Retry-After header (if any).
+        """
+        if previous is None:
+            previous = self.base
+        delay = min(self.cap, random.uniform(self.base, previous * 3))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+
+def _retry_after(headers):
+    """
+    Returns the number of seconds given by a Retry-After header (which may be
+    a number of seconds or an HTTP date) or None.
+    """
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of making a request while a CircuitBreaker is open.
+    """
+
+    def __init__(self, breaker):
+        Exception.__init__(self, 'Circuit breaker is open')
+        self.breaker = breaker
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests being sent to an instance that appears to be unhealthy.
+    After failure_threshold consecutive failures (server errors or failures
+    to connect) the breaker opens and requests fail straight away with a
+    CircuitOpenError. Once reset_timeout seconds have passed a single trial
+    request is let through (the breaker is half-open): if it succeeds the
+    breaker closes again, otherwise it re-opens.
+
+    The state, failures, opened_at and rejected attributes may be read for
+    monitoring.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self._trial or time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_request(self):
+        """
+        Raises a CircuitOpenError if a request may not be made right now.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(self)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self._trial = False
+
+
+# The retry policy used by the module level functions.
+retry = None
+
+# Map Fluidinfo instances to a CircuitBreaker to use one for the module level
+# functions when calling that instance.
+circuit_breakers = {}
+
+
+# Responses telling the client to slow down.
+THROTTLE_STATUSES = frozenset([429, 503])
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket that paces the requests a client sends to an
+    instance, limiting the number of requests and/or the number of bytes
+    (sent and received) per second. A request that would go over the limit
+    waits until it wouldn't.
+
+    When Fluidinfo responds with a 429 or 503 status (or a Retry-After
+    header) the rates are halved, down to no less than min_fraction of the
+    configured ones, and then climb steadily back over recovery_time seconds.
+    A Retry-After header also holds up every request until it has passed.
+
+    rate = The number of requests per second (None for no limit)
+    byte_rate = The number of bytes per second (None for no limit)
+    burst = The number of seconds' worth of unused capacity that can be
+        saved up for a burst of requests
+    min_fraction = The lowest fraction of the rates that throttling cuts to
+    recovery_time = Seconds taken to get back to the full rates
+    """
+
+    def __init__(self, rate=None, byte_rate=None, burst=1.0, min_fraction=0.1,
+                 recovery_time=30.0):
+        self.max_rate = rate
+        self.max_byte_rate = byte_rate
+        self.burst = burst
+        self.min_fraction = min_fraction
+        self.recovery_time = recovery_time
+        self.scale = 1.0
+        self.throttles = 0
+        self._requests = self._capacity(rate)
+        self._bytes = self._capacity(byte_rate)
+        self._paused_until = 0
+        self._throttled_at = None
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        """
+        The number of requests per second currently allowed (or None).
+        """
+        if self.max_rate is None:
+            return None
+        return self.max_rate * self.scale
+
+    @property
+    def byte_rate(self):
+        """
+        The number of bytes per second currently allowed (or None).
+        """
+        if self.max_byte_rate is None:
+            return None
+        return self.max_byte_rate * self.scale
+
+    def acquire(self, size=0):
+        """
+        Waits until a request sending size bytes may be sent and returns the
+        number of seconds waited.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            wait = self._paused_until - now
+            if self.max_rate is not None:
+                self._requests -= 1
+                wait = max(wait, -self._requests / self.rate)
+            if self.max_byte_rate is not None and size:
+                self._bytes -= size
+                wait = max(wait, -self._bytes / self.byte_rate)
+        if wait <= 0:
+            return 0
+        time.sleep(wait)
+        return wait
+
+    def consume(self, size):
+        """
+        Counts bytes received against the byte rate (holding up the requests
+        that follow rather than the one that received them).
+        """
+        if self.max_byte_rate is None or not size:
+            return
+        with self._lock:
+            self._refill(time.time())
+            self._bytes -= size
+
+    def throttled(self, retry_after=None):
+        """
+        Slows down after Fluidinfo has asked the client to, pausing for
+        retry_after seconds if given.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            # a burst of throttled responses to requests sent at the same
+            # time only counts once
+            if (self._throttled_at is None or
+                now - self._throttled_at >= 1.0):
+                self._throttled_at = now
+                self.scale = max(self.min_fraction, self.scale / 2)
+                self.throttles += 1
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until,
+                                         now + retry_after)
+
+    def _capacity(self, rate):
+        if rate is None:
+            return 0
+        return max(1, rate * self.burst)
+
+    def _refill(self, now):
+        """
+        Adds the tokens earned since the last update. Must be called with
+        the lock held.
+        """
+        elapsed = now - self._updated
+        if elapsed <= 0:
+            return
+        self._updated = now
+        self.scale = min(1.0, self.scale + elapsed / self.recovery_time)
+        if self.max_rate is not None:
+            self._requests = min(self._capacity(self.max_rate),
+                                 self._requests + elapsed * self.rate)
+        if self.max_byte_rate is not None:
+            self._bytes = min(self._capacity(self.max_byte_rate),
+                              self._bytes + elapsed * self.byte_rate)
+
+
+# Map Fluidinfo instances to a RateLimiter to pace the module level functions'
+# requests to that instance.
+rate_limiters = {}
+
+
+class RequestEvent(object):
+    """
+    Describes a call made by a FluidinfoClient, passed to each of its hooks
+    once the call has finished.
+
+    method = The HTTP verb
+    path = The path template (see path_template) for grouping calls by
+        endpoint
+    url = The URL requested
+    status = The response status as an integer (None if the request failed)
+    bytes_sent = The size of the request body
+    bytes_received = The size of the response body
+    timings = Seconds spent in each phase of the call: 'encode' (building
+        the URL, headers and body), 'ttfb' (from sending the request to
+        receiving the response headers, including any time spent
+        connecting), 'transfer' (reading the response body), 'decode'
+        (turning the body into Python objects), 'backoff' (waiting to
+        retry failed requests) and 'queue' (waiting for the RateLimiter)
+    attempts = The number of times the request was sent
+    cached = True if the response came from the client's cache
+    coalesced = True if the response was shared with an identical request
+        that was already in flight (see SingleFlight)
+    error = The exception raised by the request, if any
+    """
+
+    __slots__ = ('method', 'path', 'url', 'status', 'bytes_sent',
+                 'bytes_received', 'timings', 'attempts', 'cached',
+                 'coalesced', 'error')
+
+    def __init__(self, method, path, url):
+        self.method = method
+        self.path = path
+        self.url = url
+        self.status = None
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.timings = {}
+        self.attempts = 0
+        self.cached = False
+        self.coalesced = False
+        self.error = None
+
+    @property
+    def duration(self):
+        """
+        The total number of seconds taken by the call.
+        """
+        return sum(self.timings.values())
+
+
+class CallCounter(object):
+    """
+    A hook that counts calls by (method, path template, status).
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.method, event.path, event.status)
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+# The upper bounds (in seconds) of the buckets used by LatencyHistogram.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class LatencyHistogram(object):
+    """
+    A hook that keeps a histogram of call durations for each
+    (method, path template). Each histogram is a list with a count for each
+    bucket in buckets plus a final count for calls that took longer.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = (event.method, event.path)
+        duration = event.duration
+        index = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) +
+                                                          1)
+            histogram[index] += 1
+            self.totals[key] = self.totals.get(key, 0.0) + duration
+
+    def percentile(self, method, path, percent):
+        """
+        Returns the upper bound of the bucket containing the given percentile
+        of the durations of calls to the endpoint (None if there haven't been
+        any or it's beyond the last bucket).
+        """
+        histogram = self.histograms.get((method, path))
+        if not histogram:
+            return None
+        wanted = sum(histogram) * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, histogram):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+
+def path_template(path):
+    """
+    Given a path that is either a string or list of path elements, will return
+    it with the about value or object id replaced by '*' so that calls to the
+    same endpoint can be grouped together. For example '/about/foo/test/bar'
+    becomes '/about/*/test/bar'.
+    """
+    if isinstance(path, Path):
+        return path.template
+    if isinstance(path, list):
+        elements = list(path)
+    else:
+        elements = path.split('/')[1:]
+    if len(elements) > 1 and elements[0] in ('about', 'objects'):
+        elements[1] = '*'
+    return '/' + '/'.join(elements)
+
+
+# The maximum number of quoted path elements and path templates remembered by
+# path().
+PATH_CACHE_SIZE = 10000
+
+
+class _LRUCache(object):
+    """
+    A thread-safe mapping holding at most size keys. When full it forgets a
+    key that hasn't been used recently, using the "clock" approximation of
+    least recently used so that looking keys up stays as cheap as reading a
+    dictionary.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = {}
+        self._clock = collections.deque()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        # mark it as recently used
+        entry[1] = True
+        return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self._items[key] = [value, True]
+                return
+            while len(self._items) >= self.size:
+                old_key = self._clock.popleft()
+                if self._items[old_key][1]:
+                    # used since the hand last passed so give it another go
+                    self._items[old_key][1] = False
+                    self._clock.append(old_key)
+                else:
+                    del self._items[old_key]
+            self._items[key] = [value, False]
+            self._clock.append(key)
+
+
+_quoted_elements = _LRUCache(PATH_CACHE_SIZE)
+_path_templates = _LRUCache(PATH_CACHE_SIZE)
+
+
+def _quote_element(element):
+    quoted = _quoted_elements.get(element)
+    if quoted is None:
+        quoted = urllib.quote(element, safe='')
+        _quoted_elements.set(element, quoted)
+    return quoted
+
+
+class Path(object):
+    """
+    A path whose URL encoding and classification have been worked out ahead
+    of time so that passing it to call() (or build_url()) repeatedly is
+    cheap. Create them with path() or a PathTemplate.
+
+    quoted = The percent-encoded path to append to the instance's URL
+    template = The path with the about value or object id replaced by '*'
+    is_tag_value = True if a PUT to the path sets a tag value
+    is_values = True if the path is for the /values endpoint
+    """
+
+    __slots__ = ('quoted', 'template', 'is_tag_value', 'is_values')
+
+    def __init__(self, quoted, template, is_tag_value, is_values):
+        self.quoted = quoted
+        self.template = template
+        self.is_tag_value = is_tag_value
+        self.is_values = is_values
+
+    def __repr__(self):
+        return '<fluidinfo.Path %s>' % self.quoted
+
+
+class PathTemplate(object):
+    """
+    A path in which '*' elements are placeholders for values (such as about
+    values or object ids) supplied when the template is called. Everything
+    about the path except the quoting of those values is worked out once,
+    when the template is created::
+
+        >>> rating = PathTemplate('about', '*', 'test', 'rating')
+        >>> fluidinfo.put(rating('an/example'), 5)
+    """
+
+    def __init__(self, *elements):
+        self.elements = elements
+        self._quoted = [element != '*' and urllib.quote(element, safe='')
+                        for element in elements]
+        self._placeholders = [i for i, element in enumerate(elements)
+                              if element == '*']
+        joined = '/' + '/'.join(elements)
+        self.template = path_template(list(elements))
+        # see FluidinfoClient.prepare
+        self.is_tag_value = (joined.startswith('/objects/') or
+                             joined.startswith('/about'))
+        self.is_values = joined.startswith('/values')
+
+    def __call__(self, *values):
+        if len(values) != len(self._placeholders):
+            raise TypeError('Expected %d values for %s' %
+                            (len(self._placeholders), self.template))
+        quoted = list(self._quoted)
+        for i, value in zip(self._placeholders, values):
+            quoted[i] = _quote_element(value)
+        return Path('/' + '/'.join(quoted), self.template, self.is_tag_value,
+                    self.is_values)
+
+
+def path(*elements):
+    """
+    Given the elements of a path (as would be passed as a list to call())
+    will return an equivalent Path. Templates and quoted elements are
+    remembered so repeatedly building similar paths is cheap::
+
+        >>> fluidinfo.put(fluidinfo.path('about', 'an/example', 'test',
+        ...                              'rating'), 5)
+    """
+    key = elements
+    values = ()
+    if len(elements) > 1 and elements[0] in ('about', 'objects'):
+        key = (elements[0], '*') + elements[2:]
+        values = (elements[1],)
+    template = _path_templates.get(key)
+    if template is None:
+        template = PathTemplate(*key)
+        _path_templates.set(key, template)
+    return template(*values)
+
+
+# Callables passed a RequestEvent after each call made by the module level
+# functions.
+hooks = []
+
+
+class FluidinfoClient(object):
+    """
+    A client for a single Fluidinfo instance. Each client owns its base URL,
+    credentials, headers and connection pool so several clients (for example
+    one per tenant) can be used concurrently from different threads without
+    stepping on each other's toes.
+
+    instance = The base URL of the Fluidinfo instance (e.g. MAIN or SANDBOX)
+    username, password = Optional credentials to log in with
+    pool = The ConnectionPool to use (a new one is created if not given)
+    transport = Sends the requests in place of a ConnectionPool (see below)
+    cache = An optional ResponseCache for GET and HEAD requests
+    single_flight = An optional SingleFlight for GET and HEAD requests
+    hooks = A list of callables that are passed a RequestEvent after each
+        call (see CallCounter and LatencyHistogram)
+    retry = An optional RetryPolicy for failed requests (or a dictionary
+        mapping HTTP verbs to policies)
+    breaker = An optional CircuitBreaker for the instance
+    limiter = An optional RateLimiter pacing the requests to the instance
+    resolver = An optional AboutResolver whose known ids are used in place
+        of about values in tag value paths
+    compression = The Compression that compresses request bodies and counts
+        the bytes saved (a new one that leaves requests alone is created if
+        not given)
+    workers = The WorkerPool that runs calls made with async=True (a new one
+        with a worker per pooled connection is created if not given)
+
+    Everything apart from actually sending a request (encoding, caching,
+    retries, hooks and so on) is done by the client so it works the same
+    whichever transport is used. A transport has a request(method, url, body,
+    headers, stream=False) method that returns a requests response (or a
+    TransportResponse), an errors attribute holding the exceptions it raises
+    when a request fails and a retryable_errors attribute holding those
+    worth retrying. ConnectionPool is the default transport;
+    fakefluidinfo.FakeTransport answers requests in memory and
+    gae_fluidinfo.UrlFetchTransport sends them with App Engine's urlfetch.
+    """
+
+    def __init__(self, instance=MAIN, username=None, password=None,
+                 pool=None, cache=None, hooks=None, retry=None, breaker=None,
+                 transport=None, workers=None, single_flight=None,
+                 limiter=None, resolver=None, compression=None):
+        self.instance = instance
+        self.headers = {
+            'Accept': '*/*',
+            'Accept-Encoding': 'gzip, deflate',
+        }
+        self._configure(pool, cache, hooks, retry, breaker, transport,
+                        workers, single_flight, limiter, resolver,
+                        compression)
+        if username is not None:
+            self.login(username, password)
+
+    def _configure(self, pool=None, cache=None, hooks=None, retry=None,
+                   breaker=None, transport=None, workers=None,
+                   single_flight=None, limiter=None, resolver=None,
+                   compression=None):
+        """
+        Sets everything call() uses apart from the instance and headers, so
+        that clients which provide those some other way (such as the one in
+        gae_fluidinfo) get the same defaults.
+        """
+        self.cache = cache
+        self.single_flight = single_flight
+        self.retry = retry
+        self.breaker = breaker
+        self.limiter = limiter
+        self.resolver = resolver
+        if compression is None:
+            compression = Compression()
+        self.compression = compression
+        if hooks is None:
+            hooks = []
+        self.hooks = hooks
+        if transport is None:
+            transport = pool
+        if transport is None:
+            transport = ConnectionPool()
+        self.transport = transport
+        if workers is None:
+            workers = WorkerPool(POOL_SIZE, MAX_PENDING)
+        self.workers = workers
+
+    @property
+    def pool(self):
+        """
+        The client's transport (usually a ConnectionPool).
+        """
+        return self.transport
+
+    def login(self, username, password):
+        """
+        Creates the 'Authorization' token from the given username and
+        password.
+        """
+        userpass = username + ':' + password
+        auth = 'Basic ' + userpass.encode('base64').strip()
+        self.headers['Authorization'] = auth
+
+    def logout(self):
+        """
+        Removes the 'Authorization' token from the headers passed into
+        Fluidinfo
+        """
+        if 'Authorization' in self.headers:
+            del self.headers['Authorization']
+
+    def get(self, path, body=None, mime=None, tags=[], custom_headers={},
+            **kw):
+        """
+        Convenience method for client.call('GET', ...)
+        """
+        return self.call('GET', path, body, mime, tags, custom_headers, **kw)
+
+    def post(self, path, body=None, mime=None, tags=[], custom_headers={},
+             **kw):
+        """
+        Convenience method for client.call('POST', ...)
+        """
+        return self.call('POST', path, body, mime, tags, custom_headers, **kw)
+
+    def put(self, path, body=None, mime=None, tags=[], custom_headers={},
+            **kw):
+        """
+        Convenience method for client.call('PUT', ...)
+        """
+        return self.call('PUT', path, body, mime, tags, custom_headers, **kw)
+
+    def delete(self, path, body=None, mime=None, tags=[], custom_headers={},
+               **kw):
+        """
+        Convenience method for client.call('DELETE', ...)
+        """
+        return self.call('DELETE', path, body, mime, tags, custom_headers,
+                         **kw)
+
+    def head(self, path, body=None, mime=None, tags=[], custom_headers={},
+             **kw):
+        """
+        Convenience method for client.call('HEAD', ...)
+        """
+        return self.call('HEAD', path, body, mime, tags, custom_headers, **kw)
+
+    def call(self, method, path, body=None, mime=None, tags=[],
+             custom_headers={}, decode=True, async=False, **kw):
+        """
+        Makes a call to Fluidinfo. See fluidinfo.call for a description of
+        the arguments.
+        """
+        if async:
+            return self.workers.submit(self.call, method, path, body, mime,
+                                       tags, custom_headers, decode, **kw)
+        started = time.time()
+        if self.resolver is not None:
+            path = self.resolver.rewrite(path)
+        url, body, headers = self.prepare(method, path, body, mime, tags,
+                                           custom_headers, kw)
+        method = method.upper()
+        event = None
+        if self.hooks:
+            event = RequestEvent(method, path_template(path), url)
+            event.timings['encode'] = time.time() - started
+            if isinstance(body, (basestring, _BufferReader)):
+                event.bytes_sent = len(body)
+        cache = self.cache
+        cached = None
+        if cache is not None and method in ('GET', 'HEAD'):
+            auth = headers.get('Authorization')
+            cached = cache.get(method, url, auth)
+            if cached is not None:
+                if cached.is_fresh():
+                    return self._cached_response(cached, event, decode)
+                validators = cached.validators()
+                if not validators:
+                    cached = None
+                else:
+                    headers = headers.copy()
+                    headers.update(validators)
+        flight = self.single_flight
+        shared = False
+        try:
+            if (flight is not None and body is None and
+                method in ('GET', 'HEAD')):
+                key = (method, url, headers.get('Authorization'),
+                       headers.get('If-None-Match'),
+                       headers.get('If-Modified-Since'))
+                (response, content), shared = flight.do(
+                    key, self._fetch, method, url, body, headers, event)
+            else:
+                response, content = self._fetch(method, url, body, headers,
+                                                event)
+        except:
+            if event is not None:
+                event.error = sys.exc_info()[1]
+                self._emit(event)
+            raise
+        transferred = time.time()
+        if cached is not None and response.status_code == 304:
+            # not modified so the cached copy is good for a while longer
+            cache.revalidate(cached)
+            return self._cached_response(cached, event, decode)
+        content_type = response.headers['content-type']
+        if not decode:
+            result = LazyResult(content, content_type, response.encoding)
+        elif content_type in JSON_CONTENT_TYPES and content:
+            result = json.loads(response.text)
+        else:
+            result = response.text
+        summary = response.headers
+        if shared:
+            # the response belongs to another call
+            summary = summary.copy()
+            if event is not None:
+                event.coalesced = True
+        summary['status'] = str(response.status_code)
+        if cache is not None:
+            if method not in ('GET', 'HEAD'):
+                cache.invalidate(url)
+            elif response.status_code == 200:
+                cache.store(method, url, summary, result, auth)
+        if event is not None:
+            event.status = response.status_code
+            event.bytes_received = len(content)
+            event.timings['decode'] = time.time() - transferred
+            self._emit(event)
+        return summary, result
+
+    def iter_values(self, query, tags, custom_headers={},
+                    chunk_size=CHUNK_SIZE):
+        """
+        Makes a GET request to /values but rather than reading the whole
+        response into memory yields an (object id, tag values) tuple for each
+        matching object as soon as it has been read from the network. The tag
+        values are a dictionary of the same form as in the response returned
+        by call(). Raises a FluidinfoError if the query fails.
+
+        query = The Fluidinfo query matching the objects
+        tags = The list of tags whose values are to be returned
+        chunk_size = The number of bytes read from the network at a time
+        """
+        response, event = self._send('GET', '/values', tags, custom_headers,
+                                     {'query': query})
+        try:
+            if response.status_code != 200:
+                headers = response.headers
+                headers['status'] = str(response.status_code)
+                raise FluidinfoError(headers, response.text)
+            chunks = self._counted(response, response.iter_content(chunk_size),
+                                   event)
+            for item in _iter_json_items(chunks, ['results', 'id']):
+                yield item
+            # read whatever follows the results (usually just the closing
+            # braces) so any bytes saved by compression are counted
+            for chunk in chunks:
+                pass
+        finally:
+            response.close()
+            if event is not None:
+                self._emit(event)
+
+    def values_table(self, query, tags, custom_headers={},
+                     chunk_size=CHUNK_SIZE):
+        """
+        Like iter_values() but returns all the matching objects' tag values
+        in a ValueTable, which takes far less memory than the decoded JSON
+        returned by call().
+        """
+        return ValueTable.from_items(self.iter_values(query, tags,
+                                                      custom_headers,
+                                                      chunk_size), tags)
+
+    def map_calls(self, calls, max_workers=POOL_SIZE):
+        """
+        Makes many independent calls in parallel and returns their results in
+        the same order. Each call is described by a (method, path) or
+        (method, path, kwargs) tuple where kwargs is a dictionary of the
+        other arguments to pass to call(). Each result is the
+        (headers, result) tuple returned by call() or, if the call raised an
+        exception, the exception.
+
+        calls = The calls to make
+        max_workers = The maximum number of calls made at the same time
+            (the client's pool should keep at least this many connections
+            open)
+        """
+        futures, workers = self._submit_calls(calls, max_workers)
+        try:
+            return [_outcome(future) for future in futures]
+        finally:
+            workers.shutdown()
+
+    def as_completed(self, calls, max_workers=POOL_SIZE):
+        """
+        Like map_calls() but yields an (index, result) tuple for each call
+        as soon as it finishes, where index is the call's position in calls.
+        """
+        finished = Queue.Queue()
+        futures, workers = self._submit_calls(
+            calls, max_workers, lambda index, future: finished.put((index,
+                                                                    future)))
+        try:
+            for i in xrange(len(futures)):
+                index, future = finished.get()
+                yield index, _outcome(future)
+        finally:
+            workers.shutdown()
+
+    def _submit_calls(self, calls, max_workers, callback=None):
+        workers = WorkerPool(max_workers)
+        futures = []
+        for index, spec in enumerate(calls):
+            method, path = spec[:2]
+            kwargs = {}
+            if len(spec) > 2:
+                kwargs = spec[2]
+            future = workers.submit(self.call, method, path, **kwargs)
+            if callback is not None:
+                future.add_done_callback(
+                    lambda future, index=index: callback(index, future))
+            futures.append(future)
+        return futures, workers
+
+    def _fetch(self, method, url, body, headers, event, stream=False):
+        """
+        Sends the request, retrying it as allowed by the client's RetryPolicy
+        and failing fast if its CircuitBreaker is open, and returns the
+        response along with its content. If stream is True the body is left
+        to be read by the caller and the content returned is None.
+        """
+        policy = self.retry
+        if isinstance(policy, dict):
+            policy = policy.get(method)
+        start = None
+        if body is not None and not isinstance(body, basestring):
+            # a streamed body can only be sent again if we can go back to
+            # the beginning
+            try:
+                start = body.tell()
+            except (AttributeError, IOError):
+                policy = None
+        breaker = self.breaker
+        limiter = self.limiter
+        compression = self.compression
+        transport = self.transport
+        attempt = 0
+        delay = None
+        while True:
+            attempt += 1
+            if event is not None:
+                event.attempts = attempt
+            if breaker is not None:
+                breaker.before_request()
+            retry_after = None
+            try:
+                if attempt > 1 and start is not None:
+                    body.seek(start)
+                if limiter is not None:
+                    self._pace(limiter, body, event)
+                sent = time.time()
+                response = transport.request(method, url, body, headers,
+                                             stream=True)
+                received = time.time()
+                content = None
+                if not stream:
+                    content = response.content
+            except transport.errors, e:
+                if breaker is not None:
+                    breaker.record_failure()
+                if (policy is None or
+                    not isinstance(e, transport.retryable_errors) or
+                    not policy.should_retry(method, attempt)):
+                    raise
+            except:
+                # anything else still has to end a half-open breaker's trial
+                if breaker is not None:
+                    breaker.record_failure()
+                raise
+            else:
+                status = response.status_code
+                if breaker is not None:
+                    if status >= 500:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                if limiter is not None:
+                    self._slow_down(limiter, response)
+                    if content is not None:
+                        limiter.consume(len(content))
+                if status == 503:
+                    retry_after = _retry_after(response.headers)
+                if (policy is None or
+                    not policy.should_retry(method, attempt, status) or
+                    (retry_after is not None and retry_after > policy.cap)):
+                    if event is not None:
+                        event.timings['ttfb'] = received - sent
+                        if not stream:
+                            event.timings['transfer'] = (time.time() -
+                                                         received)
+                    if compression is not None and not stream:
+                        compression.record(response, len(content))
+                    return response, content
+                if stream:
+                    response.close()
+            delay = policy.backoff(delay, retry_after)
+            if event is not None:
+                event.timings['backoff'] = (event.timings.get('backoff', 0) +
+                                            delay)
+            time.sleep(delay)
+
+    def _pace(self, limiter, body, event):
+        """
+        Waits for the RateLimiter to allow the request to be sent.
+        """
+        size = 0
+        if isinstance(body, (basestring, _BufferReader)):
+            size = len(body)
+        waited = limiter.acquire(size)
+        if event is not None:
+            event.timings['queue'] = event.timings.get('queue', 0) + waited
+
+    def _slow_down(self, limiter, response):
+        """
+        Tells the RateLimiter if Fluidinfo asked for requests to slow down.
+        """
+        retry_after = _retry_after(response.headers)
+        if (response.status_code in THROTTLE_STATUSES or
+            retry_after is not None):
+            limiter.throttled(retry_after)
+
+    def _counted(self, response, chunks, event=None):
+        """
+        Yields the chunks of a streamed response body and then records the
+        bytes saved if it was compressed, the bytes read with the client's
+        RateLimiter and the size of the body and time taken to read it in
+        the RequestEvent.
+        """
+        started = time.time()
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+        if self.compression is not None:
+            self.compression.record(response, size)
+        if self.limiter is not None:
+            self.limiter.consume(size)
+        if event is not None:
+            event.bytes_received = size
+            event.timings['transfer'] = time.time() - started
+
+    def _cached_response(self, cached, event, decode=True):
+        headers, result = cached.response()
+        if isinstance(result, LazyResult):
+            if decode:
+                result = result.value
+        elif not decode:
+            result = LazyResult.decoded(result)
+        if event is not None:
+            event.status = int(headers['status'])
+            event.cached = True
+            self._emit(event)
+        return headers, result
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    def download(self, path, out=None, custom_headers={},
+                 chunk_size=CHUNK_SIZE, **kw):
+        """
+        GETs the resource (usually an opaque tag value) without decoding the
+        response to unicode. If out is given the response body is written
+        straight to it, a chunk at a time, as it arrives and the number of
+        bytes written is returned in place of the result. Otherwise the raw
+        bytes are returned. Raises a FluidinfoError if the request fails.
+
+        path = The path to GET (as given to call())
+        out = A file-like object (or a bytearray) to write the body to
+        chunk_size = The number of bytes read from the network at a time
+        **kw = Query-string arguments to be appended to the URL
+        """
+        response, event = self._send('GET', path, [], custom_headers, kw)
+        try:
+            headers = response.headers
+            headers['status'] = str(response.status_code)
+            if response.status_code != 200:
+                raise FluidinfoError(headers, response.text)
+            chunks = self._counted(response, response.iter_content(chunk_size),
+                                   event)
+            if out is None:
+                return headers, ''.join(chunks)
+            written = 0
+            if isinstance(out, bytearray):
+                write = out.extend
+            else:
+                write = out.write
+            for chunk in chunks:
+                write(chunk)
+                written += len(chunk)
+            return headers, written
+        finally:
+            response.close()
+            if event is not None:
+                self._emit(event)
+
+    def _send(self, method, path, tags, custom_headers, kw):
+        """
+        Encodes a request without a body as described in fluidinfo.call and
+        sends it, with the same retries, circuit breaker and rate limiting as
+        call(), without reading the response body. Returns the transport's
+        response object and the RequestEvent (None if the client has no
+        hooks) to be passed to the hooks once the body has been read.
+        """
+        started = time.time()
+        if self.resolver is not None:
+            path = self.resolver.rewrite(path)
+        url, body, headers = self.prepare(method, path, None, None, tags,
+                                           custom_headers, kw)
+        event = None
+        if self.hooks:
+            event = RequestEvent(method, path_template(path), url)
+            event.timings['encode'] = time.time() - started
+        try:
+            response, content = self._fetch(method, url, body, headers,
+                                            event, stream=True)
+        except:
+            if event is not None:
+                event.error = sys.exc_info()[1]
+                self._emit(event)
+            raise
+        if event is not None:
+            event.status = response.status_code
+        return response, event
+
+    def prepare(self, method, path, body=None, mime=None, tags=[],
+                custom_headers={}, kw={}):
+        """
+        Works out the URL, body and headers of a request as described in
+        fluidinfo.call and returns them as a tuple, ready to be handed to a
+        transport. The query-string arguments are given as the kw dictionary.
+        """
+        # build the URL and work out what sort of path it is
+        if isinstance(path, Path):
+            url = self.instance + path.quoted
+            is_values = path.is_values
+            is_tag_value = path.is_tag_value
+        else:
+            url = self.build_url(path)
+            # make sure the path is a string for the checks
+            if isinstance(path, list):
+                path = '/'+'/'.join(path)
+            is_values = path.startswith('/values')
+            is_tag_value = (path.startswith('/objects/') or
+                            path.startswith('/about'))
+        if kw:
+            url = url + '?' + urllib.urlencode(kw)
+        if tags and is_values:
+            # /values based requests must have a tags list to append to the
+            # url args (which are passed in as **kw), so append them so
+            # everything gets urlencoded correctly below
+            url = url + '&' + urllib.urlencode([('tag', tag) for tag in tags])
+        # set the headers (the client's own headers are only copied if
+        # something needs to be added to them)
+        headers = self.headers
+        if custom_headers:
+            headers = headers.copy()
+            headers.update(custom_headers)
+        # Make sure the correct content-type header is sent
+        content_type = None
+        if isinstance(body, BUFFER_TYPES):
+            # large opaque values held in memory are sent in slices rather
+            # than being copied
+            body = _BufferReader(body)
+        if isinstance(body, EncodedValue):
+            # already worked out
+            content_type = body.content_type
+            body = body.data
+        elif isinstance(body, dict):
+            # jsonify dicts
+            content_type = 'application/json'
+            body = json_dumps(body)
+        elif method.upper() == 'PUT' and is_tag_value:
+            # A PUT to an "/objects/" or "/about/" resource means that we're
+            # handling tag-values. Make sure we handle primitive/opaque value
+            # types properly.
+            if mime:
+                # opaque value (just set the mime type)
+                content_type = mime
+            elif isprimitive(body):
+                # primitive values need to be json-ified and have the correct
+                # content-type set
+                content_type = PRIMITIVE_CONTENT_TYPE
+                body = json_dumps(body)
+            else:
+                # No way to work out what content-type to send to Fluidinfo
+                # so bail out.
+                raise TypeError("You must supply a mime-type")
+        compressed = None
+        if (content_type in JSON_CONTENT_TYPES and isinstance(body, str) and
+            self.compression is not None):
+            compressed = self.compression.compress(body)
+        if content_type:
+            if headers is self.headers:
+                headers = headers.copy()
+            headers['content-type'] = content_type
+            if compressed is not None:
+                headers['content-encoding'] = 'gzip'
+                body = compressed
+        return url, body, headers
+
+    def build_url(self, path):
+        """
+        Given a path that is either a string or list of path elements, will
+        return the correct URL for this client's instance
+        """
+        url = self.instance
+        if isinstance(path, Path):
+            url += path.quoted
+        elif isinstance(path, list):
+            url += '/'
+            url += '/'.join([urllib.quote(element, safe='')
+                             for element in path])
+        else:
+            url += urllib.quote(path)
+        return url
+
+
+class _ModuleClient(FluidinfoClient):
+    """
+    The client used by the module level functions. Rather than owning its
+    settings it reads the module's instance, global_headers and
+    connection_pool variables every time so that code assigning to them keeps
+    working.
+    """
+
+    def __init__(self):
+        pass
+
+    @property
+    def instance(self):
+        return instance
+
+    @property
+    def headers(self):
+        return global_headers
+
+    @property
+    def transport(self):
+        return connection_pool
+
+    @property
+    def cache(self):
+        return cache
+
+    @property
+    def hooks(self):
+        return hooks
+
+    @property
+    def retry(self):
+        return retry
+
+    @property
+    def breaker(self):
+        return circuit_breakers.get(instance)
+
+    @property
+    def workers(self):
+        return worker_pool
+
+    @property
+    def single_flight(self):
+        return single_flight
+
+    @property
+    def limiter(self):
+        return rate_limiters.get(instance)
+
+    @property
+    def resolver(self):
+        return resolver
+
+    @property
+    def compression(self):
+        return compression
+
+
+# The client that the module level functions below delegate to.
+default_client = _ModuleClient()
+
+
+class TimeoutError(Exception):
+    """
+    Raised when waiting on a Future takes longer than the given timeout.
+    """
+    pass
+
+
+class Future(object):
+    """
+    The eventual outcome of a call that is running in the background. Use
+    result() to wait for the (headers, result) tuple that call() would have
+    returned (or to have the exception it raised re-raised).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._finished = False
+        self._callbacks = []
+
+    def done(self):
+        """
+        Returns True if the call has finished (successfully or not).
+        """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for the call to finish
+        and returns its result, re-raising any exception it raised.
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError('The call did not finish in time')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Waits like result() but returns the exception raised by the call (or
+        None if it was successful) rather than raising it.
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError('The call did not finish in time')
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, fn):
+        """
+        Arranges for fn(future) to be called when the call finishes (straight
+        away if it already has).
+        """
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """
+        Records the failure of the call. exc_info is the tuple returned by
+        sys.exc_info() so the original traceback is kept.
+        """
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        # callbacks are run before waiters are woken up so they've always
+        # happened by the time result() returns
+        try:
+            for fn in callbacks:
+                fn(self)
+        finally:
+            self._event.set()
+
+
+class WorkerPool(object):
+    """
+    A fixed size pool of daemon threads that run functions in the background
+    and report their outcome through a Future. The threads are only started
+    when the first function is submitted.
+
+    max_workers = The maximum number of functions that run at the same time
+    max_pending = The maximum number of functions waiting for a worker before
+        submit() blocks until there's room (no limit if None)
+    """
+
+    def __init__(self, max_workers=POOL_SIZE, max_pending=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(max_pending or 0)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kw):
+        """
+        Schedules fn(*args, **kw) to run on one of the pool's threads and
+        returns a Future for its result.
+        """
+        future = Future()
+        self._queue.put((future, fn, args, kw))
+        if len(self._threads) < self.max_workers:
+            with self._lock:
+                if len(self._threads) < self.max_workers:
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+        return future
+
+    def shutdown(self):
+        """
+        Stops the pool's threads once they've run everything submitted so
+        far.
+        """
+        with self._lock:
+            for thread in self._threads:
+                self._queue.put(None)
+            self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            future, fn, args, kw = job
+            try:
+                future.set_result(fn(*args, **kw))
+            except:
+                future.set_exception(sys.exc_info())
+
+
+# The worker threads shared by calls made with async=True by the module level
+# functions. There's one per connection in the default ConnectionPool.
+worker_pool = WorkerPool(POOL_SIZE, MAX_PENDING)
+
+
+class AsyncClient(object):
+    """
+    Wraps a FluidinfoClient so that calls don't block. Each method takes the
+    same arguments as its FluidinfoClient counterpart (and so encodes bodies,
+    mime-types and primitive values in exactly the same way) but immediately
+    returns a Future for the (headers, result) tuple. At most max_concurrency
+    requests are in flight at once, the rest wait their turn.
+
+    client = The FluidinfoClient to use (defaults to the module level one)
+    max_concurrency = The maximum number of simultaneous requests
+    """
+
+    def __init__(self, client=None, max_concurrency=POOL_SIZE):
+        if client is None:
+            client = default_client
+        self.client = client
+        self.workers = WorkerPool(max_concurrency)
+
+    def get(self, path, body=None, mime=None, tags=[], custom_headers={},
+            **kw):
+        """
+        Convenience method for async_client.call('GET', ...)
+        """
+        return self.call('GET', path, body, mime, tags, custom_headers, **kw)
+
+    def post(self, path, body=None, mime=None, tags=[], custom_headers={},
+             **kw):
+        """
+        Convenience method for async_client.call('POST', ...)
+        """
+        return self.call('POST', path, body, mime, tags, custom_headers, **kw)
+
+    def put(self, path, body=None, mime=None, tags=[], custom_headers={},
+            **kw):
+        """
+        Convenience method for async_client.call('PUT', ...)
+        """
+        return self.call('PUT', path, body, mime, tags, custom_headers, **kw)
+
+    def delete(self, path, body=None, mime=None, tags=[], custom_headers={},
+               **kw):
+        """
+        Convenience method for async_client.call('DELETE', ...)
+        """
+        return self.call('DELETE', path, body, mime, tags, custom_headers,
+                         **kw)
+
+    def head(self, path, body=None, mime=None, tags=[], custom_headers={},
+             **kw):
+        """
+        Convenience method for async_client.call('HEAD', ...)
+        """
+        return self.call('HEAD', path, body, mime, tags, custom_headers, **kw)
+
+    def call(self, method, path, body=None, mime=None, tags=[],
+             custom_headers={}, **kw):
+        """
+        Makes a call to Fluidinfo in the background and returns a Future for
+        its (headers, result) tuple.
+        """
+        return self.workers.submit(self.client.call, method, path, body, mime,
+                                   tags, custom_headers, **kw)
+
+
+class BatchWriter(object):
+    """
+    Collects tag values in memory and writes them to Fluidinfo in bulk with
+    PUT requests to /values (one request per batch rather than one per tag
+    value). Opaque values (those with a mime-type) can't be sent that way so
+    they're written with individual PUT requests when the batch is flushed.
+
+    A batch is flushed when it holds batch_size tag values or when its oldest
+    value has been waiting for max_delay seconds (None turns the timer off).
+    If max_pending values are waiting because a flush is already in progress
+    then set() blocks until there's room again.
+
+    Responses that aren't successful are stored in the failures list as
+    (headers, result) tuples (or the exc_info tuple if the request raised an
+    exception) since flushes may happen in the background.
+
+    A writer that's dropped without being closed is kept alive by its
+    background timer until anything queued has been written, after which
+    the timer only holds a weak reference to it so the thread stops once
+    the writer is garbage collected.
+
+    client = The FluidinfoClient to use (defaults to the module level one)
+    """
+
+    def __init__(self, client=None, batch_size=100, max_delay=1.0,
+                 max_pending=1000):
+        if client is None:
+            client = default_client
+        self.client = client
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_pending = max(max_pending, batch_size)
+        self.failures = []
+        self._queries = {}
+        self._order = []
+        self._opaque = []
+        self._pending = 0
+        self._oldest = None
+        self._flushing = False
+        self._closed = False
+        self._timer = None
+        self._condition = threading.Condition()
+
+    def set(self, about, tag, value, mime=None):
+        """
+        Queues the value of tag to be set on the object with the given about
+        value.
+        """
+        self._add(_about_query(about), ['about', about], tag, value, mime)
+
+    def set_by_id(self, object_id, tag, value, mime=None):
+        """
+        Queues the value of tag to be set on the object with the given id.
+        """
+        self._add('fluiddb/id = "%s"' % object_id, ['objects', object_id],
+                  tag, value, mime)
+
+    def flush(self):
+        """
+        Writes everything queued so far to Fluidinfo, waiting for any flush
+        that's already under way to finish first.
+        """
+        with self._condition:
+            while self._flushing:
+                self._condition.wait()
+            batch = self._take()
+        self._write(batch)
+
+    def close(self):
+        """
+        Flushes anything still queued and stops the background timer.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.flush()
+        timer = self._timer
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _add(self, query, path, tag, value, mime):
+        if isinstance(value, EncodedValue):
+            if value.content_type == PRIMITIVE_CONTENT_TYPE:
+                # no need to check it again
+                value = value.value
+            else:
+                # it'll be sent as it is with an individual PUT
+                mime = True
+        elif not mime and not isprimitive(value):
+            # No way to work out what content-type to send to Fluidinfo so
+            # bail out (just like call() would).
+            raise TypeError("You must supply a mime-type")
+        batch = None
+        with self._condition:
+            if self._closed:
+                raise ValueError('The BatchWriter has been closed')
+            # back-pressure: wait for the flush in progress to make room
+            while self._pending >= self.max_pending and self._flushing:
+                self._condition.wait()
+            if mime:
+                if mime is True:
+                    mime = None
+                self._opaque.append((path + tag.split('/'), value, mime))
+            else:
+                if query not in self._queries:
+                    self._queries[query] = {}
+                    self._order.append(query)
+                self._queries[query][tag] = {'value': value}
+            self._pending += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._start_timer()
+            if self._pending >= self.batch_size and not self._flushing:
+                batch = self._take()
+        if batch is not None:
+            self._write(batch)
+
+    def _take(self):
+        """
+        Removes and returns everything queued. Must be called with the
+        condition held.
+        """
+        batch = ([[query, self._queries[query]] for query in self._order],
+                 self._opaque)
+        self._queries = {}
+        self._order = []
+        self._opaque = []
+        self._pending = 0
+        self._oldest = None
+        self._flushing = True
+        return batch
+
+    def _write(self, batch):
+        queries, opaque = batch
+        try:
+            for i in range(0, len(queries), self.batch_size):
+                self._record(self.client.put,
+                             '/values',
+                             {'queries': queries[i:i + self.batch_size]})
+            for path, value, mime in opaque:
+                self._record(self.client.put, path, value, mime)
+        finally:
+            with self._condition:
+                self._flushing = False
+                self._condition.notify_all()
+
+    def _record(self, fn, *args):
+        try:
+            # only the status is needed unless the write failed
+            headers, result = fn(*args, decode=False)
+        except:
+            self.failures.append(sys.exc_info())
+        else:
+            if not headers['status'].startswith('2'):
+                self.failures.append((headers, result))
+
+    def _start_timer(self):
+        if (self.max_delay is None or
+            (self._timer is not None and self._timer.is_alive())):
+            return
+        self._timer = threading.Thread(target=_run_batch_timer,
+                                       args=(weakref.ref(self),
+                                             self._condition, [self]))
+        self._timer.daemon = True
+        self._timer.start()
+
+
+def _run_batch_timer(ref, condition, holder):
+    """
+    Flushes the BatchWriter once its oldest value has waited long enough,
+    until it's closed or garbage collected. Only a weak reference to the
+    writer is held while nothing is queued.
+    """
+    # the writer is handed over in a list (rather than as an argument the
+    # thread would hang on to) so that it's only kept alive while values are
+    # queued
+    writer = holder.pop()
+    while True:
+        if writer is None:
+            writer = ref()
+            if writer is None:
+                return
+        with condition:
+            if writer._closed:
+                return
+            batch = None
+            if writer._oldest is None or writer._flushing:
+                wait = writer.max_delay
+            else:
+                wait = writer._oldest + writer.max_delay - time.time()
+                if wait <= 0:
+                    batch = writer._take()
+            if batch is None:
+                if writer._oldest is None:
+                    # nothing is queued so the writer may be collected
+                    writer = None
+                condition.wait(wait)
+                continue
+        writer._write(batch)
+
+
+def _about_query(about):
+    """
+    Returns the query matching the object with the given about value.
+    """
+    return 'fluiddb/about = %s' % _query_string(about)
+
+
+def _query_string(value):
+    """
+    Returns the string quoted for use in a query.
+    """
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+# The number of bytes a WriteAheadQueue segment may grow to before a new one
+# is started.
+SEGMENT_SIZE = 16 * 1024 * 1024
+
+
+class WriteAheadQueue(object):
+    """
+    Takes tag values as fast as they can be appended to a log on disk and
+    writes them to Fluidinfo in the background, so that a slow (or
+    unavailable) Fluidinfo doesn't hold up the code producing them.
+
+    The log is a directory of append-only segment files holding one json
+    record per line. Drain workers read the records back in order, write
+    them to Fluidinfo in batches (bulk PUT requests to /values, or individual
+    PUTs for opaque values) and record how far they've got in a checkpoint
+    file. Failed requests (connection errors, timeouts and 5xx responses) are
+    retried until they succeed so nothing is lost; responses with any other
+    error status can't succeed by being retried so they're stored in the
+    failures list as (headers, result, records) tuples and skipped (records
+    is the record of an opaque value or the list of records sent to /values).
+    Any other exception is stored the same way as a (None, exception,
+    records) tuple so that one bad record can't hold up the rest. Everything
+    not yet checkpointed is written again when the queue is next opened, so
+    values survive the process being restarted.
+
+    With more than one drain worker batches may be written out of order, so
+    if a tag's value is set more than once an older value could win.
+
+    directory = Where the segments and checkpoint are kept
+    client = The FluidinfoClient to use (defaults to the module level one)
+    batch_size = The maximum number of values written by each request
+    drain_workers = The number of batches written at the same time
+    segment_size = The size (in bytes) at which a new segment is started
+    sync = If True each value is fsync'd to disk before set() returns (rather
+        than only surviving the process exiting)
+    retry = The RetryPolicy whose backoff() spaces out the attempts to write
+        a batch
+    """
+
+    def __init__(self, directory, client=None, batch_size=100,
+                 drain_workers=1, segment_size=SEGMENT_SIZE, sync=False,
+                 retry=None):
+        if client is None:
+            client = default_client
+        if retry is None:
+            retry = RetryPolicy()
+        self.directory = directory
+        self.client = client
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.sync = sync
+        self.retry = retry
+        self.failures = []
+        self._condition = threading.Condition()
+        self._checkpoint_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._closed = False
+        self._idle = False
+        self._in_flight = 0
+        self._next_batch = 0
+        self._next_ack = 0
+        self._acknowledged = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith('.log') and name[:-4].isdigit())
+        self._checkpoint = self._read_checkpoint()
+        # always start a new segment in case the last one ends with a
+        # partly written record
+        self._segment = max(self._segments + [self._checkpoint[0]]) + 1
+        self._segments.append(self._segment)
+        self._log = open(self._segment_path(self._segment), 'ab')
+        self._size = 0
+        self._workers = WorkerPool(drain_workers, drain_workers)
+        self._reader = threading.Thread(target=self._drain)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def set(self, about, tag, value, mime=None):
+        """
+        Queues the value of tag to be set on the object with the given about
+        value.
+        """
+        self._append(_about_query(about), ['about', about], tag, value, mime)
+
+    def set_by_id(self, object_id, tag, value, mime=None):
+        """
+        Queues the value of tag to be set on the object with the given id.
+        """
+        self._append('fluiddb/id = "%s"' % object_id, ['objects', object_id],
+                     tag, value, mime)
+
+    def flush(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for everything queued
+        so far to be written to Fluidinfo. Returns True if it was.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._condition:
+            while not (self._idle and self._in_flight == 0):
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            return True
+
+    def close(self, drain=True, timeout=None):
+        """
+        Stops the drain workers, first waiting up to timeout seconds for the
+        queue to be written to Fluidinfo if drain is True. Anything left is
+        written when the queue is next opened.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+        if drain:
+            self.flush(timeout)
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._reader.join()
+        self._workers.shutdown()
+        with self._condition:
+            self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _append(self, query, path, tag, value, mime):
+        if isinstance(value, EncodedValue):
+            if value.content_type == PRIMITIVE_CONTENT_TYPE:
+                value = value.value
+            else:
+                mime = value.content_type
+                value = value.data
+        if mime:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            record = {'path': path + tag.split('/'), 'mime': mime,
+                      'data': base64.b64encode(value)}
+        elif isprimitive(value):
+            record = {'query': query, 'tag': tag, 'value': value}
+        else:
+            # No way to work out what content-type to send to Fluidinfo so
+            # bail out (just like call() would).
+            raise TypeError("You must supply a mime-type")
+        line = json_dumps(record) + '\n'
+        with self._condition:
+            if self._closed:
+                raise ValueError('The WriteAheadQueue has been closed')
+            self._log.write(line)
+            self._log.flush()
+            if self.sync:
+                os.fsync(self._log.fileno())
+            self._size += len(line)
+            if self._size >= self.segment_size:
+                self._log.close()
+                self._segment += 1
+                self._segments.append(self._segment)
+                self._log = open(self._segment_path(self._segment), 'ab')
+                self._size = 0
+            self._idle = False
+            self._condition.notify_all()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, '%016d.log' % segment)
+
+    def _read_checkpoint(self):
+        """
+        Returns the (segment, offset) position of the first record that
+        hasn't been written to Fluidinfo.
+        """
+        try:
+            checkpoint = open(os.path.join(self.directory, 'checkpoint'))
+        except IOError:
+            return (0, 0)
+        try:
+            segment, offset = checkpoint.read().split()
+            return (int(segment), int(offset))
+        finally:
+            checkpoint.close()
+
+    def _write_checkpoint(self, position):
+        path = os.path.join(self.directory, 'checkpoint')
+        checkpoint = open(path + '.tmp', 'w')
+        try:
+            checkpoint.write('%d %d\n' % position)
+            checkpoint.flush()
+            if self.sync:
+                os.fsync(checkpoint.fileno())
+        finally:
+            checkpoint.close()
+        os.rename(path + '.tmp', path)
+
+    def _drain(self):
+        """
+        Reads batches of records from the log and hands them to the drain
+        workers, waiting for more to be appended when it catches up.
+        """
+        segment, offset = self._checkpoint
+        with self._condition:
+            later = [s for s in self._segments if s >= segment]
+        if segment not in later:
+            segment, offset = later[0], 0
+        reader = open(self._segment_path(segment), 'rb')
+        reader.seek(offset)
+        batch = []
+        finished = False
+        try:
+            while not self._stopped.is_set():
+                start = reader.tell()
+                line = reader.readline()
+                if line.endswith('\n'):
+                    batch.append(line)
+                    if len(batch) < self.batch_size:
+                        continue
+                else:
+                    reader.seek(start)
+                if batch:
+                    self._dispatch(batch, (segment, reader.tell()))
+                    batch = []
+                    continue
+                with self._condition:
+                    if segment != self._segment:
+                        if not finished:
+                            # read to the end once more now that nothing
+                            # else can be appended
+                            finished = True
+                            continue
+                        # anything left over was only partly written before
+                        # a crash
+                        reader.close()
+                        segment = self._segments[
+                            self._segments.index(segment) + 1]
+                        reader = open(self._segment_path(segment), 'rb')
+                        finished = False
+                        continue
+                    if start < self._size:
+                        continue
+                    self._idle = True
+                    self._condition.notify_all()
+                    while (not self._stopped.is_set() and
+                           segment == self._segment and
+                           start >= self._size):
+                        self._condition.wait()
+                    self._idle = False
+        finally:
+            reader.close()
+
+    def _dispatch(self, batch, position):
+        with self._condition:
+            number = self._next_batch
+            self._next_batch += 1
+            self._in_flight += 1
+        self._workers.submit(self._acknowledge, number, position, batch)
+
+    def _acknowledge(self, number, position, batch):
+        """
+        Writes the batch and then moves the checkpoint past every batch
+        that's been written in full.
+        """
+        written = False
+        try:
+            written = self._write(batch)
+        finally:
+            self._checkpoint_batch(number, position, written)
+
+    def _checkpoint_batch(self, number, position, written):
+        with self._checkpoint_lock:
+            if written:
+                self._acknowledged[number] = position
+            else:
+                # stopped before it could be written
+                self._acknowledged[number] = None
+            checkpoint = None
+            while self._next_ack in self._acknowledged:
+                position = self._acknowledged.pop(self._next_ack)
+                if position is None:
+                    break
+                self._next_ack += 1
+                checkpoint = position
+            if checkpoint is not None:
+                self._write_checkpoint(checkpoint)
+                with self._condition:
+                    finished = [s for s in self._segments
+                                if s < checkpoint[0]]
+                    self._segments = self._segments[len(finished):]
+                for segment in finished:
+                    os.remove(self._segment_path(segment))
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _write(self, batch):
+        """
+        Writes a batch of records to Fluidinfo, retrying until it's done.
+        Returns False if the queue was closed first.
+        """
+        queries = {}
+        order = []
+        values = []
+        writes = []
+        for line in batch:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                self.failures.append((None, None, line))
+                continue
+            if 'query' in record:
+                query = record['query']
+                if query not in queries:
+                    queries[query] = {}
+                    order.append(query)
+                queries[query][record['tag']] = {'value': record['value']}
+                values.append(record)
+            else:
+                # json gives back unicode path elements, which urllib.quote
+                # can't handle if they aren't ASCII
+                path = [element.encode('utf-8') for element in record['path']]
+                writes.append((path, base64.b64decode(record['data']),
+                               record['mime'], record))
+        if order:
+            body = {'queries': [[query, queries[query]] for query in order]}
+            writes.insert(0, ('/values', body, None, values))
+        for path, body, mime, record in writes:
+            if not self._put(path, body, mime, record):
+                return False
+        return True
+
+    def _put(self, path, body, mime, record):
+        retryable = (self.client.transport.retryable_errors +
+                     (CircuitOpenError,))
+        delay = None
+        while not self._stopped.is_set():
+            retry_after = None
+            try:
+                headers, result = self.client.put(path, body, mime,
+                                                  decode=False)
+            except retryable:
+                pass
+            except Exception, e:
+                self.failures.append((None, e, record))
+                return True
+            else:
+                status = int(headers['status'])
+                if status < 300:
+                    return True
+                if status < 500:
+                    self.failures.append((headers, result, record))
+                    return True
+                retry_after = _retry_after(headers)
+            delay = self.retry.backoff(delay, retry_after)
+            self._stopped.wait(delay)
+        return False
+
+
+class Mirror(object):
+    """
+    A local read-replica of the values of some tags, kept in a SQLite
+    database indexed by object id and about value, so that reading one of
+    them doesn't need a round trip to Fluidinfo.
+
+    refresh() reads the values with a streamed /values query and updates the
+    database in place (values that have gone are removed), so readers carry
+    on being answered while it runs. Opaque values aren't returned by
+    /values so aren't mirrored.
+
+    The mirror has the same get() and call() methods as a FluidinfoClient. A
+    GET of a mirrored tag's value on an object held by the mirror is answered
+    from the database and everything else is passed on to the client. PUTs
+    and DELETEs of mirrored tag values made through the mirror also update
+    the database; other changes are only seen after the next refresh.
+
+    tags = The tags to mirror
+    query = The query matching the objects to mirror (defaults to all the
+        objects with any of the tags)
+    client = The FluidinfoClient to use (defaults to the module level one)
+    database = The SQLite database file (by default it's held in memory and
+        so filled from scratch by the first refresh)
+    refresh_interval = Seconds between refreshes made in the background (None
+        means refresh() is only called by hand)
+    """
+
+    def __init__(self, tags, query=None, client=None, database=':memory:',
+                 refresh_interval=None):
+        if sqlite3 is None:
+            raise RuntimeError('Mirror needs sqlite3')
+        if client is None:
+            client = default_client
+        if query is None:
+            query = ' or '.join('has %s' % tag for tag in tags)
+        self.tags = list(tags)
+        self.query = query
+        self.client = client
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._stopped = threading.Event()
+        self._db = sqlite3.connect(database, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS objects (
+                id TEXT PRIMARY KEY, about TEXT);
+            CREATE INDEX IF NOT EXISTS objects_about ON objects (about);
+            CREATE TABLE IF NOT EXISTS tag_values (
+                id TEXT, tag TEXT, value TEXT, generation INTEGER,
+                PRIMARY KEY (id, tag));
+            """)
+        self._generation = self._db.execute(
+            'SELECT MAX(generation) FROM tag_values').fetchone()[0] or 0
+        self._refresher = None
+        if refresh_interval is not None:
+            self._refresher = threading.Thread(target=self._refresh_every,
+                                               args=(refresh_interval,))
+            self._refresher.daemon = True
+            self._refresher.start()
+
+    def refresh(self):
+        """
+        Brings the mirror up to date and returns the number of values it
+        holds. Only one refresh runs at a time.
+        """
+        with self._refreshing:
+            return self._refresh()
+
+    def _refresh(self):
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        objects = []
+        values = []
+        count = 0
+        items = self.client.iter_values(self.query,
+                                        self.tags + ['fluiddb/about'])
+        for object_id, tags in items:
+            about = tags.get('fluiddb/about', {}).get('value')
+            objects.append((object_id, about))
+            for tag in self.tags:
+                if tag in tags and 'value' in tags[tag]:
+                    values.append((object_id, tag,
+                                   json_dumps(tags[tag]['value']),
+                                   generation))
+            if len(values) >= 1000:
+                count += self._store(objects, values)
+                objects, values = [], []
+        count += self._store(objects, values)
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'DELETE FROM tag_values WHERE tag = ? AND '
+                    'generation < ?',
+                    [(tag, generation) for tag in self.tags])
+        return count
+
+    def value(self, tag, about=None, object_id=None):
+        """
+        Returns a (found, value) tuple for the mirrored value of the tag on
+        the object with the given about value or id.
+        """
+        if object_id is not None:
+            sql = 'SELECT value FROM tag_values WHERE id = ? AND tag = ?'
+            key = object_id
+        else:
+            sql = ('SELECT value FROM objects JOIN tag_values ON '
+                   'objects.id = tag_values.id WHERE about = ? AND tag = ?')
+            key = about
+        with self._lock:
+            row = self._db.execute(sql, (_unicode(key),
+                                         _unicode(tag))).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def get(self, path, body=None, mime=None, tags=[], custom_headers={},
+            **kw):
+        """
+        Convenience method for mirror.call('GET', ...)
+        """
+        return self.call('GET', path, body, mime, tags, custom_headers, **kw)
+
+    def call(self, method, path, body=None, mime=None, tags=[],
+             custom_headers={}, **kw):
+        """
+        Answers a GET of a mirrored tag value locally, passing everything
+        else on to the client's call().
+        """
+        if kw.pop('async', False):
+            # run in the background so the mirror is updated before the
+            # future's result is ready
+            return self.client.workers.submit(self.call, method, path, body,
+                                              mime, tags, custom_headers,
+                                              **kw)
+        method = method.upper()
+        target = _tag_value_path(path)
+        if target is not None and target[2] in self.tags:
+            kind, key, tag = target
+            if method == 'GET' and not (tags or custom_headers or kw):
+                if kind == 'about':
+                    found, value = self.value(tag, about=key)
+                else:
+                    found, value = self.value(tag, object_id=key)
+                if found:
+                    self.hits += 1
+                    headers = _Headers({'status': '200',
+                                        'content-type':
+                                            PRIMITIVE_CONTENT_TYPE})
+                    return headers, value
+                self.misses += 1
+            elif method in ('PUT', 'DELETE'):
+                headers, result = self.client.call(method, path, body, mime,
+                                                   tags, custom_headers, **kw)
+                if headers['status'].startswith('2'):
+                    self._written(method, kind, key, tag, body, mime)
+                return headers, result
+        return self.client.call(method, path, body, mime, tags,
+                                custom_headers, **kw)
+
+    def close(self):
+        """
+        Stops refreshing the mirror and closes its database.
+        """
+        self._stopped.set()
+        if self._refresher is not None:
+            self._refresher.join()
+        with self._lock:
+            self._db.close()
+
+    def _store(self, objects, values):
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO objects VALUES (?, ?)', objects)
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO tag_values VALUES (?, ?, ?, ?)',
+                    values)
+        return len(values)
+
+    def _written(self, method, kind, key, tag, body, mime):
+        """
+        Keeps the mirror up to date with a successful write made through it.
+        """
+        key = _unicode(key)
+        tag = _unicode(tag)
+        with self._lock:
+            if kind == 'about':
+                row = self._db.execute('SELECT id FROM objects WHERE '
+                                       'about = ?', (key,)).fetchone()
+                if row is None:
+                    # not an object we know about yet
+                    return
+                key = row[0]
+            with self._db:
+                if method == 'PUT' and not mime and isprimitive(body):
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO tag_values VALUES '
+                        '(?, ?, ?, ?)',
+                        (key, tag, json_dumps(body), self._generation))
+                else:
+                    # deleted (or replaced with an opaque value)
+                    self._db.execute('DELETE FROM tag_values WHERE id = ? '
+                                     'AND tag = ?', (key, tag))
+
+    def _refresh_every(self, interval):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                # try again next time
+                pass
+            self._stopped.wait(interval)
+
+
+def _tag_value_path(path):
+    """
+    Returns an ('about' or 'objects', about value or object id, tag) tuple if
+    the path is that of a tag value, otherwise None.
+    """
+    if isinstance(path, Path):
+        elements = [urllib.unquote(element)
+                    for element in path.quoted.split('/')[1:]]
+    elif isinstance(path, list):
+        elements = path
+    else:
+        elements = path.split('/')[1:]
+    if len(elements) < 4 or elements[0] not in ('about', 'objects'):
+        return None
+    return elements[0], elements[1], '/'.join(elements[2:])
+
+
+class AboutResolver(object):
+    """
+    Works out the ids of the objects with given about values and remembers
+    them (an object's id never changes) so the lookup only happens once.
+    Ids are kept in memory, forgetting the least recently used once there
+    are max_entries of them, and also in a SQLite database file if one is
+    given so they're remembered for good.
+
+    Giving a resolver to a FluidinfoClient makes call() send requests for
+    /about/... tag value paths to the equivalent /objects/... path when the
+    object's id is already known.
+
+    client = The FluidinfoClient to use (defaults to the module level one)
+    max_entries = The number of ids held in memory
+    database = An optional SQLite database file to keep the ids in
+    chunk_size = The most about values looked up by each /values query
+    """
+
+    def __init__(self, client=None, max_entries=PATH_CACHE_SIZE,
+                 database=None, chunk_size=100):
+        if client is None:
+            client = default_client
+        self.client = client
+        self.chunk_size = chunk_size
+        self._ids = _LRUCache(max_entries)
+        self._db = None
+        self._db_lock = threading.Lock()
+        if database is not None:
+            if sqlite3 is None:
+                raise RuntimeError('AboutResolver needs sqlite3 to use a '
+                                   'database')
+            self._db = sqlite3.connect(database, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS abouts ('
+                             'about TEXT PRIMARY KEY, id TEXT)')
+
+    def cached(self, about):
+        """
+        Returns the id of the object with the about value if it's already
+        known, otherwise None.
+        """
+        about = _unicode(about)
+        object_id = self._ids.get(about)
+        if object_id is None and self._db is not None:
+            with self._db_lock:
+                row = self._db.execute('SELECT id FROM abouts WHERE '
+                                       'about = ?', (about,)).fetchone()
+            if row is not None:
+                object_id = row[0]
+                self._ids.set(about, object_id)
+        return object_id
+
+    def resolve(self, about, create=True):
+        """
+        Returns the id of the object with the about value, creating the
+        object if it doesn't exist and create is True (otherwise returning
+        None).
+        """
+        return self.resolve_many([about], create).get(_unicode(about))
+
+    def resolve_many(self, abouts, create=True):
+        """
+        Returns a dictionary mapping each about value to the id of its
+        object. Those that aren't already known are looked up with /values
+        queries of chunk_size about values at a time, and any objects that
+        don't exist are created in parallel if create is True (otherwise
+        they're left out of the result). Raises a FluidinfoError if a lookup
+        fails.
+        """
+        ids = {}
+        missing = []
+        for about in abouts:
+            about = _unicode(about)
+            if about in ids:
+                continue
+            object_id = self.cached(about)
+            ids[about] = object_id
+            if object_id is None:
+                missing.append(about)
+        for i in range(0, len(missing), self.chunk_size):
+            chunk = missing[i:i + self.chunk_size]
+            query = u'fluiddb/about in (%s)' % u', '.join(
+                _query_string(about) for about in chunk)
+            # urlencode can only cope with non-ASCII characters in a str
+            query = query.encode('utf-8')
+            for object_id, tags in self.client.iter_values(query,
+                                                           ['fluiddb/about']):
+                about = tags['fluiddb/about']['value']
+                ids[about] = object_id
+                self.remember(about, object_id)
+        missing = [about for about in missing if ids[about] is None]
+        if create and missing:
+            calls = [('POST', '/objects', {'body': {'about': about}})
+                     for about in missing]
+            for about, outcome in zip(missing, self.client.map_calls(calls)):
+                if isinstance(outcome, Exception):
+                    raise outcome
+                headers, result = outcome
+                if not headers['status'].startswith('2'):
+                    raise FluidinfoError(headers, result)
+                ids[about] = result['id']
+                self.remember(about, result['id'])
+        return dict((about, object_id) for about, object_id in ids.items()
+                    if object_id is not None)
+
+    def remember(self, about, object_id):
+        """
+        Records the id of the object with the about value.
+        """
+        about = _unicode(about)
+        self._ids.set(about, object_id)
+        if self._db is not None:
+            with self._db_lock:
+                with self._db:
+                    self._db.execute('INSERT OR REPLACE INTO abouts VALUES '
+                                     '(?, ?)', (about, object_id))
+
+    def rewrite(self, path):
+        """
+        Returns the /objects/... equivalent of an /about/... tag value path
+        if the object's id is known, otherwise the path itself.
+        """
+        target = _tag_value_path(path)
+        if target is None or target[0] != 'about':
+            return path
+        object_id = self.cached(target[1])
+        if object_id is None:
+            return path
+        return ['objects', object_id] + target[2].split('/')
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+
+
+def _unicode(value):
+    """
+    Returns the string as unicode (decoding it from UTF-8 if need be).
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+# Assign an AboutResolver to have the module level functions use the ids of
+# objects whose about values it has resolved.
+resolver = None
+
+
+class Provisioner(object):
+    """
+    Makes sure a tree of namespaces and tags exists, with the given
+    descriptions and permissions, creating only what's missing so it's safe
+    to run again and again (for example, whenever an application starts).
+
+    The tree is a dictionary mapping the paths of namespaces to their
+    specifications. Any missing namespaces on the way to one of them are
+    created too (with no description), but the top level namespace (the one
+    belonging to a user) must already exist. A namespace specification is a
+    dictionary that may contain:
+
+        'description' = The namespace's description
+        'permissions' = A dictionary mapping actions (e.g. 'create') to
+            permissions such as {'policy': 'closed', 'exceptions': ['me']}
+        'namespaces' = A dictionary mapping the names of child namespaces
+            to their specifications
+        'tags' = A dictionary mapping the names of tags to their
+            specifications
+
+    A tag specification may contain a 'description', whether the tag is
+    'indexed', its 'permissions' (for the 'update', 'delete' and 'control'
+    actions) and its 'value_permissions' (for the 'read', 'create' and
+    other actions on the tag's values).
+
+    plan() reads what already exists, one request per existing namespace
+    with all those at the same depth read at the same time, and returns the
+    calls needed to bring the server in line with the tree as a list of
+    levels. apply() makes the calls of each level in parallel, only moving
+    on to the next level (whose namespaces and tags live inside those just
+    created) once they've all succeeded.
+
+    tree = The namespaces and tags to provision
+    client = The FluidinfoClient to use (defaults to the module level one)
+    update = Also read the descriptions and permissions of existing tags
+        and the permissions of existing namespaces and correct any that
+        differ (which costs a request each, so it's off by default)
+    max_workers = The most calls made at the same time
+    """
+
+    def __init__(self, tree, client=None, update=False,
+                 max_workers=POOL_SIZE):
+        if client is None:
+            client = default_client
+        self.tree = tree
+        self.client = client
+        self.update = update
+        self.max_workers = max_workers
+
+    def plan(self):
+        """
+        Returns a list of levels, each a list of (method, path, kwargs)
+        calls (as taken by FluidinfoClient.map_calls) that may be made in
+        parallel once those of the previous levels have been made. An empty
+        list means there's nothing to do. Raises a FluidinfoError if a read
+        fails, or a ValueError if a top level namespace would need to be
+        created.
+        """
+        levels = collections.defaultdict(list)
+        checks = []
+        parents = set()
+        pending = [(path, spec, 0)
+                   for path, spec in sorted(_rooted(self.tree).items())]
+        while pending:
+            calls = [('GET', '/namespaces/' + path,
+                      {'returnDescription': True, 'returnNamespaces': True,
+                       'returnTags': True}) for path, spec, depth in pending]
+            outcomes = self.client.map_calls(calls, self.max_workers)
+            reading = pending
+            pending = []
+            for (path, spec, depth), outcome in zip(reading, outcomes):
+                headers, result = _checked(outcome, ('404',))
+                if headers['status'] == '404':
+                    self._create_namespace(levels, path, spec, depth)
+                    if depth == 0:
+                        # make sure there's somewhere to create it
+                        parents.add(path.rsplit('/', 1)[0])
+                    continue
+                if ('description' in spec and
+                    result.get('description') != spec['description']):
+                    levels[0].append(('PUT', '/namespaces/' + path,
+                                      {'body': {'description':
+                                                spec['description']}}))
+                if self.update:
+                    checks.extend(_permission_checks(
+                        'namespaces', path, spec.get('permissions', {})))
+                children = set(result.get('namespaceNames', []))
+                for name, child in sorted(spec.get('namespaces',
+                                                   {}).items()):
+                    child_path = path + '/' + name
+                    if name in children:
+                        pending.append((child_path, child, depth + 1))
+                    else:
+                        self._create_namespace(levels, child_path, child,
+                                               depth + 1)
+                tags = set(result.get('tagNames', []))
+                for name, tag in sorted(spec.get('tags', {}).items()):
+                    if name not in tags:
+                        self._create_tag(levels, path, name, tag, depth + 1)
+                    elif self.update:
+                        checks.extend(_tag_checks(path + '/' + name, tag))
+        if parents:
+            parents = sorted(parents)
+            outcomes = self.client.map_calls([('GET', '/namespaces/' + parent)
+                                              for parent in parents],
+                                             self.max_workers)
+            for parent, outcome in zip(parents, outcomes):
+                headers, result = _checked(outcome, ('404',))
+                if headers['status'] == '404':
+                    raise ValueError("The top level namespace %r doesn't "
+                                     "exist and can't be created" % parent)
+        if checks:
+            outcomes = self.client.map_calls([read for read, wanted, fix in
+                                              checks], self.max_workers)
+            for (read, wanted, fix), outcome in zip(checks, outcomes):
+                headers, result = _checked(outcome)
+                if not wanted(result):
+                    levels[0].append(fix)
+        return [levels[depth] for depth in sorted(levels)]
+
+    def apply(self, plan=None):
+        """
+        Makes the calls in the plan (working one out with plan() if none is
+        given) level by level and returns the number of calls made. A
+        namespace or tag that turns out to exist already (because something
+        else created it in the meantime) isn't treated as a failure. Raises
+        a FluidinfoError for the first call of a level that fails, without
+        going on to the next level.
+        """
+        if plan is None:
+            plan = self.plan()
+        made = 0
+        for level in plan:
+            outcomes = self.client.map_calls(level, self.max_workers)
+            made += len(level)
+            for (method, path, kwargs), outcome in zip(level, outcomes):
+                if method == 'POST':
+                    _checked(outcome, ('412',))
+                else:
+                    _checked(outcome)
+        return made
+
+    def describe(self, plan):
+        """
+        Returns a list of lines describing the calls in the plan, suitable
+        for showing someone before it's applied.
+        """
+        lines = []
+        for depth, level in enumerate(plan):
+            for method, path, kwargs in level:
+                line = '%d %s %s' % (depth, method, path)
+                if 'action' in kwargs:
+                    line += '?action=' + kwargs['action']
+                if 'body' in kwargs:
+                    line += ' ' + json.dumps(kwargs['body'], sort_keys=True)
+                lines.append(line)
+        return lines
+
+    def _create_namespace(self, levels, path, spec, depth):
+        if '/' not in path:
+            raise ValueError("The top level namespace %r doesn't exist and "
+                             "can't be created" % path)
+        parent, name = path.rsplit('/', 1)
+        levels[depth].append(('POST', '/namespaces/' + parent,
+                              {'body': {'name': name,
+                                        'description':
+                                        spec.get('description', '')}}))
+        for action, permission in sorted(spec.get('permissions',
+                                                  {}).items()):
+            levels[depth + 1].append(_set_permission('namespaces', path,
+                                                     action, permission))
+        for name, child in sorted(spec.get('namespaces', {}).items()):
+            self._create_namespace(levels, path + '/' + name, child,
+                                   depth + 1)
+        for name, tag in sorted(spec.get('tags', {}).items()):
+            self._create_tag(levels, path, name, tag, depth + 1)
+
+    def _create_tag(self, levels, namespace, name, spec, depth):
+        path = namespace + '/' + name
+        levels[depth].append(('POST', '/tags/' + namespace,
+                              {'body': {'name': name,
+                                        'description':
+                                        spec.get('description', ''),
+                                        'indexed':
+                                        spec.get('indexed', False)}}))
+        for kind, key in (('tags', 'permissions'),
+                          ('tag-values', 'value_permissions')):
+            for action, permission in sorted(spec.get(key, {}).items()):
+                levels[depth + 1].append(_set_permission(kind, path, action,
+                                                         permission))
+
+
+def _rooted(tree):
+    """
+    Returns a copy of a Provisioner's tree in which the paths given are at
+    most two levels deep, with anything deeper moved into the
+    specifications of the namespaces on the way to it. Planning then reads
+    (and creates if need be) each of those namespaces in turn, parent first.
+    """
+    rooted = {}
+    for path, spec in sorted(tree.items()):
+        elements = path.strip('/').split('/')
+        root = '/'.join(elements[:2])
+        if len(elements) <= 2:
+            if root in rooted:
+                raise ValueError('The namespace %r is given more than once' %
+                                 root)
+            rooted[root] = spec
+            continue
+        parent = rooted[root] = dict(rooted.get(root, {}))
+        for name in elements[2:]:
+            namespaces = parent['namespaces'] = dict(parent.get('namespaces',
+                                                                {}))
+            parent = namespaces[name] = dict(namespaces.get(name, {}))
+        if parent:
+            raise ValueError('The namespace %r is given more than once' %
+                             '/'.join(elements))
+        parent.update(spec)
+    return rooted
+
+
+def _checked(outcome, allowed=()):
+    """
+    Returns the (headers, result) of a map_calls() outcome, raising the
+    exception or a FluidinfoError if it failed with a status other than one
+    of those allowed.
+    """
+    if isinstance(outcome, Exception):
+        raise outcome
+    headers, result = outcome
+    if not (headers['status'].startswith('2') or
+            headers['status'] in allowed):
+        raise FluidinfoError(headers, result)
+    return headers, result
+
+
+def _set_permission(kind, path, action, permission):
+    return ('PUT', '/permissions/%s/%s' % (kind, path),
+            {'body': permission, 'action': action})
+
+
+def _same_permission(permission):
+    """
+    Returns a function saying whether a permission read from Fluidinfo is
+    the same as the one given (in whatever order the exceptions are).
+    """
+    wanted = (permission.get('policy'),
+              sorted(permission.get('exceptions', [])))
+    return lambda result: (result.get('policy'),
+                           sorted(result.get('exceptions', []))) == wanted
+
+
+def _permission_checks(kind, path, permissions):
+    """
+    Returns a (read, wanted, fix) tuple for each of the permissions, where
+    read is the call that reads it, wanted says whether the result is right
+    and fix is the call that puts it right.
+    """
+    return [(('GET', '/permissions/%s/%s' % (kind, path),
+              {'action': action}), _same_permission(permission),
+             _set_permission(kind, path, action, permission))
+            for action, permission in sorted(permissions.items())]
+
+
+def _tag_checks(path, spec):
+    checks = []
+    if 'description' in spec:
+        description = spec['description']
+        checks.append((('GET', '/tags/' + path, {'returnDescription': True}),
+                       lambda result: result.get('description') ==
+                       description,
+                       ('PUT', '/tags/' + path,
+                        {'body': {'description': description}})))
+    checks.extend(_permission_checks('tags', path,
+                                     spec.get('permissions', {})))
+    checks.extend(_permission_checks('tag-values', path,
+                                     spec.get('value_permissions', {})))
+    return checks
+
+
 def login(username, password):
     """
     Creates the 'Authorization' token from the given username and password.
     """
-    userpass = username + ':' + password
-    auth = 'Basic ' + userpass.encode('base64').strip()
-    global_headers['Authorization'] = auth
+    default_client.login(username, password)
 
 
 def logout():
     """
     Removes the 'Authorization' token from the headers passed into Fluidinfo
     """
-    if 'Authorization' in global_headers:
-        del global_headers['Authorization']
+    default_client.logout()
 
 
 def get(path, body=None, mime=None, tags=[], custom_headers={}, **kw):
@@ -87,7 +3504,8 @@ def head(path, body=None, mime=None, tags=[], custom_headers={}, **kw):
     return call('HEAD', path, body, mime, tags, custom_headers, **kw)
 
 
-def call(method, path, body=None, mime=None, tags=[], custom_headers={}, **kw):
+def call(method, path, body=None, mime=None, tags=[], custom_headers={},
+         decode=True, async=False, **kw):
     """
     Makes a call to Fluidinfo
 
@@ -95,63 +3513,438 @@ def call(method, path, body=None, mime=None, tags=[], custom_headers={}, **kw):
     path = Path appended to the instance to locate the resource in Fluidinfo
         this can be either a string OR a list of path elements.
     body = The request body (a dictionary will be translated to json,
-        primitive types will also be jsonified)
+        primitive types will also be jsonified). Large opaque values may be
+        given as a file-like object, an iterator of chunks (sent with chunked
+        transfer encoding) or a memoryview, mmap or bytearray (sent without
+        being copied)
     mime = The mime-type for the body of the request - will override the
         jsonification of primitive types
     tags = The list of tags to return if the request is to values
     headers = A dictionary containing additional headers to send in the request
+    decode = If False the result is returned as a LazyResult that only
+        decodes the response body when its value is first used
+    async = If True the call is made in the background by the shared
+        worker_pool and a Future for the (headers, result) tuple is returned
+        straight away (see wait_all and wait_any)
     **kw = Query-string arguments to be appended to the URL
     """
-    # build the URL
-    url = build_url(path)
-    if kw:
-        url = url + '?' + urllib.urlencode(kw)
-    if tags and path.startswith('/values'):
-        # /values based requests must have a tags list to append to the
-        # url args (which are passed in as **kw), so append them so everything
-        # gets urlencoded correctly below
-        url = url + '&' + urllib.urlencode([('tag', tag) for tag in tags])
-    # set the headers
-    headers = global_headers.copy()
-    if custom_headers:
-        headers.update(custom_headers)
-    # make sure the path is a string for the following elif check for PUT
-    # based requests
-    if isinstance(path, list):
-        path = '/'+'/'.join(path)
-    # Make sure the correct content-type header is sent
-    if isinstance(body, dict):
-        # jsonify dicts
-        headers['content-type'] = 'application/json'
-        body = json.dumps(body)
-    elif method.upper() == 'PUT' and (
-        path.startswith('/objects/') or path.startswith('/about')):
-        # A PUT to an "/objects/" or "/about/" resource means that we're
-        # handling tag-values. Make sure we handle primitive/opaque value types
-        # properly.
-        if mime:
-            # opaque value (just set the mime type)
-            headers['content-type'] = mime
-        elif isprimitive(body):
-            # primitive values need to be json-ified and have the correct
-            # content-type set
-            headers['content-type'] = 'application/vnd.fluiddb.value+json'
-            body = json.dumps(body)
+    return default_client.call(method, path, body, mime, tags, custom_headers,
+                               decode, async, **kw)
+
+
+def result(future, timeout=None):
+    """
+    Waits for a call made with async=True to finish and returns its
+    (headers, result) tuple, re-raising any exception it raised.
+    """
+    return future.result(timeout)
+
+
+def wait_all(futures, timeout=None):
+    """
+    Waits up to timeout seconds (forever if None) for all the calls to finish
+    and returns their results in the same order. Each result is the
+    (headers, result) tuple or, if the call raised an exception, the
+    exception. Raises a TimeoutError if they don't all finish in time.
+    """
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    for future in futures:
+        if deadline is not None:
+            timeout = max(0, deadline - time.time())
+        future.exception(timeout)
+    return [_outcome(future) for future in futures]
+
+
+def wait_any(futures, timeout=None):
+    """
+    Waits up to timeout seconds (forever if None) for any of the calls to
+    finish and returns the first Future that does. Raises a TimeoutError if
+    none of them finish in time.
+    """
+    if not futures:
+        raise ValueError('No futures to wait for')
+    finished = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    try:
+        return finished.get(True, timeout)
+    except Queue.Empty:
+        raise TimeoutError('None of the calls finished in time')
+
+
+def map_calls(calls, max_workers=POOL_SIZE):
+    """
+    Makes many independent calls in parallel and returns their results in
+    order. See FluidinfoClient.map_calls.
+    """
+    return default_client.map_calls(calls, max_workers)
+
+
+def as_completed(calls, max_workers=POOL_SIZE):
+    """
+    Makes many independent calls in parallel and yields an (index, result)
+    tuple for each as it finishes. See FluidinfoClient.as_completed.
+    """
+    return default_client.as_completed(calls, max_workers)
+
+
+def _outcome(future):
+    """
+    Returns the result of a finished call or the exception it raised.
+    """
+    error = future.exception()
+    if error is not None:
+        return error
+    return future.result()
+
+
+# Matches the whitespace allowed between JSON tokens.
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class _JSONStream(object):
+    """
+    Reads JSON tokens and values from an iterator of chunks of a document,
+    only holding on to the part of the document that hasn't been read yet.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    def next_char(self):
+        """
+        Skips any whitespace then consumes and returns the next character.
+        """
+        while True:
+            match = _JSON_WHITESPACE.match(self.buffer, self.position)
+            self.position = match.end()
+            if self.position < len(self.buffer):
+                self.position += 1
+                return self.buffer[self.position - 1]
+            if not self._read_more():
+                raise ValueError('Unexpected end of JSON document')
+
+    def peek_char(self):
+        """
+        Returns the next character without consuming it.
+        """
+        char = self.next_char()
+        self.position -= 1
+        return char
+
+    def value(self):
+        """
+        Decodes, consumes and returns the next complete JSON value.
+        """
+        self.peek_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer,
+                                                     self.position)
+            except ValueError:
+                if not self._read_more():
+                    raise
+                continue
+            if (end == len(self.buffer) and
+                self.buffer[end - 1] not in '"]}' and self._read_more()):
+                # a number may carry on in the next chunk so try again
+                continue
+            self.position = end
+            return value
+
+    def _read_more(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.position:] + chunk
+                self.position = 0
+                return True
+        return False
+
+
+def _iter_json_items(chunks, keys):
+    """
+    Given an iterator over chunks of a JSON document will descend through the
+    nested objects named by keys and yield the (key, value) pairs of the
+    innermost object as they are read. Everything else is skipped.
+    """
+    return _iter_json_object(_JSONStream(chunks), keys)
+
+
+def _iter_json_object(stream, keys):
+    if stream.next_char() != '{':
+        raise ValueError('Expected a JSON object')
+    if stream.peek_char() == '}':
+        stream.next_char()
+        return
+    while True:
+        key = stream.value()
+        if stream.next_char() != ':':
+            raise ValueError('Expected ":" in JSON object')
+        if not keys:
+            yield key, stream.value()
+        elif key == keys[0]:
+            for item in _iter_json_object(stream, keys[1:]):
+                yield item
         else:
-            # No way to work out what content-type to send to Fluidinfo so
-            # bail out.
-            raise TypeError("You must supply a mime-type")
-    response = requests.request(method, url, data=body, headers=headers)
-    if ((response.headers['content-type'] == 'application/json' or
-        response.headers['content-type'] == 'application/' +
-            'vnd.fluiddb.value+json')
-        and response.text):
-        result = json.loads(response.text)
-    else:
-        result = response.text
-    summary = response.headers
-    summary['status'] = str(response.status_code)
-    return summary, result
+            stream.value()
+        separator = stream.next_char()
+        if separator == '}':
+            return
+        if separator != ',':
+            raise ValueError('Expected "," or "}" in JSON object')
+
+
+class ValueTable(object):
+    """
+    A /values result held column by column rather than as the dictionaries
+    of dictionaries that json.loads makes of it, which take several times
+    as much memory as the values themselves. Object ids are packed into a
+    single bytearray (16 bytes each), each tag's values are kept in a list
+    of their own (with a shared marker where an object doesn't have the
+    tag) and equal strings and sets of strings are only stored once.
+
+    Rows are ValueRow objects, made when asked for, and a table can be
+    turned back into the usual dictionary form with to_dict(). Use
+    from_items() (or FluidinfoClient.values_table) to build one straight
+    from the streaming parser so the dictionary form never exists at all.
+
+    tags = The tag paths of the columns (more are added as they turn up)
+    """
+
+    def __init__(self, tags=()):
+        self.tags = []
+        self._ids = bytearray()
+        self._columns = {}
+        self._strings = {}
+        self._by_id = None
+        self._by_about = None
+        for tag in tags:
+            self._add_column(tag)
+
+    @classmethod
+    def from_items(cls, items, tags=()):
+        """
+        Returns a table of the (object id, tag values) tuples yielded by
+        FluidinfoClient.iter_values.
+        """
+        table = cls(tags)
+        for object_id, values in items:
+            table.append(object_id, values)
+        return table
+
+    @classmethod
+    def from_chunks(cls, chunks, tags=()):
+        """
+        Returns a table of the /values response body given as an iterator of
+        chunks (for example, a response's iter_content()).
+        """
+        return cls.from_items(_iter_json_items(chunks, ['results', 'id']),
+                              tags)
+
+    @classmethod
+    def from_result(cls, result):
+        """
+        Returns a table of an already decoded /values result.
+        """
+        return cls.from_items(result['results']['id'].iteritems())
+
+    def append(self, object_id, values):
+        """
+        Adds a row for the object given its tag values in the form returned
+        by /values (a dictionary mapping tag paths to {'value': value}).
+        """
+        try:
+            packed = binascii.unhexlify(object_id.replace('-', ''))
+        except TypeError:
+            packed = ''
+        if len(packed) != 16:
+            raise ValueError('Not an object id: %r' % object_id)
+        row = len(self)
+        for tag, entry in values.iteritems():
+            column = self._columns.get(tag)
+            if column is None:
+                column = self._add_column(tag)
+            if isinstance(entry, dict) and entry.keys() == ['value']:
+                # the usual case, anything else (such as an opaque value's
+                # value-type and size) is kept as it is
+                entry = self._intern(entry['value'])
+            column.append(entry)
+        for column in self._columns.itervalues():
+            if len(column) == row:
+                column.append(_MISSING)
+        self._ids.extend(packed)
+        self._by_id = self._by_about = None
+
+    def __len__(self):
+        return len(self._ids) // 16
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield ValueRow(self, index)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return ValueRow(self, index)
+
+    def object_id(self, index):
+        """
+        Returns the id of the object in the given row.
+        """
+        hexed = binascii.hexlify(self._ids[index * 16:index * 16 + 16])
+        return '%s-%s-%s-%s-%s' % (hexed[:8], hexed[8:12], hexed[12:16],
+                                   hexed[16:20], hexed[20:])
+
+    def ids(self):
+        """
+        Yields the ids of the objects in the table in order.
+        """
+        for index in xrange(len(self)):
+            yield self.object_id(index)
+
+    def scan(self, tag):
+        """
+        Yields an (object id, value) tuple for each object with the tag.
+        """
+        column = self._columns.get(tag, ())
+        for index, value in enumerate(column):
+            if value is not _MISSING:
+                yield self.object_id(index), _exported(value)
+
+    def values(self, tag):
+        """
+        Yields the value of the tag on each object that has it (without
+        working out the objects' ids, so it's the quickest way to scan a
+        column).
+        """
+        for value in self._columns.get(tag, ()):
+            if value is not _MISSING:
+                yield _exported(value)
+
+    def get(self, object_id):
+        """
+        Returns the ValueRow of the object with the given id, or None.
+        """
+        if self._by_id is None:
+            ids = self._ids
+            self._by_id = dict((str(ids[i:i + 16]), i // 16)
+                               for i in xrange(0, len(ids), 16))
+        try:
+            packed = binascii.unhexlify(object_id.replace('-', ''))
+        except TypeError:
+            return None
+        index = self._by_id.get(packed)
+        if index is None:
+            return None
+        return ValueRow(self, index)
+
+    def get_by_about(self, about):
+        """
+        Returns the ValueRow of the object with the given about value, or
+        None. The table must have a fluiddb/about column.
+        """
+        if self._by_about is None:
+            column = self._columns.get('fluiddb/about')
+            if column is None:
+                raise ValueError('The table has no fluiddb/about column')
+            self._by_about = dict((about, index) for index, about in
+                                  enumerate(column) if about is not _MISSING)
+        index = self._by_about.get(_unicode(about))
+        if index is None:
+            return None
+        return ValueRow(self, index)
+
+    def to_dict(self):
+        """
+        Returns the table in the form of a decoded /values result.
+        """
+        return {'results': {'id': dict((row.id, row.to_dict())
+                                       for row in self)}}
+
+    def _add_column(self, tag):
+        column = self._columns[tag] = [_MISSING] * len(self)
+        self.tags.append(tag)
+        return column
+
+    def _intern(self, value):
+        if isinstance(value, list):
+            value = tuple(self._intern(member) for member in value)
+        elif not isinstance(value, basestring):
+            return value
+        return self._strings.setdefault(value, value)
+
+
+class ValueRow(object):
+    """
+    One object's row of a ValueTable. Its tag values can be got by tag path
+    (like a dictionary) and to_dict() returns them in the /values form.
+    """
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    @property
+    def id(self):
+        return self.table.object_id(self.index)
+
+    def __getitem__(self, tag):
+        column = self.table._columns.get(tag)
+        if column is None or column[self.index] is _MISSING:
+            raise KeyError(tag)
+        return _exported(column[self.index])
+
+    def __contains__(self, tag):
+        column = self.table._columns.get(tag)
+        return column is not None and column[self.index] is not _MISSING
+
+    def get(self, tag, default=None):
+        try:
+            return self[tag]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """
+        Returns the object's tag values as a dictionary mapping tag paths to
+        {'value': value} (or whatever else /values returned for the tag).
+        """
+        values = {}
+        for tag, column in self.table._columns.iteritems():
+            value = column[self.index]
+            if value is _MISSING:
+                continue
+            if isinstance(value, dict):
+                values[tag] = dict(value)
+            else:
+                values[tag] = {'value': _exported(value)}
+        return values
+
+    def __repr__(self):
+        return '<ValueRow %s>' % self.id
+
+
+# Marks a tag that an object in a ValueTable doesn't have.
+_MISSING = object()
+
+
+def _exported(value):
+    """
+    Returns a value stored in a ValueTable as it would be in a /values
+    result (sets of strings are stored as tuples but returned as lists).
+    """
+    if isinstance(value, tuple):
+        return list(value)
+    return value
 
 
 def isprimitive(body):
@@ -171,13 +3964,122 @@ def isprimitive(body):
     values.
     """
     bodyType = type(body)
-    if bodyType in SERIALIZABLE_TYPES:
-        if bodyType in ITERABLE_TYPES:
-            if not all(isinstance(x, basestring) for x in body):
+    if bodyType in ITERABLE_TYPES:
+        # a plain loop is much quicker than all() with a generator for the
+        # large sets of strings that are common
+        for x in body:
+            if not isinstance(x, basestring):
                 return False
         return True
-    else:
-        return False
+    return bodyType in SERIALIZABLE_TYPES
+
+
+# In-memory buffers that are uploaded in slices rather than being copied.
+BUFFER_TYPES = (memoryview, bytearray)
+if mmap is not None:
+    BUFFER_TYPES += (mmap.mmap,)
+
+
+class _BufferReader(object):
+    """
+    A read-only file-like view of a memoryview, mmap or bytearray whose
+    read() method returns slices of the underlying memory rather than
+    copies.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size=-1):
+        start = self.position
+        end = len(self.data)
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        self.position = max(start, end)
+        if isinstance(self.data, memoryview):
+            return self.data[start:end]
+        return buffer(self.data, start, max(0, end - start))
+
+
+# The content-type of primitive tag values.
+PRIMITIVE_CONTENT_TYPE = 'application/vnd.fluiddb.value+json'
+
+
+class EncodedValue(object):
+    """
+    A tag value that has already been classified and serialised, ready to be
+    sent to Fluidinfo as the body of a request. Passing one to call() (or a
+    BatchWriter) rather than the value itself means the checks and encoding
+    are only done once however many times the value is written (or retried).
+    Create them with encode_value().
+
+    value = The original value
+    content_type = The content-type to send
+    data = The serialised value
+    """
+
+    __slots__ = ('value', 'content_type', 'data')
+
+    def __init__(self, value, content_type, data):
+        self.value = value
+        self.content_type = content_type
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+def encode_value(value, mime=None):
+    """
+    Classifies and serialises a tag value in the same way as call() and
+    returns an EncodedValue. Primitive values are turned into json, values
+    given a mime-type are opaque and sent as they are, and dictionaries are
+    sent as json. Anything else raises a TypeError.
+    """
+    if mime:
+        return EncodedValue(value, mime, value)
+    if isinstance(value, dict):
+        return EncodedValue(value, 'application/json', json_dumps(value))
+    if isprimitive(value):
+        return EncodedValue(value, PRIMITIVE_CONTENT_TYPE, json_dumps(value))
+    raise TypeError("You must supply a mime-type")
+
+
+def iter_values(query, tags, custom_headers={}, chunk_size=CHUNK_SIZE):
+    """
+    Yields an (object id, tag values) tuple for each object matching the
+    query as the response to the /values request is read. See
+    FluidinfoClient.iter_values.
+    """
+    return default_client.iter_values(query, tags, custom_headers, chunk_size)
+
+
+def values_table(query, tags, custom_headers={}, chunk_size=CHUNK_SIZE):
+    """
+    Returns the tag values of the objects matching the query in a
+    ValueTable. See FluidinfoClient.values_table.
+    """
+    return default_client.values_table(query, tags, custom_headers,
+                                       chunk_size)
+
+
+def download(path, out=None, custom_headers={}, chunk_size=CHUNK_SIZE, **kw):
+    """
+    GETs the resource without decoding the response, writing it to out if
+    given. See FluidinfoClient.download.
+    """
+    return default_client.download(path, out, custom_headers, chunk_size,
+                                   **kw)
 
 
 def build_url(path):
@@ -185,10 +4087,4 @@ def build_url(path):
     Given a path that is either a string or list of path elements, will return
     the correct URL
     """
-    url = instance
-    if isinstance(path, list):
-        url += '/'
-        url += '/'.join([urllib.quote(element, safe='') for element in path])
-    else:
-        url += urllib.quote(path)
-    return url
+    return default_client.build_url(path)
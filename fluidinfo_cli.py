@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+The fluidinfo command for exporting tag values from, and importing them
+into, Fluidinfo.
+
+Usage:
+
+    $ fluidinfo export 'has test/rating' test/rating test/title > out.ndjson
+    $ fluidinfo import out.ndjson --checkpoint import.checkpoint
+
+export streams the objects matching a query to newline-delimited JSON, one
+object per line such as {"id": "...", "test/rating": 7}, without reading
+the whole result into memory.
+
+import reads newline-delimited JSON (in the same form, identifying each
+object by its "id" or "about" value) or CSV (with a header row naming an
+"id" or "about" column and the tag path of every other column) and writes
+the tag values with batched PUT requests to /values made in parallel.
+Failed requests are retried and, if a checkpoint file is given, an
+interrupted import picks up where it left off when run again.
+
+The username and password are taken from the FLUIDINFO_USERNAME and
+FLUIDINFO_PASSWORD environment variables unless given as options.
+
+Copyright (c) 2009-2010 Seo Sanghyeon, Nicholas Tollervey and others
+
+See README, AUTHORS and LICENSE for more information
+"""
+
+import os
+import sys
+import csv
+import time
+import argparse
+import itertools
+import fluidinfo
+if sys.version_info < (2, 6):
+    import simplejson as json
+else:
+    import json
+
+
+# The fields of a record identifying the object rather than naming a tag.
+ID_FIELDS = ('id', 'fluiddb/id')
+ABOUT_FIELDS = ('about', 'fluiddb/about')
+
+
+def export(client, query, tags, out):
+    """
+    Writes a line of JSON to out for each object matching the query and
+    returns the number of objects written. Opaque values are left out since
+    /values doesn't return them.
+    """
+    written = 0
+    for object_id, values in client.iter_values(query, tags):
+        record = {'id': object_id}
+        for tag, value in values.items():
+            if 'value' in value:
+                record[tag] = value['value']
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        written += 1
+    return written
+
+
+def read_ndjson(lines):
+    """
+    Yields a (line number, record) tuple for each non-blank line of JSON.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise ValueError('line %d: not valid JSON' % number)
+        if not isinstance(record, dict):
+            raise ValueError('line %d: not a JSON object' % number)
+        yield number, record
+
+
+def read_csv(lines):
+    """
+    Yields a (line number, record) tuple for each row after the header row.
+    Values are left as strings and empty cells are skipped.
+    """
+    reader = csv.reader(lines)
+    try:
+        header = [name.decode('utf-8').strip() for name in reader.next()]
+    except StopIteration:
+        return
+    for row in reader:
+        record = {}
+        for name, cell in zip(header, row):
+            if cell:
+                record[name] = cell.decode('utf-8')
+        if record:
+            yield reader.line_num, record
+
+
+def query_and_values(number, record):
+    """
+    Returns the /values query matching the record's object and a dictionary
+    of the values to set, as sent in a PUT to /values.
+    """
+    query = None
+    values = {}
+    for name, value in record.items():
+        if name in ID_FIELDS:
+            query = 'fluiddb/id = "%s"' % value
+        elif name in ABOUT_FIELDS:
+            if query is None:
+                query = fluidinfo._about_query(value)
+        elif not fluidinfo.isprimitive(value):
+            raise ValueError('line %d: %s is not a primitive value' %
+                             (number, name))
+        else:
+            values[name] = {'value': value}
+    if query is None:
+        raise ValueError('line %d: no id or about value' % number)
+    return query, values
+
+
+class Importer(object):
+    """
+    Writes records to Fluidinfo in batches of batch_size objects, with up to
+    workers batches in flight at a time. The number of records that have
+    been written is saved to the checkpoint file (if any) after every round
+    of batches, and records up to that point are skipped when starting
+    again.
+
+    client = The FluidinfoClient to use (its RetryPolicy retries failures)
+    checkpoint = The path of the checkpoint file
+    dry_run = Read and check the records but don't write anything
+    progress = Seconds between progress reports (None means never)
+    out = Where progress is reported
+    """
+
+    def __init__(self, client, batch_size=100, workers=4, checkpoint=None,
+                 dry_run=False, progress=None, out=sys.stderr):
+        self.client = client
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.progress = progress
+        self.out = out
+        self.records = 0
+        self.values = 0
+        self.requests = 0
+        self.skipped = 0
+        self._started = None
+        self._reported = None
+
+    def run(self, records):
+        """
+        Imports the (line number, record) tuples and returns the number of
+        records written (or that would be in a dry run). Raises a
+        FluidinfoError if a batch can't be written.
+        """
+        self._started = self._reported = time.time()
+        done = self._load_checkpoint()
+        records = iter(records)
+        # count the records already imported without holding on to them
+        self.skipped = sum(1 for record in itertools.islice(records, done))
+        size = self.batch_size * self.workers
+        while True:
+            chunk = list(itertools.islice(records, size))
+            if not chunk:
+                break
+            batches = []
+            for i in range(0, len(chunk), self.batch_size):
+                batches.append([query_and_values(number, record)
+                                for number, record in
+                                chunk[i:i + self.batch_size]])
+            if not self.dry_run:
+                self._write(batches)
+            self.records += len(chunk)
+            self.values += sum(len(values) for batch in batches
+                               for query, values in batch)
+            self.requests += len(batches)
+            if not self.dry_run:
+                self._save_checkpoint(done + self.records)
+            self._report()
+        self._report(True)
+        return self.records
+
+    def _write(self, batches):
+        calls = [('PUT', '/values', {'body': {'queries': [[query, values]
+                                                          for query, values
+                                                          in batch]},
+                                     'decode': False})
+                 for batch in batches]
+        for outcome in self.client.map_calls(calls, self.workers):
+            if isinstance(outcome, Exception):
+                raise outcome
+            headers, result = outcome
+            if not headers['status'].startswith('2'):
+                raise fluidinfo.FluidinfoError(headers, result.value)
+
+    def _load_checkpoint(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return 0
+        with open(self.checkpoint) as f:
+            return int(f.read().strip() or 0)
+
+    def _save_checkpoint(self, done):
+        if self.checkpoint is None:
+            return
+        # write a new file and rename it over the old one so a crash can't
+        # leave a half written checkpoint behind
+        temporary = self.checkpoint + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('%d\n' % done)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.checkpoint)
+
+    def _report(self, finished=False):
+        now = time.time()
+        if self.out is None:
+            return
+        if not finished and (self.progress is None or
+                             now - self._reported < self.progress):
+            return
+        self._reported = now
+        elapsed = max(now - self._started, 1e-6)
+        verb = 'checked' if self.dry_run else 'imported'
+        message = '%s %d records (%d values in %d requests) %.1f records/s' % (
+            verb, self.records, self.values, self.requests,
+            self.records / elapsed)
+        if finished and self.skipped:
+            message += ', skipped %d already imported' % self.skipped
+        self.out.write(message + '\n')
+        self.out.flush()
+
+
+def main(argv=None, transport=None, stdout=sys.stdout, stderr=sys.stderr):
+    """
+    Runs the fluidinfo command with the given arguments (sys.argv[1:] by
+    default) and returns its exit status.
+
+    transport = The transport for the client to use (see FluidinfoClient)
+    """
+    parser = argparse.ArgumentParser(prog='fluidinfo',
+                                     description=__doc__.split('\n')[1])
+    parser.add_argument('--instance', default=fluidinfo.MAIN,
+                        help='the URL of the Fluidinfo instance')
+    parser.add_argument('--username',
+                        default=os.environ.get('FLUIDINFO_USERNAME'))
+    parser.add_argument('--password',
+                        default=os.environ.get('FLUIDINFO_PASSWORD'))
+    parser.add_argument('--retries', type=int, default=5,
+                        help='the number of times failed requests are '
+                        'retried')
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't report progress")
+    commands = parser.add_subparsers(dest='command')
+    export_parser = commands.add_parser(
+        'export', help='write the objects matching a query as NDJSON')
+    export_parser.add_argument('query')
+    export_parser.add_argument('tags', nargs='+', metavar='tag')
+    export_parser.add_argument('--output',
+                               help='write to this file (default stdout)')
+    import_parser = commands.add_parser(
+        'import', help='write the tag values in an NDJSON or CSV file')
+    import_parser.add_argument('input', help="the file to read ('-' for "
+                               'stdin)')
+    import_parser.add_argument('--format', choices=['ndjson', 'csv'],
+                               help='the format of the input (guessed from '
+                               'its extension by default)')
+    import_parser.add_argument('--batch-size', type=int, default=100,
+                               help='the number of objects per request')
+    import_parser.add_argument('--workers', type=int,
+                               default=fluidinfo.POOL_SIZE,
+                               help='the number of requests made at once')
+    import_parser.add_argument('--checkpoint',
+                               help='record progress in this file and '
+                               'resume from it')
+    import_parser.add_argument('--progress', type=float, default=5.0,
+                               help='seconds between progress reports')
+    import_parser.add_argument('--dry-run', action='store_true',
+                               help="check the input but don't write "
+                               'anything')
+    args = parser.parse_args(argv)
+    client = fluidinfo.FluidinfoClient(
+        args.instance, transport=transport,
+        retry=fluidinfo.RetryPolicy(max_retries=args.retries))
+    if args.username is not None:
+        client.login(args.username, args.password or '')
+    try:
+        if args.command == 'export':
+            return _export(client, args, stdout, stderr)
+        return _import(client, args, stdin=sys.stdin, stderr=stderr)
+    except (ValueError, IOError, fluidinfo.FluidinfoError), e:
+        stderr.write('fluidinfo: error: %s\n' % e)
+        return 1
+
+
+def _export(client, args, stdout, stderr):
+    out = stdout
+    if args.output:
+        out = open(args.output, 'w')
+    try:
+        written = export(client, args.query, args.tags, out)
+    finally:
+        if out is not stdout:
+            out.close()
+    if not args.quiet:
+        stderr.write('exported %d objects\n' % written)
+    return 0
+
+
+def _import(client, args, stdin, stderr):
+    format = args.format
+    if format is None:
+        format = 'csv' if args.input.lower().endswith('.csv') else 'ndjson'
+    if args.input == '-':
+        lines = stdin
+    else:
+        lines = open(args.input, 'rb')
+    try:
+        if format == 'csv':
+            records = read_csv(lines)
+        else:
+            records = read_ndjson(lines)
+        importer = Importer(client, args.batch_size, args.workers,
+                            args.checkpoint, args.dry_run, args.progress,
+                            None if args.quiet else stderr)
+        importer.run(records)
+    finally:
+        if lines is not stdin:
+            lines.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
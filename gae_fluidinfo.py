@@ -8,8 +8,9 @@ See README, AUTHORS and LICENSE for more information
 """
 
 import sys
-import urllib
-import types
+import fluidinfo
+from fluidinfo import MAIN, SANDBOX, ITERABLE_TYPES, SERIALIZABLE_TYPES
+from fluidinfo import isprimitive
 if sys.version_info < (2, 6):
     import simplejson as json
 else:
@@ -17,23 +18,75 @@ else:
 from google.appengine.api import urlfetch
 
 
-# There are currently two instances of Fluidinfo. MAIN is the default standard
-# instance and SANDBOX is a scratch version for testing purposes. Data in
-# SANDBOX can (and will) be blown away.
-MAIN = 'https://fluiddb.fluidinfo.com'
-SANDBOX = 'https://sandbox.fluidinfo.com'
+# MAIN is the default standard instance of Fluidinfo and SANDBOX is a scratch
+# version for testing purposes. Data in SANDBOX can (and will) be blown away.
 instance = MAIN
 
 
-ITERABLE_TYPES = set((list, tuple))
-SERIALIZABLE_TYPES = set((types.NoneType, bool, int, float, str, unicode, list,
-                          tuple))
-
-
 global_headers = {
     'Accept': '*/*',
 }
 
+
+class UrlFetchTransport(object):
+    """
+    A transport for fluidinfo.FluidinfoClient that sends requests with App
+    Engine's urlfetch service, so a client on App Engine gets the same
+    encoding, caching, retries and hooks as anywhere else::
+
+        client = fluidinfo.FluidinfoClient(transport=UrlFetchTransport())
+
+    deadline = Seconds to wait for a response (urlfetch's default if None)
+    """
+
+    errors = (urlfetch.Error,)
+    retryable_errors = (urlfetch.DownloadError,)
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+
+    def start(self, method, url, body=None, headers=None):
+        """
+        Starts fetching the URL and returns the urlfetch RPC object.
+        """
+        rpc = urlfetch.create_rpc(deadline=self.deadline)
+        urlfetch.make_fetch_call(rpc, url, fluidinfo.read_body(body), method,
+                                 headers)
+        return rpc
+
+    def request(self, method, url, body=None, headers=None, stream=False):
+        response = self.start(method, url, body, headers).get_result()
+        return fluidinfo.TransportResponse(response.status_code,
+                                           response.headers, response.content)
+
+    def close(self):
+        pass
+
+
+class _ModuleClient(fluidinfo.FluidinfoClient):
+    """
+    Prepares the requests made by the module level functions, reading this
+    module's instance and global_headers variables every time. Everything
+    else is set up just as it is for any other FluidinfoClient (sending the
+    requests with urlfetch) so its call() works too.
+    """
+
+    def __init__(self):
+        self._configure(transport=UrlFetchTransport())
+
+    @property
+    def instance(self):
+        return instance
+
+    @property
+    def headers(self):
+        return global_headers
+
+
+# The client that the module level functions below delegate to.
+default_client = _ModuleClient()
+
+
 def login(username, password):
     """
     Creates the 'Authorization' token from the given username and password.
@@ -106,47 +159,9 @@ def call(method, path, body=None, mime=None, tags=[], custom_headers={},
     headers = A dictionary containing additional headers to send in the request
     **kw = Query-string arguments to be appended to the URL
     """
-    # build the URL
-    url = build_url(path)
-    if kw:
-        url = url + '?' + urllib.urlencode(kw)
-    if tags and path.startswith('/values'):
-        # /values based requests must have a tags list to append to the
-        # url args (which are passed in as **kw), so append them so everything
-        # gets urlencoded correctly below
-        url = url + '&' + urllib.urlencode([('tag', tag) for tag in tags])
-    # set the headers
-    headers = global_headers.copy()
-    if custom_headers:
-        headers.update(custom_headers)
-    # make sure the path is a string for the following elif check for PUT
-    # based requests
-    if isinstance(path, list):
-        path = '/'+'/'.join(path)
-    # Make sure the correct content-type header is sent
-    if isinstance(body, dict):
-        # jsonify dicts
-        headers['content-type'] = 'application/json'
-        body = json.dumps(body)
-    elif method.upper() == 'PUT' and (
-        path.startswith('/objects/') or path.startswith('/about')):
-        # A PUT to an "/objects/" or "/about/" resource means that we're
-        # handling tag-values. Make sure we handle primitive/opaque value types
-        # properly.
-        if mime:
-            # opaque value (just set the mime type)
-            headers['content-type'] = mime
-        elif isprimitive(body):
-            # primitive values need to be json-ified and have the correct
-            # content-type set
-            headers['content-type'] = 'application/vnd.fluiddb.value+json'
-            body = json.dumps(body)
-        else:
-            # No way to work out what content-type to send to Fluidinfo so
-            # bail out.
-            raise TypeError("You must supply a mime-type")
-    rpc = urlfetch.create_rpc()
-    urlfetch.make_fetch_call(rpc, url, body, method, headers)
+    url, body, headers = default_client.prepare(method, path, body, mime,
+                                                tags, custom_headers, kw)
+    rpc = default_client.transport.start(method, url, body, headers)
     if async:
         return rpc
     return result(rpc)
@@ -158,47 +173,15 @@ def result(rpc):
     try:
         response = rpc.get_result()
         if (response.content and (response.headers['content-type'] in
-            ['application/json', 'application/vnd.fluiddb.value+json'])):
+            fluidinfo.JSON_CONTENT_TYPES)):
             response.content = json.loads(response.content)
         return response
     except urlfetch.Error:
         return None
 
-def isprimitive(body):
-    """
-    Given the body of a request will return a boolean to indicate if the
-    value is a primitive value type.
-
-    See:
-
-    http://doc.fluidinfo.com/fluidDB/api/tag-values.html
-
-    &
-
-    http://bit.ly/hmrMzT
-
-    For an explanation of the difference between primitive and opaque
-    values.
-    """
-    bodyType = type(body)
-    if bodyType in SERIALIZABLE_TYPES:
-        if bodyType in ITERABLE_TYPES:
-            if not all(isinstance(x, basestring) for x in body):
-                return False
-        return True
-    else:
-        return False
-
-
 def build_url(path):
     """
     Given a path that is either a string or list of path elements, will return
     the correct URL
     """
-    url = instance
-    if isinstance(path, list):
-        url += '/'
-        url += '/'.join([urllib.quote(element, safe='') for element in path])
-    else:
-        url += urllib.quote(path)
-    return url
+    return default_client.build_url(path)
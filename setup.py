@@ -8,7 +8,8 @@ setup(name='fluidinfo.py',
       author='Nicholas Tollervey (based upon work by Sanghyeon Seo)',
       author_email='ntoll@ntoll.org',
       url='http://fluidinfo.com',
-      py_modules=['fluidinfo',],
+      py_modules=['fluidinfo', 'fakefluidinfo', 'fluidinfo_cli',],
+      entry_points={'console_scripts': ['fluidinfo = fluidinfo_cli:main']},
       license='MIT',
       install_requires=['requests',],
       long_description=open('README.rst').read(),
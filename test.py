@@ -1,5 +1,20 @@
 import fluidinfo
+import fakefluidinfo
+import fluidinfo_cli
+import os
+import gc
+import json
+import mmap
+import shutil
+import tempfile
+import StringIO
+import requests
+import time
+import threading
 import uuid
+import zlib
+import types
+import sys
 import unittest
 
 # Generic test user created on the Sandbox for the express purpose of
@@ -7,6 +22,54 @@ import unittest
 USERNAME = 'test'
 PASSWORD = 'test'
 
+
+class CountingTransport(fakefluidinfo.FakeTransport):
+    """
+    A FakeTransport that records the method and path of every request.
+    """
+
+    def __init__(self, fake=None):
+        fakefluidinfo.FakeTransport.__init__(self, fake)
+        self.sent = []
+
+    def request(self, method, url, *args, **kw):
+        self.sent.append((method, url.split('?')[0][len('http://fake'):]))
+        return fakefluidinfo.FakeTransport.request(self, method, url,
+                                                   *args, **kw)
+
+
+class FakeFluidinfoTestCase(unittest.TestCase):
+    """
+    Base class for tests run against the in-memory stand-in for Fluidinfo.
+    """
+
+    def set_up_client(self, tags=('tag',), **kw):
+        """
+        Sets self.transport to a new CountingTransport and self.client to a
+        FluidinfoClient (given the keyword arguments) using it, and creates
+        a test/ns namespace holding the given tags.
+        """
+        self.transport = CountingTransport()
+        self.client = fluidinfo.FluidinfoClient('http://fake',
+                                                transport=self.transport,
+                                                **kw)
+        if tags:
+            self.client.post('/namespaces/test', {'name': 'ns',
+                                                  'description': 'ns'})
+        for tag in tags:
+            self.client.post('/tags/test/ns', {'name': tag,
+                                               'description': tag,
+                                               'indexed': False})
+
+    def requests(self):
+        """
+        Returns the (method, path) of the requests sent since it was last
+        called.
+        """
+        sent = self.transport.sent[:]
+        del self.transport.sent[:]
+        return sent
+
 class TestFluidinfo(unittest.TestCase):
     """
     The names of the test methods are pretty self-explanatory. I've made sure
@@ -278,5 +341,1967 @@ class TestFluidinfo(unittest.TestCase):
             fluidinfo.delete('/tags/test/' + new_tag)
 
 
+class TestEncodedValue(unittest.TestCase):
+
+    def test_encode_value(self):
+        encoded = fluidinfo.encode_value(['a', u'b'])
+        self.assertEqual('application/vnd.fluiddb.value+json',
+                         encoded.content_type)
+        self.assertEqual(['a', 'b'], json.loads(encoded.data))
+        encoded = fluidinfo.encode_value('<p>Hi</p>', 'text/html')
+        self.assertEqual(('text/html', '<p>Hi</p>'),
+                         (encoded.content_type, encoded.data))
+        encoded = fluidinfo.encode_value({'foo': 'bar'})
+        self.assertEqual('application/json', encoded.content_type)
+        self.assertRaises(TypeError, fluidinfo.encode_value, object())
+
+    def test_call_with_encoded_value(self):
+        pool = FakePool(FakeResponse(204), FakeResponse(204))
+        client = fluidinfo.FluidinfoClient(pool=pool)
+        encoded = fluidinfo.encode_value(1.5)
+        client.put('/about/foo/test/bar', encoded)
+        client.put('/objects/1234/test/bar', encoded)
+        for method, url, body, headers in pool.requests:
+            self.assertEqual('1.5', body)
+            self.assertEqual('application/vnd.fluiddb.value+json',
+                             headers['content-type'])
+
+    def test_batch_writer_with_encoded_values(self):
+        client = TestBatchWriter.FakeClient()
+        with fluidinfo.BatchWriter(client, max_delay=None) as writer:
+            writer.set('foo', 'test/a', fluidinfo.encode_value(['x']))
+            page = fluidinfo.encode_value('<p>Hi</p>', 'text/html')
+            writer.set('foo', 'test/page', page)
+        self.assertEqual([
+            ('/values', {'queries': [['fluiddb/about = "foo"',
+                                      {'test/a': {'value': ['x']}}]]}, None),
+            (['about', 'foo', 'test', 'page'], page, None)], client.puts)
+
+
+class TestBufferReader(unittest.TestCase):
+
+    def test_read(self):
+        data = bytearray('abcdefgh')
+        for buf in (data, memoryview(data)):
+            reader = fluidinfo._BufferReader(buf)
+            self.assertEqual(8, len(reader))
+            self.assertEqual('abc', str(bytearray(reader.read(3))))
+            self.assertEqual(3, reader.tell())
+            self.assertEqual('defgh', str(bytearray(reader.read())))
+            self.assertEqual('', str(bytearray(reader.read(3))))
+            reader.seek(6)
+            self.assertEqual('gh', str(bytearray(reader.read(10))))
+
+
+class TestPath(unittest.TestCase):
+
+    paths = [
+        ['about', 'an/- object', 'test', 'foo'],
+        ['objects', '05eee31e-fbd1-43cc-9500-0469707a9bc3', 'test', 'foo'],
+        ['about', 'C\xfc\xe4h?&=#%'],
+        ['namespaces', 'test', 'a b'],
+        ['values'],
+        ['users', 'test'],
+    ]
+
+    def test_same_as_build_url(self):
+        for elements in self.paths:
+            # twice, to check the cached version is the same
+            for i in range(2):
+                self.assertEqual(fluidinfo.build_url(elements),
+                                 fluidinfo.build_url(fluidinfo.path(*elements)))
+
+    def test_classification(self):
+        self.assertTrue(fluidinfo.path('about', 'x', 'test', 'foo')
+                        .is_tag_value)
+        self.assertTrue(fluidinfo.path('objects', 'x', 'test', 'foo')
+                        .is_tag_value)
+        self.assertFalse(fluidinfo.path('tags', 'test', 'foo').is_tag_value)
+        self.assertTrue(fluidinfo.path('values').is_values)
+        self.assertEqual('/about/*/test/foo',
+                         fluidinfo.path('about', 'x/y', 'test', 'foo')
+                         .template)
+
+    def test_template(self):
+        template = fluidinfo.PathTemplate('about', '*', 'test', '*')
+        result = template('a/b', 'c d')
+        self.assertEqual('/about/a%2Fb/test/c%20d', result.quoted)
+        self.assertEqual('/about/*/test/*', fluidinfo.path_template(result))
+        self.assertRaises(TypeError, template, 'a/b')
+
+    def test_lru_cache(self):
+        cache = fluidinfo._LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        # b was the least recently used
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_call_with_path(self):
+        pool = FakePool(FakeResponse(204), FakeResponse(200, '{}'))
+        client = fluidinfo.FluidinfoClient(fluidinfo.SANDBOX, pool=pool)
+        client.put(fluidinfo.path('about', 'a/b', 'test', 'foo'), 1)
+        method, url, body, headers = pool.requests[0]
+        self.assertEqual(fluidinfo.SANDBOX + '/about/a%2Fb/test/foo', url)
+        self.assertEqual('application/vnd.fluiddb.value+json',
+                         headers['content-type'])
+        client.get(fluidinfo.path('values'), tags=['test/foo'], query='x')
+        self.assertEqual(fluidinfo.SANDBOX + '/values?query=x&tag=test%2Ffoo',
+                         pool.requests[1][1])
+
+
+class TestConnectionPool(unittest.TestCase):
+    """
+    These tests don't touch the network, they only check the book-keeping
+    done by the pool.
+    """
+
+    def test_session_reused_per_instance(self):
+        pool = fluidinfo.ConnectionPool()
+        main = pool.session(fluidinfo.MAIN)
+        self.assertTrue(main is pool.session(fluidinfo.MAIN))
+        # a different instance gets its own session
+        sandbox = pool.session(fluidinfo.SANDBOX)
+        self.assertFalse(main is sandbox)
+        pool.close()
+
+    def test_idle_session_replaced(self):
+        pool = fluidinfo.ConnectionPool(idle_timeout=0)
+        first = pool.session(fluidinfo.MAIN)
+        time.sleep(0.01)
+        self.assertFalse(first is pool.session(fluidinfo.MAIN))
+        pool.close()
+
+    def test_pool_size(self):
+        pool = fluidinfo.ConnectionPool(pool_size=3)
+        session = pool.session(fluidinfo.MAIN)
+        adapter = session.get_adapter(fluidinfo.MAIN)
+        self.assertEqual(3, adapter._pool_maxsize)
+        pool.close()
+
+
+class TestFluidinfoClient(unittest.TestCase):
+    """
+    Checks that clients keep their settings to themselves.
+    """
+
+    def tearDown(self):
+        fluidinfo.instance = fluidinfo.MAIN
+        fluidinfo.logout()
+
+    def test_clients_are_independent(self):
+        alice = fluidinfo.FluidinfoClient(fluidinfo.SANDBOX, 'alice', 'secret')
+        bob = fluidinfo.FluidinfoClient(fluidinfo.MAIN)
+        self.assertTrue('Authorization' in alice.headers)
+        self.assertFalse('Authorization' in bob.headers)
+        self.assertFalse(alice.pool is bob.pool)
+        # the module level functions aren't affected either
+        self.assertFalse('Authorization' in fluidinfo.global_headers)
+        fluidinfo.login(USERNAME, PASSWORD)
+        alice.logout()
+        self.assertTrue('Authorization' in fluidinfo.global_headers)
+        self.assertFalse('Authorization' in alice.headers)
+
+    def test_build_url(self):
+        client = fluidinfo.FluidinfoClient(fluidinfo.SANDBOX)
+        self.assertEqual(fluidinfo.SANDBOX + '/about/a%2Fb/test/foo',
+                         client.build_url(['about', 'a/b', 'test', 'foo']))
+
+    def test_default_client_follows_module_settings(self):
+        fluidinfo.instance = fluidinfo.SANDBOX
+        self.assertEqual(fluidinfo.SANDBOX, fluidinfo.default_client.instance)
+        self.assertTrue(fluidinfo.default_client.headers is
+                        fluidinfo.global_headers)
+        fluidinfo.connection_pool, old = fluidinfo.ConnectionPool(), \
+            fluidinfo.connection_pool
+        try:
+            self.assertTrue(fluidinfo.default_client.pool is
+                            fluidinfo.connection_pool)
+        finally:
+            fluidinfo.connection_pool = old
+
+
+class TestAsyncClient(unittest.TestCase):
+    """
+    Uses a stand-in for FluidinfoClient so that no requests are made.
+    """
+
+    class FakeClient(object):
+
+        def __init__(self):
+            self.running = 0
+            self.most_running = 0
+            self.lock = threading.Lock()
+
+        def call(self, method, path, body=None, mime=None, tags=[],
+                 custom_headers={}, **kw):
+            with self.lock:
+                self.running += 1
+                self.most_running = max(self.running, self.most_running)
+            time.sleep(0.01)
+            with self.lock:
+                self.running -= 1
+            if path == '/fail':
+                raise ValueError(path)
+            return {'status': '200'}, (method, path, kw)
+
+    def test_call_returns_future(self):
+        client = fluidinfo.AsyncClient(self.FakeClient())
+        future = client.get('/users/test', returnDescription=True)
+        headers, result = future.result(5)
+        self.assertTrue(future.done())
+        self.assertEqual('200', headers['status'])
+        self.assertEqual(('GET', '/users/test', {'returnDescription': True}),
+                         result)
+
+    def test_exceptions_are_reraised(self):
+        client = fluidinfo.AsyncClient(self.FakeClient())
+        future = client.put('/fail', 'foo')
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertTrue(isinstance(future.exception(), ValueError))
+
+    def test_bounded_concurrency(self):
+        fake = self.FakeClient()
+        client = fluidinfo.AsyncClient(fake, max_concurrency=3)
+        futures = [client.get('/about/%d' % i) for i in range(20)]
+        for future in futures:
+            future.result(5)
+        self.assertTrue(fake.most_running <= 3)
+
+    def test_done_callback(self):
+        called = []
+        client = fluidinfo.AsyncClient(self.FakeClient())
+        future = client.head('/about/foo')
+        future.add_done_callback(called.append)
+        future.result(5)
+        # callbacks added after the fact are run immediately
+        future.add_done_callback(called.append)
+        self.assertEqual([future, future], called)
+
+
+class TestAsyncCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.client = fluidinfo.FluidinfoClient(
+            'http://fake', transport=fakefluidinfo.FakeTransport())
+
+    def test_async_call(self):
+        future = self.client.get('/users/test', async=True)
+        self.assertTrue(isinstance(future, fluidinfo.Future))
+        headers, result = fluidinfo.result(future, 5)
+        self.assertEqual('200', headers['status'])
+        self.assertEqual(u'test', result['name'])
+
+    def test_wait_all(self):
+        futures = [self.client.get(path, async=True)
+                   for path in ('/users/test', '/nothing', '/users/test')]
+        results = fluidinfo.wait_all(futures, 5)
+        self.assertEqual(['200', '404', '200'],
+                         [headers['status'] for headers, result in results])
+        self.assertTrue(all(future.done() for future in futures))
+
+    def test_wait_any(self):
+        slow = fluidinfo.Future()
+        fast = self.client.head('/users/test', async=True)
+        self.assertTrue(fast is fluidinfo.wait_any([slow, fast], 5))
+        self.assertRaises(fluidinfo.TimeoutError, fluidinfo.wait_any, [slow],
+                          0.01)
+        self.assertRaises(fluidinfo.TimeoutError, fluidinfo.wait_all,
+                          [fast, slow], 0.01)
+
+    def test_max_pending(self):
+        workers = fluidinfo.WorkerPool(1, max_pending=1)
+        release = threading.Event()
+        workers.submit(release.wait, 5)
+        time.sleep(0.05)
+        workers.submit(lambda: None)
+        blocked = threading.Thread(target=workers.submit, args=(len, []))
+        blocked.start()
+        time.sleep(0.05)
+        self.assertTrue(blocked.is_alive())
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        workers.shutdown()
+
+    def test_module_worker_pool(self):
+        self.assertTrue(fluidinfo.default_client.workers is
+                        fluidinfo.worker_pool)
+
+
+class TestBatchWriter(unittest.TestCase):
+    """
+    Uses a stand-in for FluidinfoClient that records the PUTs made.
+    """
+
+    class FakeClient(object):
+
+        def __init__(self):
+            self.puts = []
+
+        def put(self, path, body=None, mime=None, **kw):
+            self.puts.append((path, body, mime))
+            return {'status': '204'}, ''
+
+    def test_batches_by_size(self):
+        client = self.FakeClient()
+        writer = fluidinfo.BatchWriter(client, batch_size=3, max_delay=None)
+        writer.set('foo', 'test/a', 1)
+        writer.set('foo', 'test/b', 'x')
+        self.assertEqual([], client.puts)
+        writer.set_by_id('1234', 'test/a', ['a', 'b'])
+        self.assertEqual([('/values', {'queries': [
+            ['fluiddb/about = "foo"', {'test/a': {'value': 1},
+                                       'test/b': {'value': 'x'}}],
+            ['fluiddb/id = "1234"', {'test/a': {'value': ['a', 'b']}}]]},
+            None)], client.puts)
+        self.assertEqual([], writer.failures)
+
+    def test_opaque_values_put_individually(self):
+        client = self.FakeClient()
+        writer = fluidinfo.BatchWriter(client, max_delay=None)
+        writer.set('a/b', 'test/page', '<p>Hi</p>', 'text/html')
+        writer.set('a/b', 'test/a', True)
+        writer.close()
+        self.assertEqual([
+            ('/values', {'queries': [['fluiddb/about = "a/b"',
+                                      {'test/a': {'value': True}}]]}, None),
+            (['about', 'a/b', 'test', 'page'], '<p>Hi</p>', 'text/html')],
+            client.puts)
+
+    def test_flushes_after_delay(self):
+        client = self.FakeClient()
+        writer = fluidinfo.BatchWriter(client, max_delay=0.05)
+        writer.set('foo', 'test/a', 1)
+        for i in range(100):
+            if client.puts:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(client.puts))
+        writer.close()
+
+    def test_dropped_writer(self):
+        writer = fluidinfo.BatchWriter(self.FakeClient(), max_delay=0.01)
+        writer.set('foo', 'test/a', 1)
+        timer = writer._timer
+        self.assertTrue(timer.daemon)
+        del writer
+        gc.collect()
+        # the timer doesn't keep the writer alive, so stops once it's gone
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+
+    def test_dropped_writer_writes_queued_values(self):
+        client = self.FakeClient()
+        writer = fluidinfo.BatchWriter(client, max_delay=0.05)
+        for i in range(10):
+            writer.set('thing %d' % i, 'test/a', i)
+        timer = writer._timer
+        del writer
+        gc.collect()
+        timer.join(5)
+        self.assertFalse(timer.is_alive())
+        self.assertEqual(1, len(client.puts))
+        self.assertEqual(10, len(client.puts[0][1]['queries']))
+
+    def test_about_values_are_escaped(self):
+        client = self.FakeClient()
+        with fluidinfo.BatchWriter(client, max_delay=None) as writer:
+            writer.set('say "hi" \\o/', 'test/a', 1)
+        query = client.puts[0][1]['queries'][0][0]
+        self.assertEqual('fluiddb/about = "say \\"hi\\" \\\\o/"', query)
+
+    def test_failures_recorded(self):
+        client = self.FakeClient()
+        client.put = lambda *args, **kw: ({'status': '400'}, 'bad')
+        writer = fluidinfo.BatchWriter(client, max_delay=None)
+        writer.set('foo', 'test/a', 1)
+        writer.flush()
+        self.assertEqual([({'status': '400'}, 'bad')], writer.failures)
+
+    def test_mime_type_required(self):
+        writer = fluidinfo.BatchWriter(self.FakeClient(), max_delay=None)
+        self.assertRaises(TypeError, writer.set, 'foo', 'test/a', object())
+
+
+class TestWriteAheadQueue(FakeFluidinfoTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.set_up_client()
+        # don't actually wait between attempts
+        self.retry = fluidinfo.RetryPolicy(base=0.001, cap=0.001)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def queue(self, client=None, **kw):
+        return fluidinfo.WriteAheadQueue(self.directory, client or self.client,
+                                         retry=self.retry, **kw)
+
+    def value(self, about):
+        return self.client.get(['about', about, 'test', 'ns', 'tag'])[1]
+
+    def test_values_written(self):
+        with self.queue(batch_size=7, drain_workers=3) as queue:
+            for i in range(50):
+                queue.set('thing %d' % i, 'test/ns/tag', i)
+            queue.set('opaque', 'test/ns/tag', '<p/>', 'text/html')
+            self.assertTrue(queue.flush(5))
+        self.assertEqual(range(50), [self.value('thing %d' % i)
+                                     for i in range(50)])
+        self.assertEqual(u'<p/>', self.value('opaque'))
+        self.assertEqual([], queue.failures)
+
+    def test_survives_restart(self):
+        transport = FakePool(*[FakeResponse(503) for i in range(1000)])
+        down = fluidinfo.FluidinfoClient('http://fake', transport=transport)
+        queue = self.queue(down)
+        queue.set('thing', 'test/ns/tag', 'queued')
+        queue.set_by_id('1234', 'test/ns/tag', 1)
+        self.assertFalse(queue.flush(0.05))
+        self.assertTrue(transport.requests)
+        queue.close(drain=False)
+        self.assertRaises(ValueError, queue.set, 'thing', 'test/ns/tag', 1)
+        queue = self.queue()
+        self.assertTrue(queue.flush(5))
+        queue.close()
+        self.assertEqual(u'queued', self.value('thing'))
+
+    def test_checkpoint(self):
+        with self.queue(segment_size=100) as queue:
+            for i in range(20):
+                queue.set('thing %d' % i, 'test/ns/tag', i)
+            queue.flush(5)
+            queue.set('thing', 'test/ns/tag', 'last')
+            queue.flush(5)
+        # acknowledged segments are deleted and nothing is sent again
+        self.assertTrue(len(os.listdir(self.directory)) <= 3)
+        transport = FakePool()
+        queue = self.queue(fluidinfo.FluidinfoClient(transport=transport))
+        self.assertTrue(queue.flush(5))
+        queue.close()
+        self.assertEqual([], transport.requests)
+
+    def test_failures(self):
+        with self.queue() as queue:
+            queue.set('thing', 'test/ns/missing', 1)
+            queue.set('thing', 'test/ns/missing', 'x', 'text/plain')
+            queue.flush(5)
+            queue.set('thing', 'test/ns/tag', 2)
+        self.assertEqual(['404', '404'],
+                         [headers['status'] for headers, result, record
+                          in queue.failures])
+        self.assertEqual(2, self.value('thing'))
+        self.assertRaises(TypeError, queue.set, 'thing', 'test/ns/tag',
+                          object())
+
+    def test_non_ascii_about(self):
+        with self.queue() as queue:
+            queue.set(u'caf\xe9', 'test/ns/tag', 'unicode', 'text/plain')
+            queue.set('na\xc3\xafve', 'test/ns/tag', 'utf-8', 'text/plain')
+            self.assertTrue(queue.flush(5))
+        self.assertEqual(u'unicode', self.value('caf\xc3\xa9'))
+        self.assertEqual(u'utf-8', self.value('na\xc3\xafve'))
+        self.assertEqual([], queue.failures)
+
+    def test_unexpected_errors(self):
+        def request(*args, **kw):
+            raise requests.exceptions.InvalidURL('bad')
+        transport = FakePool()
+        transport.request = request
+        client = fluidinfo.FluidinfoClient('http://fake', transport=transport)
+        with self.queue(client) as queue:
+            queue.set('thing', 'test/ns/tag', 'x', 'text/plain')
+            queue.set('thing', 'test/ns/tag', 1)
+            # recorded as failures rather than retried forever
+            self.assertTrue(queue.flush(5))
+        self.assertEqual(2, len(queue.failures))
+        for headers, result, record in queue.failures:
+            self.assertEqual(None, headers)
+            self.assertTrue(isinstance(result,
+                                       requests.exceptions.InvalidURL))
+
+
+class TestMirror(FakeFluidinfoTestCase):
+
+    def setUp(self):
+        self.events = []
+        self.set_up_client(('tag', 'other'), hooks=[self.events.append])
+        for i in range(5):
+            self.client.put(['about', 'thing/%d' % i, 'test', 'ns', 'tag'], i)
+        self.client.put(['about', 'thing/0', 'test', 'ns', 'other'], 'x')
+        self.mirror = fluidinfo.Mirror(['test/ns/tag'], client=self.client)
+
+    def tearDown(self):
+        self.mirror.close()
+
+    def test_answers_locally(self):
+        self.assertEqual(5, self.mirror.refresh())
+        del self.events[:]
+        headers, result = self.mirror.get(['about', 'thing/3', 'test', 'ns',
+                                           'tag'])
+        self.assertEqual(('200', 3), (headers['status'], result))
+        object_id = self.client.get(['about', 'thing/3'])[1]['id']
+        self.assertEqual(3, self.mirror.get('/objects/%s/test/ns/tag' %
+                                            object_id)[1])
+        self.assertEqual(3, self.mirror.get(fluidinfo.path(
+            'about', 'thing/3', 'test', 'ns', 'tag'))[1])
+        self.assertEqual((True, 3), self.mirror.value('test/ns/tag',
+                                                      object_id=object_id))
+        self.assertEqual(1, len(self.events))
+        self.assertEqual(3, self.mirror.hits)
+
+    def test_falls_through(self):
+        self.mirror.refresh()
+        self.client.put(['about', 'new', 'test', 'ns', 'tag'], 9)
+        del self.events[:]
+        # not mirrored
+        path = ['about', 'thing/0', 'test', 'ns', 'other']
+        self.assertEqual(u'x', self.mirror.get(path)[1])
+        # not (yet) held by the mirror
+        path = ['about', 'new', 'test', 'ns', 'tag']
+        self.assertEqual(9, self.mirror.get(path)[1])
+        self.assertEqual('404', self.mirror.get(['about', 'nothing', 'test',
+                                                 'ns', 'tag'])[0]['status'])
+        self.assertEqual(3, len(self.events))
+        self.assertEqual(2, self.mirror.misses)
+
+    def test_non_ascii_about(self):
+        about = 'caf\xc3\xa9'
+        self.client.put(['about', about, 'test', 'ns', 'tag'], 'latte')
+        self.mirror.refresh()
+        del self.events[:]
+        path = ['about', about, 'test', 'ns', 'tag']
+        self.assertEqual(u'latte', self.mirror.get(path)[1])
+        self.assertEqual(u'latte', self.mirror.get(fluidinfo.path(*path))[1])
+        self.assertEqual((True, u'latte'),
+                         self.mirror.value('test/ns/tag', about=about))
+        self.mirror.call('PUT', path, 'mocha')
+        self.assertEqual((True, u'mocha'),
+                         self.mirror.value('test/ns/tag', about=u'caf\xe9'))
+        self.assertEqual(1, len(self.events))
+
+    def test_writes_and_refresh(self):
+        self.mirror.refresh()
+        path = ['about', 'thing/1', 'test', 'ns', 'tag']
+        self.mirror.call('PUT', path, 'changed')
+        self.assertEqual((True, u'changed'),
+                         self.mirror.value('test/ns/tag', about='thing/1'))
+        self.mirror.call('DELETE', path)
+        self.assertEqual((False, None),
+                         self.mirror.value('test/ns/tag', about='thing/1'))
+        # changes made elsewhere are picked up by a refresh
+        self.client.delete(['about', 'thing/2', 'test', 'ns', 'tag'])
+        self.client.put(['about', 'thing/3', 'test', 'ns', 'tag'], 33)
+        self.assertEqual(3, self.mirror.refresh())
+        self.assertEqual((False, None),
+                         self.mirror.value('test/ns/tag', about='thing/2'))
+        self.assertEqual((True, 33),
+                         self.mirror.value('test/ns/tag', about='thing/3'))
+
+    def test_writes_with_arguments(self):
+        self.mirror.refresh()
+        path = ['about', 'thing/1', 'test', 'ns', 'tag']
+        headers, result = self.mirror.call('PUT', path, 'lazy', decode=False)
+        self.assertEqual('204', headers['status'])
+        self.assertEqual((True, u'lazy'),
+                         self.mirror.value('test/ns/tag', about='thing/1'))
+        future = self.mirror.call('PUT', path, 'later', async=True)
+        self.assertEqual('204', future.result(5)[0]['status'])
+        self.assertEqual((True, u'later'),
+                         self.mirror.value('test/ns/tag', about='thing/1'))
+
+    def test_concurrent_refreshes(self):
+        threads = [threading.Thread(target=self.mirror.refresh)
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, self.mirror._generation)
+        for i in range(5):
+            self.assertEqual((True, i), self.mirror.value(
+                'test/ns/tag', about='thing/%d' % i))
+
+    def test_database_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            database = os.path.join(directory, 'mirror.db')
+            mirror = fluidinfo.Mirror(['test/ns/tag'], client=self.client,
+                                      database=database)
+            mirror.refresh()
+            mirror.close()
+            mirror = fluidinfo.Mirror(['test/ns/tag'], client=self.client,
+                                      database=database)
+            self.assertEqual((True, 4),
+                             mirror.value('test/ns/tag', about='thing/4'))
+            mirror.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_background_refresh(self):
+        mirror = fluidinfo.Mirror(['test/ns/tag'], client=self.client,
+                                  refresh_interval=0.01)
+        for i in range(500):
+            if mirror.value('test/ns/tag', about='thing/4')[0]:
+                break
+            time.sleep(0.01)
+        self.assertEqual((True, 4),
+                         mirror.value('test/ns/tag', about='thing/4'))
+        mirror.close()
+
+
+class TestAboutResolver(FakeFluidinfoTestCase):
+
+    def setUp(self):
+        self.set_up_client()
+        self.ids = {}
+        for about in ('a', 'b "quoted"', u'caf\xe9'):
+            headers, result = self.client.post('/objects', {'about': about})
+            self.ids[about] = result['id']
+        self.resolver = fluidinfo.AboutResolver(self.client)
+
+    def test_resolve_many(self):
+        self.requests()
+        ids = self.resolver.resolve_many(['a', 'b "quoted"', 'caf\xc3\xa9',
+                                          'a'], create=False)
+        self.assertEqual(self.ids, ids)
+        self.assertEqual([('GET', '/values')], self.requests())
+        # remembered
+        self.assertEqual(self.ids['a'], self.resolver.resolve('a'))
+        self.assertEqual([], self.requests())
+
+    def test_creates_missing(self):
+        self.assertEqual({}, self.resolver.resolve_many(['new'],
+                                                        create=False))
+        ids = self.resolver.resolve_many(['a', 'new', 'newer'])
+        self.assertEqual(self.ids['a'], ids['a'])
+        self.requests()
+        for about in ('new', 'newer'):
+            self.assertEqual(ids[about],
+                             self.client.get(['about', about])[1]['id'])
+        self.assertEqual(3, len(ids))
+
+    def test_chunks(self):
+        self.resolver.chunk_size = 2
+        self.requests()
+        self.resolver.resolve_many(self.ids.keys())
+        self.assertEqual(2, len(self.requests()))
+
+    def test_rewrite(self):
+        self.resolver.resolve('a')
+        object_id = self.ids['a']
+        for path in (['about', 'a', 'test', 'ns', 'tag'],
+                     '/about/a/test/ns/tag',
+                     fluidinfo.path('about', 'a', 'test', 'ns', 'tag')):
+            self.assertEqual(['objects', object_id, 'test', 'ns', 'tag'],
+                             self.resolver.rewrite(path))
+        path = ['about', 'unknown', 'test', 'ns', 'tag']
+        self.assertTrue(self.resolver.rewrite(path) is path)
+        path = ['about', 'a']
+        self.assertTrue(self.resolver.rewrite(path) is path)
+
+    def test_client_uses_ids(self):
+        self.client.resolver = self.resolver
+        self.resolver.resolve('a')
+        self.requests()
+        self.client.put(['about', 'a', 'test', 'ns', 'tag'], 1)
+        self.assertEqual(1, self.client.get('/about/a/test/ns/tag')[1])
+        path = '/objects/%s/test/ns/tag' % self.ids['a']
+        self.assertEqual([('PUT', path), ('GET', path)], self.requests())
+
+    def test_database(self):
+        directory = tempfile.mkdtemp()
+        try:
+            database = os.path.join(directory, 'ids.db')
+            resolver = fluidinfo.AboutResolver(self.client, database=database)
+            resolver.resolve_many(['a', u'caf\xe9'])
+            resolver.close()
+            resolver = fluidinfo.AboutResolver(self.client, database=database)
+            self.requests()
+            self.assertEqual(self.ids[u'caf\xe9'],
+                             resolver.resolve(u'caf\xe9'))
+            self.assertEqual([], self.requests())
+            resolver.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_needs_sqlite(self):
+        sqlite3 = fluidinfo.sqlite3
+        fluidinfo.sqlite3 = None
+        try:
+            self.assertRaises(RuntimeError, fluidinfo.Mirror, ['test/ns/tag'],
+                              client=self.client)
+            self.assertRaises(RuntimeError, fluidinfo.AboutResolver,
+                              self.client, database='resolver.db')
+            # an AboutResolver only needs it for its database
+            fluidinfo.AboutResolver(self.client)
+        finally:
+            fluidinfo.sqlite3 = sqlite3
+
+
+class TestProvisioner(FakeFluidinfoTestCase):
+
+    TREE = {
+        'test/app': {
+            'description': 'The app',
+            'permissions': {'create': {'policy': 'closed',
+                                       'exceptions': ['test']}},
+            'namespaces': {
+                'users': {
+                    'description': 'Users',
+                    'tags': {'name': {'description': 'A name'}},
+                },
+            },
+            'tags': {
+                'rating': {'description': 'A rating', 'indexed': True,
+                           'value_permissions': {
+                               'read': {'policy': 'closed',
+                                        'exceptions': ['test']}}},
+            },
+        },
+    }
+
+    def setUp(self):
+        self.set_up_client(tags=())
+
+    def test_plan_and_apply(self):
+        provisioner = fluidinfo.Provisioner(self.TREE, self.client)
+        plan = provisioner.plan()
+        # only the namespace given (and the user's namespace it's created
+        # in) is read, everything beneath it is known to be missing
+        self.assertEqual([('GET', '/namespaces/test/app'),
+                          ('GET', '/namespaces/test')], self.requests())
+        self.assertEqual([
+            '0 POST /namespaces/test {"description": "The app", '
+            '"name": "app"}',
+            '1 PUT /permissions/namespaces/test/app?action=create '
+            '{"exceptions": ["test"], "policy": "closed"}',
+            '1 POST /namespaces/test/app {"description": "Users", '
+            '"name": "users"}',
+            '1 POST /tags/test/app {"description": "A rating", '
+            '"indexed": true, "name": "rating"}',
+            '2 POST /tags/test/app/users {"description": "A name", '
+            '"indexed": false, "name": "name"}',
+            '2 PUT /permissions/tag-values/test/app/rating?action=read '
+            '{"exceptions": ["test"], "policy": "closed"}',
+        ], provisioner.describe(plan))
+        self.assertEqual(6, provisioner.apply(plan))
+        self.assertEqual('A name', self.client.get(
+            '/tags/test/app/users/name', returnDescription=True)[1][
+                'description'])
+        headers, result = self.client.get(
+            '/permissions/tag-values/test/app/rating', action='read')
+        self.assertEqual('closed', result['policy'])
+        # idempotent: the second time round there's nothing to do
+        self.requests()
+        self.assertEqual([], provisioner.plan())
+        self.assertEqual([('GET', '/namespaces/test/app'),
+                          ('GET', '/namespaces/test/app/users')],
+                         self.requests())
+        self.assertEqual(0, provisioner.apply())
+
+    def test_partial(self):
+        self.client.post('/namespaces/test', {'name': 'app',
+                                              'description': 'Old'})
+        provisioner = fluidinfo.Provisioner(self.TREE, self.client)
+        self.assertEqual([
+            '0 PUT /namespaces/test/app {"description": "The app"}',
+            '1 POST /namespaces/test/app {"description": "Users", '
+            '"name": "users"}',
+            '1 POST /tags/test/app {"description": "A rating", '
+            '"indexed": true, "name": "rating"}',
+            '2 POST /tags/test/app/users {"description": "A name", '
+            '"indexed": false, "name": "name"}',
+            '2 PUT /permissions/tag-values/test/app/rating?action=read '
+            '{"exceptions": ["test"], "policy": "closed"}',
+        ], provisioner.describe(provisioner.plan()))
+
+    def test_update(self):
+        fluidinfo.Provisioner(self.TREE, self.client).apply()
+        self.client.put('/tags/test/app/rating', {'description': 'Changed'})
+        self.client.put('/permissions/namespaces/test/app',
+                        {'policy': 'open', 'exceptions': []},
+                        action='create')
+        self.assertEqual([], fluidinfo.Provisioner(self.TREE,
+                                                   self.client).plan())
+        provisioner = fluidinfo.Provisioner(self.TREE, self.client,
+                                            update=True)
+        self.assertEqual([
+            '0 PUT /permissions/namespaces/test/app?action=create '
+            '{"exceptions": ["test"], "policy": "closed"}',
+            '0 PUT /tags/test/app/rating {"description": "A rating"}',
+        ], provisioner.describe(provisioner.plan()))
+        provisioner.apply()
+        self.assertEqual([], provisioner.plan())
+
+    def test_already_exists(self):
+        provisioner = fluidinfo.Provisioner(self.TREE, self.client)
+        plan = provisioner.plan()
+        # something else creates part of the tree in the meantime
+        self.client.post('/namespaces/test', {'name': 'app',
+                                              'description': 'The app'})
+        self.assertEqual(6, provisioner.apply(plan))
+        self.assertEqual([], provisioner.plan())
+
+    def test_missing_parents(self):
+        tree = {'test/a/b': {'tags': {'t': {'description': 'T'}}}}
+        provisioner = fluidinfo.Provisioner(tree, self.client)
+        plan = provisioner.plan()
+        self.assertEqual([
+            '0 POST /namespaces/test {"description": "", "name": "a"}',
+            '1 POST /namespaces/test/a {"description": "", "name": "b"}',
+            '2 POST /tags/test/a/b {"description": "T", "indexed": false, '
+            '"name": "t"}',
+        ], provisioner.describe(plan))
+        self.assertEqual(3, provisioner.apply(plan))
+        self.assertEqual([], provisioner.plan())
+        # given alongside its parent
+        tree = {'test/a': {'description': 'A'},
+                'test/a/b/c': {'description': 'C'}}
+        provisioner = fluidinfo.Provisioner(tree, self.client)
+        self.assertEqual([
+            '0 PUT /namespaces/test/a {"description": "A"}',
+            '1 POST /namespaces/test/a/b {"description": "C", "name": "c"}',
+        ], provisioner.describe(provisioner.plan()))
+        self.assertEqual({'test/a': {'description': 'A'},
+                          'test/a/b/c': {'description': 'C'}}, tree)
+        tree = {'test/a': {'namespaces': {'b': {'description': 'B'}}},
+                'test/a/b': {'description': 'Also B'}}
+        self.assertRaises(ValueError,
+                          fluidinfo.Provisioner(tree, self.client).plan)
+
+    def test_top_level(self):
+        # users' namespaces can't be created
+        for tree in ({'missing': {}}, {'missing/app': {}},
+                     {'missing/app/deeper': {}}):
+            self.requests()
+            provisioner = fluidinfo.Provisioner(tree, self.client)
+            self.assertRaises(ValueError, provisioner.plan)
+            self.assertEqual([], [method for method, path in self.requests()
+                                  if method != 'GET'])
+        # but an existing one can be provisioned
+        provisioner = fluidinfo.Provisioner(
+            {'test': {'tags': {'t': {'description': 'T'}}}}, self.client)
+        self.assertEqual(1, provisioner.apply())
+
+
+class TestCommandLine(FakeFluidinfoTestCase):
+
+    def setUp(self):
+        self.set_up_client(('rating', 'title'))
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_command(self, *argv):
+        stdout = StringIO.StringIO()
+        stderr = StringIO.StringIO()
+        status = fluidinfo_cli.main(['--instance', 'http://fake'] +
+                                    list(argv), self.transport, stdout,
+                                    stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def rating(self, about):
+        return self.client.get(['about', about, 'test', 'ns', 'rating'])[1]
+
+    def test_import_and_export(self):
+        lines = [json.dumps({'about': 'thing %d' % i, 'test/ns/rating': i,
+                             'test/ns/title': u'caf\xe9 %d' % i})
+                 for i in range(25)]
+        path = self.write('in.ndjson', '\n'.join(lines) + '\n\n')
+        status, out, err = self.run_command('import', path, '--batch-size',
+                                            '4', '--workers', '3')
+        self.assertEqual(0, status)
+        self.assertTrue(err.startswith('imported 25 records (50 values in '
+                                       '7 requests)'))
+        self.assertEqual(7, self.rating('thing 7'))
+        status, out, err = self.run_command('export', 'has test/ns/rating',
+                                            'test/ns/rating', 'test/ns/title')
+        self.assertEqual(0, status)
+        records = [json.loads(line) for line in out.splitlines()]
+        self.assertEqual(25, len(records))
+        by_title = dict((record['test/ns/title'], record)
+                        for record in records)
+        self.assertEqual(3, by_title[u'caf\xe9 3']['test/ns/rating'])
+        # exported records can be imported again (by id)
+        path = self.write('out.ndjson', out.replace('"test/ns/rating": 3,',
+                                                    '"test/ns/rating": 33,'))
+        self.assertEqual(0, self.run_command('--quiet', 'import', path)[0])
+        self.assertEqual(33, self.rating('thing 3'))
+
+    def test_csv(self):
+        path = self.write('in.csv', 'about,test/ns/title\n'
+                          'a,"Hello, world"\nb,caf\xc3\xa9\nc,\n')
+        status, out, err = self.run_command('import', path)
+        self.assertEqual(0, status)
+        self.assertEqual(u'caf\xe9', self.client.get(
+            ['about', 'b', 'test', 'ns', 'title'])[1])
+        self.assertEqual(u'Hello, world', self.client.get(
+            ['about', 'a', 'test', 'ns', 'title'])[1])
+
+    def test_dry_run(self):
+        path = self.write('in.ndjson', json.dumps({'about': 'x',
+                                                   'test/ns/rating': 1}))
+        status, out, err = self.run_command('import', path, '--dry-run')
+        self.assertEqual(0, status)
+        self.assertTrue(err.startswith('checked 1 records'))
+        self.assertEqual('404', self.client.get(
+            ['about', 'x', 'test', 'ns', 'rating'])[0]['status'])
+
+    def test_bad_input(self):
+        path = self.write('in.ndjson', '{"about": "x", "test/ns/rating": 1}\n'
+                          '{"test/ns/rating": 2}\n')
+        status, out, err = self.run_command('--quiet', 'import', path,
+                                            '--dry-run')
+        self.assertEqual(1, status)
+        self.assertEqual('fluidinfo: error: line 2: no id or about value\n',
+                         err)
+
+    def test_checkpoint(self):
+        lines = [json.dumps({'about': str(i), 'test/ns/rating': i})
+                 for i in range(10)]
+        path = self.write('in.ndjson', '\n'.join(lines))
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('6\n')
+        status, out, err = self.run_command('import', path, '--checkpoint',
+                                            checkpoint, '--batch-size', '1',
+                                            '--workers', '2')
+        self.assertEqual(0, status)
+        self.assertTrue('imported 4 records' in err)
+        self.assertTrue('skipped 6 already imported' in err)
+        self.assertEqual('404', self.client.get(
+            ['about', '5', 'test', 'ns', 'rating'])[0]['status'])
+        self.assertEqual(6, self.rating('6'))
+        with open(checkpoint) as f:
+            self.assertEqual('10\n', f.read())
+        # a failed batch stops the import leaving the checkpoint where it was
+        path = self.write('in.ndjson', '\n'.join(
+            lines + [json.dumps({'about': 'x', 'test/ns/missing': 1})]))
+        status, out, err = self.run_command('--quiet', 'import', path,
+                                            '--checkpoint', checkpoint)
+        self.assertEqual(1, status)
+        with open(checkpoint) as f:
+            self.assertEqual('10\n', f.read())
+
+    def test_checkpoint_past_the_end(self):
+        lines = [json.dumps({'about': str(i), 'test/ns/rating': i})
+                 for i in range(3)]
+        path = self.write('in.ndjson', '\n'.join(lines))
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        with open(checkpoint, 'w') as f:
+            f.write('5\n')
+        status, out, err = self.run_command('import', path, '--checkpoint',
+                                            checkpoint)
+        self.assertEqual(0, status)
+        self.assertTrue('imported 0 records' in err)
+        self.assertTrue('skipped 3 already imported' in err)
+        self.assertEqual('404', self.client.get(
+            ['about', '0', 'test', 'ns', 'rating'])[0]['status'])
+        with open(checkpoint) as f:
+            self.assertEqual('5\n', f.read())
+
+
+class TestStreamingParser(unittest.TestCase):
+    """
+    Checks the incremental parser used by iter_values no matter how the
+    response is split into chunks.
+    """
+
+    document = json.dumps({
+        'results': {
+            'id': {
+                '05eee31e-fbd1-43cc-9500-0469707a9bc3': {
+                    'fluiddb/about': {'value': u'C\xfc\xe4h "quoted"'},
+                    'test/rating': {'value': 12345},
+                },
+                'a9bc3d2d-5fc7-4d3e-9ef0-0ad03a6e9a03': {
+                    'test/rating': {'value': -1.5e3},
+                    'test/tags': {'value': ['a', 'b']},
+                    'test/page': {'value-type': 'text/html', 'size': 10},
+                },
+            },
+            'other': [1, 2, {'id': 3}],
+        },
+    }, indent=1)
+
+    def chunks(self, size):
+        return [self.document[i:i + size]
+                for i in range(0, len(self.document), size)]
+
+    def test_all_chunk_sizes(self):
+        expected = json.loads(self.document)['results']['id']
+        for size in (1, 2, 3, 7, 64, len(self.document)):
+            items = list(fluidinfo._iter_json_items(self.chunks(size),
+                                                    ['results', 'id']))
+            self.assertEqual(2, len(items))
+            self.assertEqual(expected, dict(items))
+
+    def test_empty_results(self):
+        items = fluidinfo._iter_json_items(['{"results": {"id": {}}}'],
+                                           ['results', 'id'])
+        self.assertEqual([], list(items))
+
+    def test_truncated_document(self):
+        items = fluidinfo._iter_json_items([self.document[:-20]],
+                                           ['results', 'id'])
+        self.assertRaises(ValueError, list, items)
+
+
+class TestValueTable(FakeFluidinfoTestCase):
+
+    TAGS = ['fluiddb/about', 'test/ns/rating', 'test/ns/set',
+            'test/ns/page']
+
+    def setUp(self):
+        self.set_up_client(('rating', 'set', 'page'))
+        for i in range(20):
+            about = 'thing %d' % i
+            self.client.put(['about', about, 'test', 'ns', 'rating'], i)
+            if i % 2:
+                self.client.put(['about', about, 'test', 'ns', 'set'],
+                                ['a', u'caf\xe9'])
+        self.client.put(['about', 'thing 3', 'test', 'ns', 'page'],
+                        '<p/>', 'text/html')
+        self.table = self.client.values_table('has test/ns/rating',
+                                              self.TAGS)
+
+    def test_to_dict(self):
+        headers, result = self.client.get('/values', tags=self.TAGS,
+                                          query='has test/ns/rating')
+        self.assertEqual(20, len(self.table))
+        self.assertEqual(result, self.table.to_dict())
+        self.assertEqual(result, fluidinfo.ValueTable.from_result(
+            result).to_dict())
+        chunks = json.dumps(result)
+        table = fluidinfo.ValueTable.from_chunks(
+            chunks[i:i + 10] for i in range(0, len(chunks), 10))
+        self.assertEqual(result, table.to_dict())
+        self.assertEqual(set(result['results']['id']), set(table.ids()))
+
+    def test_lookups(self):
+        row = self.table.get_by_about('thing 3')
+        self.assertEqual(3, row['test/ns/rating'])
+        self.assertEqual([u'a', u'caf\xe9'], row['test/ns/set'])
+        self.assertEqual({'value-type': 'text/html', 'size': 4},
+                         row['test/ns/page'])
+        self.assertTrue(row is not None and
+                        self.table.get(row.id).index == row.index)
+        row = self.table.get_by_about(u'thing 4')
+        self.assertFalse('test/ns/set' in row)
+        self.assertRaises(KeyError, lambda: row['test/ns/set'])
+        self.assertEqual('none', row.get('test/ns/set', 'none'))
+        self.assertEqual(None, self.table.get_by_about('nothing'))
+        self.assertEqual(None, self.table.get(str(uuid.uuid4())))
+        self.assertEqual(row.id, self.table[row.index].id)
+        self.assertRaises(IndexError, lambda: self.table[20])
+        self.assertRaises(ValueError, fluidinfo.ValueTable().get_by_about,
+                          'x')
+
+    def test_scans(self):
+        self.assertEqual(sum(range(20)),
+                         sum(self.table.values('test/ns/rating')))
+        ratings = dict(self.table.scan('test/ns/rating'))
+        self.assertEqual(3, ratings[self.table.get_by_about('thing 3').id])
+        self.assertEqual(10, len(list(self.table.values('test/ns/set'))))
+        self.assertEqual([], list(self.table.scan('test/ns/unknown')))
+
+    def test_compact(self):
+        # equal strings are only stored once
+        sets = self.table._columns['test/ns/set']
+        members = [value for value in sets if value is not fluidinfo._MISSING]
+        self.assertTrue(members[0][1] is members[1][1])
+        self.assertEqual(20 * 16, len(self.table._ids))
+        self.assertRaises(ValueError, self.table.append, 'not an id', {})
+
+
+class FakeResponse(object):
+    """
+    Just enough of a requests response for FluidinfoClient.call.
+    """
+
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode('utf-8')
+        self.encoding = None
+        self.headers = requests.structures.CaseInsensitiveDict(
+            headers or {'content-type': 'application/json'})
+
+
+class FakePool(object):
+    """
+    A stand-in for ConnectionPool whose sessions record the requests made and
+    answer them with the responses queued in the pool.
+    """
+
+    errors = fluidinfo.ConnectionPool.errors
+    retryable_errors = fluidinfo.ConnectionPool.retryable_errors
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def session(self, base_url):
+        return self
+
+    def request(self, method, url, data=None, headers=None, **kw):
+        self.requests.append((method, url, data, headers))
+        return self.responses.pop(0)
+
+
+class TestLazyResult(unittest.TestCase):
+
+    def test_decoded_on_first_use(self):
+        result = fluidinfo.LazyResult('{"id": "1", "a": [1, 2]}',
+                                      'application/json')
+        self.assertEqual('{"id": "1", "a": [1, 2]}', result.raw)
+        self.assertEqual('1', result['id'])
+        self.assertTrue('a' in result)
+        self.assertEqual(2, len(result))
+        self.assertEqual({'id': '1', 'a': [1, 2]}, result)
+        self.assertTrue(result.value is result.value)
+
+    def test_text(self):
+        result = fluidinfo.LazyResult('caf\xc3\xa9', 'text/plain')
+        self.assertEqual(u'caf\xe9', result.value)
+        result = fluidinfo.LazyResult('', 'application/json')
+        self.assertEqual(u'', result.value)
+
+    def test_call(self):
+        value = {'content-type': 'application/vnd.fluiddb.value+json'}
+        client = fluidinfo.FluidinfoClient(
+            pool=FakePool(FakeResponse(200, '[1, 2]', value),
+                          FakeResponse(200, '[1, 2]', value)))
+        headers, result = client.get('/about/foo/test/bar', decode=False)
+        self.assertTrue(isinstance(result, fluidinfo.LazyResult))
+        self.assertEqual('[1, 2]', result.raw)
+        self.assertEqual([1, 2], result.value)
+        # decode isn't passed on as a query-string argument
+        self.assertFalse('decode' in client.pool.requests[0][1])
+        headers, result = client.get('/about/foo/test/bar')
+        self.assertEqual([1, 2], result)
+
+    def test_cached(self):
+        value = {'content-type': 'application/vnd.fluiddb.value+json'}
+        client = fluidinfo.FluidinfoClient(
+            pool=FakePool(FakeResponse(200, '[1, 2]', value)),
+            cache=fluidinfo.ResponseCache())
+        client.get('/about/foo/test/bar', decode=False)
+        self.assertEqual([1, 2], client.get('/about/foo/test/bar')[1])
+        result = client.get('/about/foo/test/bar', decode=False)[1]
+        self.assertEqual([1, 2], result.value)
+        self.assertEqual(1, len(client.pool.requests))
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def client(self, *responses):
+        return fluidinfo.FluidinfoClient(fluidinfo.SANDBOX,
+                                         pool=FakePool(*responses),
+                                         cache=fluidinfo.ResponseCache())
+
+    def test_fresh_responses_served_from_cache(self):
+        client = self.client(FakeResponse(200, '{"id": "1"}'))
+        self.assertEqual({'id': '1'}, client.get('/users/test')[1])
+        headers, result = client.get('/users/test')
+        self.assertEqual('200', headers['status'])
+        self.assertEqual({'id': '1'}, result)
+        self.assertEqual(1, len(client.pool.requests))
+
+    def test_query_args_are_part_of_the_key(self):
+        client = self.client(FakeResponse(200, '{"id": "1"}'),
+                             FakeResponse(200, '{"id": "2"}'))
+        client.get('/users/test')
+        self.assertEqual({'id': '2'},
+                         client.get('/users/test', returnDescription=True)[1])
+        self.assertEqual(2, len(client.pool.requests))
+
+    def test_stale_responses_revalidated(self):
+        etag = {'content-type': 'application/json', 'etag': '"abc"'}
+        client = self.client(FakeResponse(200, '{"id": "1"}', etag),
+                             FakeResponse(304, '', {'content-type': ''}))
+        client.cache.ttl = 0
+        client.get('/users/test')
+        self.assertEqual({'id': '1'}, client.get('/users/test')[1])
+        headers = client.pool.requests[1][3]
+        self.assertEqual('"abc"', headers['If-None-Match'])
+
+    def test_writes_invalidate(self):
+        value = {'content-type': 'application/vnd.fluiddb.value+json'}
+        client = self.client(FakeResponse(200, '1', value),
+                             FakeResponse(204, '', {'content-type': ''}),
+                             FakeResponse(200, '2', value))
+        path = '/about/foo/test/bar'
+        self.assertEqual(1, client.get(path)[1])
+        client.put(path, 2)
+        self.assertEqual(2, client.get(path)[1])
+        self.assertEqual(3, len(client.pool.requests))
+
+    def test_credentials_are_part_of_the_key(self):
+        client = self.client(FakeResponse(200, '{"id": "1"}'),
+                             FakeResponse(200, '{"id": "2"}'))
+        client.login('alice', 'secret')
+        client.get('/users/test')
+        client.login('bob', 'secret')
+        self.assertEqual({'id': '2'}, client.get('/users/test')[1])
+        self.assertEqual(2, len(client.pool.requests))
+
+    def test_writes_invalidate_other_paths_to_the_tag(self):
+        value = {'content-type': 'application/vnd.fluiddb.value+json'}
+        client = self.client(FakeResponse(200, '1', value),
+                             FakeResponse(200, '1', value),
+                             FakeResponse(204, '', {'content-type': ''}),
+                             FakeResponse(200, '2', value),
+                             FakeResponse(200, '1', value))
+        client.get('/about/foo/test/bar')
+        client.get('/about/foo/test/other')
+        client.put('/objects/1234/test/bar', 2)
+        self.assertEqual(2, client.get('/about/foo/test/bar')[1])
+        # values of other tags are left alone
+        self.assertEqual(1, client.get('/about/foo/test/other')[1])
+        self.assertEqual(4, len(client.pool.requests))
+
+    def test_lru_eviction(self):
+        cache = fluidinfo.ResponseCache(max_entries=2)
+        cache.store('GET', 'a', {}, 1)
+        cache.store('GET', 'b', {}, 2)
+        cache.get('GET', 'a')
+        cache.store('GET', 'c', {}, 3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(None, cache.get('GET', 'b'))
+        self.assertEqual(1, cache.get('GET', 'a').result)
+
+    def test_per_entry_ttl(self):
+        cache = fluidinfo.ResponseCache(
+            ttl=lambda url, headers: url.endswith('/short') and -1 or 60)
+        cache.store('GET', '/short', {}, 1)
+        cache.store('GET', '/long', {}, 1)
+        self.assertFalse(cache.get('GET', '/short').is_fresh())
+        self.assertTrue(cache.get('GET', '/long').is_fresh())
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    class SlowPool(FakePool):
+
+        def request(self, *args, **kw):
+            time.sleep(0.1)
+            if self.responses[0] is None:
+                raise requests.exceptions.ConnectionError('refused')
+            return FakePool.request(self, *args, **kw)
+
+    def get_concurrently(self, clients, path):
+        results = [None] * len(clients)
+
+        def get(i):
+            try:
+                results[i] = clients[i].get(path)
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=get, args=(i,))
+                   for i in range(len(clients))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_requests_share_a_call(self):
+        pool = self.SlowPool(FakeResponse(200, '{"id": "1"}'))
+        events = []
+        flight = fluidinfo.SingleFlight()
+        client = fluidinfo.FluidinfoClient(fluidinfo.SANDBOX, pool=pool,
+                                           single_flight=flight,
+                                           hooks=[events.append])
+        results = self.get_concurrently([client] * 5, '/users/test')
+        self.assertEqual(1, len(pool.requests))
+        for headers, result in results:
+            self.assertEqual('200', headers['status'])
+            self.assertEqual({'id': '1'}, result)
+        key = ('GET', fluidinfo.SANDBOX + '/users/test')
+        self.assertEqual(1, flight.calls[key])
+        self.assertEqual(4, flight.coalesced[key])
+        self.assertEqual(4, len([e for e in events if e.coalesced]))
+        # once it's finished the next request is sent
+        pool.responses.append(FakeResponse(200, '{"id": "2"}'))
+        self.assertEqual({'id': '2'}, client.get('/users/test')[1])
+
+    def test_keyed_on_credentials(self):
+        pool = self.SlowPool(*[FakeResponse(200, '{}') for i in range(2)])
+        flight = fluidinfo.SingleFlight()
+        alice = fluidinfo.FluidinfoClient(pool=pool, single_flight=flight,
+                                          username='alice', password='x')
+        bob = fluidinfo.FluidinfoClient(pool=pool, single_flight=flight,
+                                        username='bob', password='x')
+        self.get_concurrently([alice, bob, alice, bob], '/users/test')
+        self.assertEqual(2, len(pool.requests))
+
+    def test_errors_shared(self):
+        pool = self.SlowPool(None)
+        client = fluidinfo.FluidinfoClient(
+            pool=pool, single_flight=fluidinfo.SingleFlight())
+        results = self.get_concurrently([client] * 3, '/users/test')
+        for result in results:
+            self.assertTrue(isinstance(result,
+                                       requests.exceptions.ConnectionError))
+
+    def test_writes_not_coalesced(self):
+        pool = self.SlowPool(*[FakeResponse(204) for i in range(3)])
+        client = fluidinfo.FluidinfoClient(
+            pool=pool, single_flight=fluidinfo.SingleFlight())
+        threads = [threading.Thread(target=client.put,
+                                    args=('/about/foo/test/bar', 1))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(pool.requests))
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_request_rate(self):
+        limiter = fluidinfo.RateLimiter(rate=100, burst=0.01)
+        started = time.time()
+        waited = sum(limiter.acquire() for i in range(11))
+        self.assertTrue(time.time() - started >= 0.09)
+        self.assertTrue(waited >= 0.09)
+
+    def test_shared_by_threads(self):
+        limiter = fluidinfo.RateLimiter(rate=100, burst=0.01)
+        threads = [threading.Thread(target=limiter.acquire)
+                   for i in range(11)]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(time.time() - started >= 0.09)
+
+    def test_byte_rate(self):
+        limiter = fluidinfo.RateLimiter(byte_rate=10000)
+        self.assertEqual(0, limiter.acquire(10000))
+        limiter.consume(1000)
+        self.assertEqual(0, limiter.acquire())
+        self.assertTrue(limiter.acquire(500) >= 0.1)
+
+    def test_throttled(self):
+        limiter = fluidinfo.RateLimiter(rate=100, min_fraction=0.2,
+                                        recovery_time=1000)
+        limiter.throttled()
+        self.assertAlmostEqual(50, limiter.rate, 0)
+        # the same burst of throttled responses
+        limiter.throttled()
+        self.assertAlmostEqual(50, limiter.rate, 0)
+        self.assertEqual(1, limiter.throttles)
+        limiter._throttled_at -= 1
+        limiter.throttled()
+        limiter._throttled_at -= 1
+        limiter.throttled()
+        self.assertAlmostEqual(20, limiter.rate, 0)
+        limiter.throttled(retry_after=0.1)
+        self.assertTrue(limiter.acquire() >= 0.09)
+
+    def test_recovers(self):
+        limiter = fluidinfo.RateLimiter(rate=100, recovery_time=0.1)
+        limiter.throttled()
+        time.sleep(0.1)
+        limiter.acquire()
+        self.assertEqual(100, limiter.rate)
+
+    def test_client(self):
+        pool = FakePool(FakeResponse(429, '', {'content-type': 'text/html',
+                                               'retry-after': '0'}),
+                        FakeResponse(200, '{}'))
+        events = []
+        limiter = fluidinfo.RateLimiter(rate=1000)
+        client = fluidinfo.FluidinfoClient(pool=pool, limiter=limiter,
+                                           hooks=[events.append])
+        self.assertEqual('429', client.get('/users/test')[0]['status'])
+        self.assertEqual(1, limiter.throttles)
+        self.assertTrue(limiter.rate < 1000)
+        client.get('/users/test')
+        self.assertTrue('queue' in events[1].timings)
+
+    def test_module_limiter(self):
+        limiter = fluidinfo.RateLimiter(rate=10)
+        fluidinfo.rate_limiters[fluidinfo.instance] = limiter
+        try:
+            self.assertTrue(fluidinfo.default_client.limiter is limiter)
+        finally:
+            del fluidinfo.rate_limiters[fluidinfo.instance]
+
+
+class TestHooks(unittest.TestCase):
+
+    def test_event(self):
+        events = []
+        pool = FakePool(FakeResponse(200, '{"id": "1"}'))
+        client = fluidinfo.FluidinfoClient(pool=pool, hooks=[events.append])
+        client.put(['about', 'a/b', 'test', 'foo'], 'bar')
+        self.assertEqual(1, len(events))
+        event = events[0]
+        self.assertEqual('PUT', event.method)
+        self.assertEqual('/about/*/test/foo', event.path)
+        self.assertEqual(200, event.status)
+        self.assertEqual(5, event.bytes_sent)
+        self.assertEqual(11, event.bytes_received)
+        self.assertEqual(['decode', 'encode', 'transfer', 'ttfb'],
+                         sorted(event.timings))
+        self.assertFalse(event.cached)
+
+    def test_cached_event(self):
+        events = []
+        client = fluidinfo.FluidinfoClient(
+            pool=FakePool(FakeResponse(200, '{"id": "1"}')),
+            cache=fluidinfo.ResponseCache(), hooks=[events.append])
+        client.get('/users/test')
+        client.get('/users/test')
+        self.assertEqual([False, True], [event.cached for event in events])
+
+    def test_error_event(self):
+        events = []
+        client = fluidinfo.FluidinfoClient(pool=FakePool(),
+                                           hooks=[events.append])
+        self.assertRaises(IndexError, client.get, '/users/test')
+        self.assertTrue(isinstance(events[0].error, IndexError))
+        self.assertEqual(None, events[0].status)
+
+    def test_streamed_events(self):
+        events = []
+        client = fluidinfo.FluidinfoClient(
+            'http://fake', transport=fakefluidinfo.FakeTransport(),
+            hooks=[events.append])
+        client.post('/tags/test', {'name': 'foo', 'description': 'foo',
+                                   'indexed': False})
+        client.put(['about', 'a', 'test', 'foo'], 'bar')
+        del events[:]
+        self.assertEqual(1, len(list(client.iter_values('has test/foo',
+                                                        ['test/foo']))))
+        headers, content = client.download(['about', 'a', 'test', 'foo'])
+        self.assertEqual(['/values', '/about/*/test/foo'],
+                         [event.path for event in events])
+        self.assertEqual([200, 200], [event.status for event in events])
+        self.assertEqual(len(content), events[1].bytes_received)
+        for event in events:
+            self.assertEqual(['encode', 'transfer', 'ttfb'],
+                             sorted(event.timings))
+
+    def test_aggregators(self):
+        counter = fluidinfo.CallCounter()
+        histogram = fluidinfo.LatencyHistogram(buckets=(0.1, 1.0))
+        for duration, status in ((0.05, 200), (0.5, 200), (5, 404)):
+            event = fluidinfo.RequestEvent('GET', '/users/test', None)
+            event.status = status
+            event.timings['ttfb'] = duration
+            counter(event)
+            histogram(event)
+        self.assertEqual({('GET', '/users/test', 200): 2,
+                          ('GET', '/users/test', 404): 1}, counter.counts)
+        self.assertEqual([1, 1, 1],
+                         histogram.histograms[('GET', '/users/test')])
+        self.assertEqual(1.0, histogram.percentile('GET', '/users/test', 50))
+        self.assertEqual(None, histogram.percentile('GET', '/users/test', 99))
+
+    def test_path_template(self):
+        self.assertEqual('/objects/*/test/foo',
+                         fluidinfo.path_template('/objects/1234/test/foo'))
+        self.assertEqual('/about/*',
+                         fluidinfo.path_template(['about', 'a/b']))
+        self.assertEqual('/users/test',
+                         fluidinfo.path_template('/users/test'))
+
+
+class TestFakeFluidinfo(unittest.TestCase):
+    """
+    Round trips through a real HTTP connection to the in-process stand-in
+    for Fluidinfo.
+    """
+
+    def setUp(self):
+        self.server = fakefluidinfo.FakeFluidinfoServer()
+        self.client = fluidinfo.FluidinfoClient(self.server.start(),
+                                                USERNAME, PASSWORD)
+        self.client.post('/namespaces/test', {'name': 'ns',
+                                              'description': 'a namespace'})
+        self.client.post('/tags/test/ns', {'name': 'tag', 'indexed': False,
+                                           'description': 'a tag'})
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.server.stop()
+
+    def test_primitive_values(self):
+        path = ['about', 'a/b', 'test', 'ns', 'tag']
+        for primitive in [1, 1.1, u'foo', ['a', 'b', u'c'], True, None]:
+            result = self.client.put(path, primitive)
+            self.assertEqual('204', result[0]['status'])
+            result = self.client.get(path)
+            self.assertEqual('application/vnd.fluiddb.value+json',
+                             result[0]['content-type'])
+            self.assertEqual(primitive, result[1])
+
+    def test_opaque_values(self):
+        path = '/about/foo/test/ns/tag'
+        self.client.put(path, '<p>Hello</p>', 'text/html')
+        headers, content = self.client.get(path)
+        self.assertEqual('text/html', headers['content-type'])
+        self.assertEqual('<p>Hello</p>', content)
+
+    def test_streamed_uploads(self):
+        path = '/about/foo/test/ns/tag'
+        data = ''.join(chr(i % 256) for i in range(100000))
+        source = tempfile.TemporaryFile()
+        source.write(data)
+        source.flush()
+        source.seek(0)
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        bodies = [source, mapped, memoryview(bytearray(data)),
+                  bytearray(data), iter([data[:10], data[10:]])]
+        for body in bodies:
+            headers, content = self.client.put(path, body,
+                                               'application/pdf')
+            self.assertEqual('204', headers['status'])
+            headers, content = self.client.download(path)
+            self.assertEqual('application/pdf', headers['content-type'])
+            self.assertEqual(data, content)
+        mapped.close()
+        source.close()
+
+    def test_download(self):
+        path = '/about/foo/test/ns/tag'
+        self.client.put(path, 'x' * 100000, 'application/octet-stream')
+        out = StringIO.StringIO()
+        headers, written = self.client.download(path, out, chunk_size=1000)
+        self.assertEqual(100000, written)
+        self.assertEqual('x' * 100000, out.getvalue())
+        out = bytearray()
+        self.client.download(path, out)
+        self.assertEqual('x' * 100000, str(out))
+        self.assertRaises(fluidinfo.FluidinfoError, self.client.download,
+                          '/about/bar/test/ns/tag')
+
+    def test_values(self):
+        for i in range(3):
+            self.client.put('/about/%d/test/ns/tag' % i, i)
+        headers, content = self.client.get('/values',
+            tags=['fluiddb/about', 'test/ns/tag'], query='test/ns/tag > 0')
+        self.assertEqual('200', headers['status'])
+        values = sorted(tags['test/ns/tag']['value']
+                        for tags in content['results']['id'].values())
+        self.assertEqual([1, 2], values)
+        items = list(self.client.iter_values('has test/ns/tag',
+                                             ['fluiddb/about']))
+        self.assertEqual(3, len(items))
+
+    def test_errors(self):
+        headers, content = self.client.get('/users/nobody')
+        self.assertEqual('404', headers['status'])
+        self.assertEqual('NoSuchUser', headers['x-fluiddb-error-class'])
+
+
+class TestTransports(unittest.TestCase):
+
+    def test_fake_transport(self):
+        transport = fakefluidinfo.FakeTransport()
+        client = fluidinfo.FluidinfoClient('http://fake', 'test', 'test',
+                                           transport=transport)
+        self.assertTrue(client.pool is transport)
+        client.post('/namespaces/test', {'name': 'ns', 'description': 'ns'})
+        headers, result = client.post('/tags/test/ns',
+                                      {'name': 'tag', 'description': 'tag',
+                                       'indexed': False})
+        self.assertEqual('201', headers['status'])
+        path = ['about', 'a/b', 'test', 'ns', 'tag']
+        self.assertEqual('204', client.put(path, [u'x', u'y'])[0]['status'])
+        self.assertEqual([u'x', u'y'], client.get(path)[1])
+        client.put(path, bytearray('<p/>'), 'text/html')
+        headers, result = client.get(path)
+        self.assertEqual('text/html', headers['Content-Type'])
+        self.assertEqual(u'<p/>', result)
+        self.assertEqual('404', client.get('/nothing')[0]['status'])
+
+    def test_transport_response(self):
+        response = fluidinfo.TransportResponse(
+            200, {'Content-Type': 'text/plain; charset=latin-1'}, 'caf\xe9')
+        self.assertEqual('latin-1', response.encoding)
+        self.assertEqual(u'caf\xe9', response.text)
+        self.assertEqual(['ca', 'f\xe9'], list(response.iter_content(2)))
+        response.headers['status'] = '200'
+        self.assertEqual('200', response.headers.copy()['Status'])
+        self.assertTrue('content-TYPE' in response.headers)
+
+    def test_read_body(self):
+        self.assertEqual(None, fluidinfo.read_body(None))
+        self.assertEqual('abc', fluidinfo.read_body('abc'))
+        self.assertEqual('abc', fluidinfo.read_body(iter(['a', 'bc'])))
+        self.assertEqual('abc', fluidinfo.read_body(StringIO.StringIO('abc')))
+        for data in (bytearray('abc'), memoryview(bytearray('abc'))):
+            reader = fluidinfo._BufferReader(data)
+            self.assertEqual('abc', fluidinfo.read_body(reader))
+
+
+class TestAppEngine(unittest.TestCase):
+    """
+    Stands in for App Engine's urlfetch module if the SDK isn't installed so
+    that gae_fluidinfo can be imported.
+    """
+
+    MODULES = ('google', 'google.appengine', 'google.appengine.api',
+               'google.appengine.api.urlfetch', 'gae_fluidinfo')
+
+    def setUp(self):
+        self.modules = dict((name, sys.modules.get(name))
+                            for name in self.MODULES)
+        try:
+            import google.appengine.api.urlfetch
+        except ImportError:
+            for name in self.MODULES[:-1]:
+                sys.modules[name] = types.ModuleType(name)
+            urlfetch = sys.modules['google.appengine.api.urlfetch']
+            urlfetch.Error = type('Error', (Exception,), {})
+            urlfetch.DownloadError = type('DownloadError', (urlfetch.Error,),
+                                          {})
+            sys.modules['google.appengine.api'].urlfetch = urlfetch
+        import gae_fluidinfo
+        self.gae_fluidinfo = gae_fluidinfo
+        self.client = gae_fluidinfo.default_client
+        self.client.transport = fakefluidinfo.FakeTransport()
+        gae_fluidinfo.instance = 'http://fake'
+
+    def tearDown(self):
+        for name, module in self.modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+    def test_module_client_call(self):
+        headers, result = self.client.call('POST', '/namespaces/test',
+                                           {'name': 'ns',
+                                            'description': 'ns'})
+        self.assertEqual('201', headers['status'])
+        headers, result = self.client.call('GET', ['namespaces', 'test', 'ns'],
+                                           returnDescription=True)
+        self.assertEqual(u'ns', result['description'])
+        future = self.client.call('GET', '/namespaces/test/ns', async=True)
+        self.assertEqual('200', future.result(5)[0]['status'])
+
+
+class TestCompression(FakeFluidinfoTestCase):
+
+    def setUp(self):
+        self.compression = fluidinfo.Compression(threshold=256)
+        self.set_up_client(compression=self.compression)
+        self.values = dict((str(i), u'value %d' % i) for i in range(100))
+        for about, value in self.values.items():
+            self.client.put(['about', about, 'test', 'ns', 'tag'], value)
+
+    def test_compressed_responses(self):
+        headers, result = self.client.get('/values', tags=['test/ns/tag'],
+                                          query='has test/ns/tag')
+        self.assertEqual('gzip', headers['content-encoding'])
+        self.assertEqual(100, len(result['results']['id']))
+        self.assertEqual(1, self.compression.responses_compressed)
+        self.assertTrue(self.compression.received_saved > 0)
+        # small responses aren't compressed
+        headers, result = self.client.get(['about', '1', 'test', 'ns', 'tag'])
+        self.assertFalse('content-encoding' in headers)
+        self.assertEqual(1, self.compression.responses_compressed)
+
+    def test_streamed_responses(self):
+        values = dict((tags['test/ns/tag']['value'], object_id)
+                      for object_id, tags in self.client.iter_values(
+                          'has test/ns/tag', ['test/ns/tag'], chunk_size=7))
+        self.assertEqual(sorted(self.values.values()), sorted(values))
+        self.assertEqual(1, self.compression.responses_compressed)
+        saved = self.compression.received_saved
+        self.assertTrue(saved > 0)
+        out = StringIO.StringIO()
+        self.client.download('/values', out, chunk_size=7, tag='test/ns/tag',
+                             query='has test/ns/tag')
+        self.assertEqual(100, len(json.loads(out.getvalue())['results']['id']))
+        self.assertEqual(2 * saved, self.compression.received_saved)
+
+    def test_compressed_requests(self):
+        path = ['about', 'set', 'test', 'ns', 'tag']
+        members = [u'member %d' % i for i in range(100)]
+        self.client.put(path, members)
+        self.assertEqual(1, self.compression.requests_compressed)
+        self.assertTrue(self.compression.sent_saved > 0)
+        self.assertEqual(members, self.client.get(path)[1])
+        # small and opaque bodies are sent as they are
+        self.client.put(path, u'small')
+        self.client.put(path, 'x' * 1000, 'text/plain')
+        self.assertEqual(1, self.compression.requests_compressed)
+        self.assertEqual(self.compression.sent_saved +
+                         self.compression.received_saved,
+                         self.compression.saved)
+
+    def test_off_by_default(self):
+        client = fluidinfo.FluidinfoClient('http://fake',
+                                           transport=self.transport)
+        client.put(['about', 'set', 'test', 'ns', 'tag'], ['x'] * 1000)
+        self.assertEqual(0, client.compression.requests_compressed)
+
+    def test_deflate(self):
+        data = 'hello ' * 100
+        for compressed in (zlib.compress(data),
+                           zlib.compress(data)[2:-4]):
+            response = fluidinfo.TransportResponse(
+                200, {'Content-Encoding': 'deflate'}, compressed)
+            self.assertEqual(data, ''.join(response.iter_content(5)))
+            self.assertEqual(len(compressed), response.bytes_read)
+
+    def test_http(self):
+        server = fakefluidinfo.FakeFluidinfoServer(self.transport.fake)
+        client = fluidinfo.FluidinfoClient(server.start(),
+                                           compression=self.compression)
+        try:
+            values = list(client.iter_values('has test/ns/tag',
+                                             ['test/ns/tag']))
+            self.assertEqual(100, len(values))
+            self.assertEqual(1, self.compression.responses_compressed)
+            self.assertTrue(self.compression.received_saved > 0)
+            client.put(['about', 'set', 'test', 'ns', 'tag'], ['x'] * 1000)
+            self.assertEqual(['x'] * 1000, client.get(
+                ['about', 'set', 'test', 'ns', 'tag'])[1])
+            self.assertEqual(2, self.compression.responses_compressed)
+        finally:
+            client.pool.close()
+            server.stop()
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        # don't actually wait between attempts
+        self.sleep = time.sleep
+        time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        time.sleep = self.sleep
+
+    def test_server_errors_retried(self):
+        pool = FakePool(FakeResponse(502), FakeResponse(500),
+                        FakeResponse(200, '{"id": "1"}'))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        headers, result = client.get('/users/test')
+        self.assertEqual('200', headers['status'])
+        self.assertEqual(3, len(pool.requests))
+
+    def test_gives_up(self):
+        pool = FakePool(*[FakeResponse(503) for i in range(3)])
+        client = fluidinfo.FluidinfoClient(
+            pool=pool, retry=fluidinfo.RetryPolicy(max_retries=2))
+        self.assertEqual('503', client.get('/users/test')[0]['status'])
+        self.assertEqual(3, len(pool.requests))
+
+    def test_streamed_responses(self):
+        def response(status, content=''):
+            return fluidinfo.TransportResponse(
+                status, {'content-type': 'application/json'}, content)
+        pool = FakePool(response(503), response(200, '{"results": {"id": '
+                                                     '{"1": {}}}}'))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        self.assertEqual([('1', {})],
+                         list(client.iter_values('has test/foo', [])))
+        self.assertEqual(2, len(pool.requests))
+        pool.responses = [response(502), response(200, '<p/>')]
+        headers, content = client.download('/about/foo/test/tag')
+        self.assertEqual('<p/>', content)
+        self.assertEqual(4, len(pool.requests))
+
+    def test_streamed_bodies(self):
+        pool = FakePool(FakeResponse(500), FakeResponse(204))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        body = StringIO.StringIO('<html/>')
+        client.put('/about/foo/test/tag', body, 'text/html')
+        self.assertEqual(2, len(pool.requests))
+        self.assertEqual(0, body.tell())
+        # an iterator can't be rewound so is only sent once
+        pool.responses = [FakeResponse(500), FakeResponse(204)]
+        headers, content = client.put('/about/foo/test/tag',
+                                      iter(['<html/>']), 'text/html')
+        self.assertEqual('500', headers['status'])
+        self.assertEqual(3, len(pool.requests))
+
+    def test_post_not_retried(self):
+        pool = FakePool(FakeResponse(500), FakeResponse(201, '{}'))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        self.assertEqual('500', client.post('/objects', {})[0]['status'])
+        # unless asked to
+        client.retry = {'POST': fluidinfo.RetryPolicy(methods=['POST'])}
+        pool.responses = [FakeResponse(500), FakeResponse(201, '{}')]
+        self.assertEqual('201', client.post('/objects', {})[0]['status'])
+
+    def test_connection_errors_retried(self):
+        class FailingPool(FakePool):
+            def request(self, *args, **kw):
+                if not self.requests:
+                    self.requests.append(args)
+                    raise requests.exceptions.ConnectionError('refused')
+                return FakePool.request(self, *args, **kw)
+        pool = FailingPool(FakeResponse(200, '{}'))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        self.assertEqual('200', client.get('/users/test')[0]['status'])
+        client.retry = fluidinfo.RetryPolicy(connection_errors=False)
+        pool.requests = []
+        self.assertRaises(requests.exceptions.ConnectionError, client.get,
+                          '/users/test')
+
+    def test_retry_after(self):
+        waits = []
+        time.sleep = waits.append
+        headers = {'content-type': 'text/html', 'retry-after': '5'}
+        pool = FakePool(FakeResponse(503, '', headers), FakeResponse(200, '{}'),
+                        FakeResponse(503, '', {'content-type': 'text/html',
+                                               'retry-after': '600'}))
+        client = fluidinfo.FluidinfoClient(pool=pool,
+                                           retry=fluidinfo.RetryPolicy())
+        self.assertEqual('200', client.get('/users/test')[0]['status'])
+        self.assertTrue(waits[0] >= 5)
+        # too long a wait so the 503 is returned
+        self.assertEqual('503', client.get('/users/test')[0]['status'])
+
+    def test_decorrelated_jitter(self):
+        policy = fluidinfo.RetryPolicy(base=1, cap=10)
+        delay = None
+        for i in range(100):
+            delay = policy.backoff(delay)
+            self.assertTrue(1 <= delay <= 10)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_opens_and_closes(self):
+        breaker = fluidinfo.CircuitBreaker(failure_threshold=2,
+                                           reset_timeout=60)
+        pool = FakePool(FakeResponse(500), FakeResponse(500),
+                        FakeResponse(200, '{}'))
+        client = fluidinfo.FluidinfoClient(pool=pool, breaker=breaker)
+        client.get('/users/test')
+        self.assertEqual('closed', breaker.state)
+        client.get('/users/test')
+        self.assertEqual('open', breaker.state)
+        self.assertRaises(fluidinfo.CircuitOpenError, client.get,
+                          '/users/test')
+        self.assertEqual(1, breaker.rejected)
+        # after the timeout one trial request is let through
+        breaker.opened_at -= 60
+        self.assertEqual('half-open', breaker.state)
+        self.assertEqual('200', client.get('/users/test')[0]['status'])
+        self.assertEqual('closed', breaker.state)
+
+    def test_failed_trial_reopens(self):
+        breaker = fluidinfo.CircuitBreaker(failure_threshold=1,
+                                           reset_timeout=0)
+        breaker.record_failure()
+        breaker.before_request()
+        # only one trial at a time
+        self.assertRaises(fluidinfo.CircuitOpenError, breaker.before_request)
+        breaker.reset_timeout = 60
+        breaker.record_failure()
+        self.assertEqual('open', breaker.state)
+
+    def test_trial_raises(self):
+        breaker = fluidinfo.CircuitBreaker(failure_threshold=1,
+                                           reset_timeout=60)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+        pool = FakePool(FakeResponse(200, '{}'))
+
+        def request(*args, **kw):
+            raise ValueError('not a transport error')
+        pool.request = request
+        client = fluidinfo.FluidinfoClient(pool=pool, breaker=breaker)
+        self.assertRaises(ValueError, client.get, '/users/test')
+        # the failed trial re-opens the breaker rather than leaving it stuck
+        self.assertEqual('open', breaker.state)
+        breaker.opened_at -= 60
+        del pool.request
+        self.assertEqual('200', client.get('/users/test')[0]['status'])
+        self.assertEqual('closed', breaker.state)
+
+    def test_module_breakers_per_instance(self):
+        breaker = fluidinfo.CircuitBreaker()
+        fluidinfo.circuit_breakers[fluidinfo.SANDBOX] = breaker
+        try:
+            fluidinfo.instance = fluidinfo.SANDBOX
+            self.assertTrue(fluidinfo.default_client.breaker is breaker)
+            fluidinfo.instance = fluidinfo.MAIN
+            self.assertEqual(None, fluidinfo.default_client.breaker)
+        finally:
+            del fluidinfo.circuit_breakers[fluidinfo.SANDBOX]
+
+
+class TestMapCalls(unittest.TestCase):
+
+    def setUp(self):
+        self.server = fakefluidinfo.FakeFluidinfoServer()
+        self.client = fluidinfo.FluidinfoClient(self.server.start(),
+                                                USERNAME, PASSWORD)
+        self.client.post('/tags/test', {'name': 'tag', 'indexed': False,
+                                        'description': 'a tag'})
+
+    def tearDown(self):
+        self.client.pool.close()
+        self.server.stop()
+
+    def calls(self):
+        calls = [('PUT', ['about', str(i), 'test', 'tag'], {'body': i})
+                 for i in range(20)]
+        calls.append(('PUT', '/about/bad/test/tag', {'body': object()}))
+        calls.append(('GET', '/users/test'))
+        return calls
+
+    def test_map_calls(self):
+        results = self.client.map_calls(self.calls(), max_workers=5)
+        self.assertEqual(22, len(results))
+        for headers, content in results[:20]:
+            self.assertEqual('204', headers['status'])
+        # errors are returned in place of the result
+        self.assertTrue(isinstance(results[20], TypeError))
+        self.assertEqual(USERNAME, results[21][1]['name'])
+        results = self.client.map_calls(
+            [('GET', ['about', str(i), 'test', 'tag']) for i in range(20)])
+        self.assertEqual(range(20), [content for headers, content in results])
+
+    def test_as_completed(self):
+        seen = {}
+        for index, result in self.client.as_completed(self.calls(), 5):
+            seen[index] = result
+        self.assertEqual(range(22), sorted(seen))
+        self.assertTrue(isinstance(seen[20], TypeError))
+
+    def test_worker_pool_shutdown(self):
+        workers = fluidinfo.WorkerPool(3)
+        futures = [workers.submit(time.sleep, 0.01) for i in range(6)]
+        threads = list(workers._threads)
+        workers.shutdown()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        self.assertTrue(all(future.done() for future in futures))
+
 if __name__ == '__main__':
     unittest.main()